@@ -797,9 +797,11 @@ def main():
             print(f"Using project type: {project_type['name']!r} (user-selected)", file=sys.stderr)
         else:
             print(f"Unknown --project-type {forced_type_name!r}, falling back to auto-detect", file=sys.stderr)
-    if project_type is None:
+    if project_type is None and os.path.isdir(base):
+        # base ya es absoluto y normalizado: un solo isdir para todos los detectores
         for pt in get_project_types():
-            if pt["detect"](base):
+            detect = pt.get("detect_unchecked") or pt["detect"]
+            if detect(base):
                 project_type = pt
                 break
 
@@ -864,6 +866,23 @@ def main():
         print("And set the corresponding API key: GROQ_API_KEY, OPENAI_API_KEY, ANTHROPIC_API_KEY, GEMINI_API_KEY, DEEPSEEK_API_KEY, OPENROUTER_API_KEY", file=sys.stderr)
         sys.exit(1)
 
+    # Builders especializados con el esquema ya fijado (opcional en el contrato): build_prompt genérico -> closure
+    specialized_builders = {}
+    if project_type and project_type.get("make_builders"):
+        for variant_name, builder in project_type["make_builders"](schema).items():
+            variant_config = project_type["variants"].get(variant_name)
+            if variant_config:
+                specialized_builders[variant_config["build_prompt"]] = builder
+
+    def render_prompt(build_prompt_fn, code, rel):
+        builder = specialized_builders.get(build_prompt_fn)
+        if builder is not None:
+            return builder(code)
+        try:
+            return build_prompt_fn(schema, code, file_path=rel)
+        except TypeError:
+            return build_prompt_fn(schema, code)
+
     to_retry = []  # (filepath, rel, build_prompt_fn, code_kind) para reintentar al final
 
     if project_type:
@@ -893,10 +912,7 @@ def main():
                 print(f"  [{current_run}/{pending}] [{variant_name}] {rel}", file=sys.stderr)
                 try:
                     code = load_file(filepath)
-                    try:
-                        prompt = build_prompt_fn(schema, code, file_path=rel)
-                    except TypeError:
-                        prompt = build_prompt_fn(schema, code)
+                    prompt = render_prompt(build_prompt_fn, code, rel)
                     if not _schema_has_tables(schema):
                         prompt += NO_SCHEMA_PROMPT_SUFFIX
                     raw = provider(prompt)
@@ -964,10 +980,7 @@ def main():
         for filepath, rel, build_prompt_fn, code_kind in to_retry:
             try:
                 code = load_file(filepath)
-                try:
-                    prompt = build_prompt_fn(schema, code, file_path=rel)
-                except TypeError:
-                    prompt = build_prompt_fn(schema, code)
+                prompt = render_prompt(build_prompt_fn, code, rel)
                 if not _schema_has_tables(schema):
                     prompt += NO_SCHEMA_PROMPT_SUFFIX
                 raw = provider(prompt)
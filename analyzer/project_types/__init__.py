@@ -13,10 +13,13 @@ from project_types.express import EXPRESS
 # Contrato: cada tipo es un dict con:
 #   name: str
 #   detect(root_path: str) -> bool
+#   detect_unchecked(root_path: str) -> bool  — (opcional) igual que detect pero sin os.path.isdir: extract_deps
+#       comprueba una vez que root_path es un directorio absoluto y normalizado y lo pasa a todos los detectores
 #   extensions: tuple[str, ...]  — extensiones a escanear (ej. (".php",) o (".ts", ".tsx"))
 #   exclude_dirs: tuple[str, ...]  — (opcional) carpetas a no recorrer, ej. ("vendor", "node_modules")
 #   classify(files: list[str], base_path: str) -> dict[str, list[str]]  — variant_name -> paths
 #   variants: dict[str, dict]  — variant_name -> {"build_prompt": (schema, code) -> str, "code_kind": str | None}
+#   make_builders(schema) -> dict[str, (code) -> str]  — (opcional) builders por variante con el esquema ya fijado
 # code_kind = tipo de nodo al que asociar el código del archivo (ej. "controller", "model"); None = no asociar
 
 def get_project_types():
@@ -7,10 +7,8 @@ import json
 import os
 
 
-def _detect(path: str) -> bool:
-    path = os.path.normpath(os.path.abspath(str(path).strip()))
-    if not path or not os.path.isdir(path):
-        return False
+def _detect_unchecked(path: str) -> bool:
+    """express en dependencies/devDependencies de package.json (y no NestJS, que también lo trae)."""
     pkg = os.path.join(path, "package.json")
     if not os.path.isfile(pkg):
         return False
@@ -27,6 +25,13 @@ def _detect(path: str) -> bool:
     return False
 
 
+def _detect(path: str) -> bool:
+    path = os.path.normpath(os.path.abspath(str(path).strip()))
+    if not path or not os.path.isdir(path):
+        return False
+    return _detect_unchecked(path)
+
+
 def _classify(file_paths: list[str], base_path: str) -> dict:
     base = os.path.normpath(os.path.abspath(base_path))
     routes = []
@@ -115,6 +120,7 @@ Rules:
 EXPRESS = {
     "name": "express",
     "detect": _detect,
+    "detect_unchecked": _detect_unchecked,
     "extensions": (".js", ".ts"),
     "exclude_dirs": ("node_modules", "dist", "build", ".git"),
     "classify": _classify,
@@ -8,12 +8,17 @@ import json
 import os
 
 
+def _detect_unchecked(path: str) -> bool:
+    """Cualquier carpeta con package.json (va la última en el registro)."""
+    pkg = os.path.join(path, "package.json")
+    return os.path.isfile(pkg)
+
+
 def _detect(path: str) -> bool:
     path = os.path.normpath(os.path.abspath(str(path).strip()))
     if not path or not os.path.isdir(path):
         return False
-    pkg = os.path.join(path, "package.json")
-    return os.path.isfile(pkg)
+    return _detect_unchecked(path)
 
 
 def _classify(file_paths: list[str], base_path: str) -> dict:
@@ -58,6 +63,7 @@ Remember: ONE node for this file. Only real exports and real imports. No invente
 GENERIC_NODE = {
     "name": "generic_node",
     "detect": _detect,
+    "detect_unchecked": _detect_unchecked,
     "extensions": (".js", ".ts", ".jsx", ".tsx"),
     "exclude_dirs": ("node_modules", "dist", "build", ".git", "coverage"),
     "classify": _classify,
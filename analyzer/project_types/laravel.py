@@ -7,10 +7,8 @@ import json
 import os
 
 
-def _detect(path: str) -> bool:
-    path = os.path.abspath(path)
-    if not os.path.isdir(path):
-        return False
+def _detect_unchecked(path: str) -> bool:
+    """laravel/framework en composer.json o, sin él, la estructura app/Http/Controllers, app/Models o routes."""
     composer = os.path.join(path, "composer.json")
     if os.path.isfile(composer):
         try:
@@ -27,6 +25,13 @@ def _detect(path: str) -> bool:
     return False
 
 
+def _detect(path: str) -> bool:
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        return False
+    return _detect_unchecked(path)
+
+
 def _classify(file_paths: list[str], base_path: str) -> dict:
     base = os.path.normpath(os.path.abspath(base_path))
     controllers = []
@@ -187,6 +192,7 @@ Rules:
 LARAVEL = {
     "name": "laravel",
     "detect": _detect,
+    "detect_unchecked": _detect_unchecked,
     "extensions": (".php", ".blade.php"),
     "exclude_dirs": ("vendor", "node_modules", "coverage"),  # dependencias y reportes
     "classify": _classify,
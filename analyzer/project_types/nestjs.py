@@ -7,10 +7,8 @@ import json
 import os
 
 
-def _detect(path: str) -> bool:
-    path = os.path.abspath(path)
-    if not os.path.isdir(path):
-        return False
+def _detect_unchecked(path: str) -> bool:
+    """@nestjs/core en dependencies/devDependencies de package.json."""
     pkg = os.path.join(path, "package.json")
     if not os.path.isfile(pkg):
         return False
@@ -25,6 +23,13 @@ def _detect(path: str) -> bool:
     return False
 
 
+def _detect(path: str) -> bool:
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        return False
+    return _detect_unchecked(path)
+
+
 def _classify(file_paths: list[str], base_path: str) -> dict:
     base = os.path.normpath(os.path.abspath(base_path))
     controllers = []
@@ -151,6 +156,7 @@ Rules:
 NESTJS = {
     "name": "nestjs",
     "detect": _detect,
+    "detect_unchecked": _detect_unchecked,
     "extensions": (".ts", ".js"),
     "exclude_dirs": ("node_modules", "dist", "build", ".git"),
     "classify": _classify,
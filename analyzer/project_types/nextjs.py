@@ -5,12 +5,22 @@ Detección por package.json (next) o carpetas app/, pages/.
 
 import json
 import os
+from collections import OrderedDict
+from typing import Callable
 
+# Esquema compacto por defecto (menos bytes y tokens); ANALYZER_PRETTY_SCHEMA=1 vuelve a indent=2
+# si se necesita legible. En un run se serializa una sola vez: make_builders guarda el str en su closure.
+_PROMPT_CACHE_MAX = 4096
+_PROMPT_SEEN_MAX = 65536
+_PRETTY_SCHEMA = os.environ.get("ANALYZER_PRETTY_SCHEMA", "").strip().lower() in ("1", "true", "yes")
 
-def _detect(path: str) -> bool:
-    path = os.path.abspath(path)
-    if not os.path.isdir(path):
-        return False
+
+def _schema_str(schema: dict) -> str:
+    return json.dumps(schema, indent=2) if _PRETTY_SCHEMA else json.dumps(schema, separators=(",", ":"))
+
+
+def _detect_unchecked(path: str) -> bool:
+    """next en package.json o carpetas app/ o pages/ en la raíz."""
     pkg = os.path.join(path, "package.json")
     if os.path.isfile(pkg):
         try:
@@ -28,46 +38,78 @@ def _detect(path: str) -> bool:
     return False
 
 
-def _classify(file_paths: list[str], base_path: str) -> dict:
-    base = os.path.normpath(os.path.abspath(base_path))
+def _detect(path: str) -> bool:
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        return False
+    return _detect_unchecked(path)
+
+
+# En POSIX relpath ya devuelve "/": no hace falta normalizar separadores por archivo
+_SEP_IS_SLASH = os.sep == "/"
+# Primer segmento de la ruta relativa -> variante (0 app, 1 pages, 2 components)
+_HEAD_DISPATCH: dict[str, int] = {"app": 0, "pages": 1, "components": 2}
+_ROUTE_FILES = frozenset(("route.ts", "route.tsx", "route.js", "route.jsx"))
+_PAGE_FILES = frozenset(("page.tsx", "page.ts", "page.jsx", "page.js"))
+
+
+def _classify_batch(file_paths: list[str], base: str) -> tuple[list, list, list]:
+    """Clasifica en bloque (pages, api_routes, components); base debe ser absoluto y normalizado."""
     pages = []
     api_routes = []
     components = []
+    add_page = pages.append
+    add_api = api_routes.append
+    add_component = components.append
+    prefix = base if base.endswith(os.sep) else base + os.sep
+    plen = len(prefix)
     for fp in file_paths:
-        full = os.path.normpath(os.path.abspath(fp))
-        try:
-            rel = os.path.relpath(full, base).replace("\\", "/")
-        except ValueError:
-            rel = full.replace("\\", "/")
+        # Descarte barato: una ruta absoluta sin ninguna raíz conocida no puede clasificarse
+        if "app" not in fp and "pages" not in fp and "components" not in fp and os.path.isabs(fp):
+            continue
+        if _SEP_IS_SLASH and fp.startswith(prefix) and "//" not in fp and "/." not in fp:
+            # Ruta ya normalizada bajo base (lo habitual con os.walk): relpath por slicing
+            rel = fp[plen:]
+        else:
+            full = os.path.normpath(os.path.abspath(fp))
+            try:
+                rel = os.path.relpath(full, base)
+            except ValueError:
+                rel = full
+            if not _SEP_IS_SLASH:
+                rel = rel.replace("\\", "/")
+        kind = _HEAD_DISPATCH.get(rel.partition("/")[0], -1)
+        if kind < 0:
+            continue
         parts = rel.split("/")
-        # App Router: app/**/page.tsx|js, app/api/**/route.ts|js
-        if parts and parts[0] == "app":
-            if "api" in parts and (parts[-1] == "route.ts" or parts[-1] == "route.tsx" or parts[-1] == "route.js" or parts[-1] == "route.jsx"):
-                api_routes.append(fp)
-                continue
-            if parts[-1] in ("page.tsx", "page.ts", "page.jsx", "page.js"):
-                pages.append(fp)
-                continue
-        # Pages Router: pages/*.tsx, pages/api/*.ts
-        if parts and parts[0] == "pages":
+        if kind == 0:
+            # App Router: app/**/page.tsx|js, app/api/**/route.ts|js
+            if "api" in parts and parts[-1] in _ROUTE_FILES:
+                add_api(fp)
+            elif parts[-1] in _PAGE_FILES:
+                add_page(fp)
+        elif kind == 1:
+            # Pages Router: pages/*.tsx, pages/api/*.ts
             if len(parts) > 1 and parts[1] == "api":
-                api_routes.append(fp)
-                continue
-            if parts[-1].endswith((".tsx", ".ts", ".jsx", ".js")):
-                pages.append(fp)
-                continue
-        # components/
-        if parts and parts[0] == "components":
-            components.append(fp)
+                add_api(fp)
+            elif parts[-1].endswith((".tsx", ".ts", ".jsx", ".js")):
+                add_page(fp)
+        elif kind == 2:
+            # components/
+            add_component(fp)
+    return pages, api_routes, components
+
+
+def _classify(file_paths: list[str], base_path: str) -> dict:
+    base = os.path.normpath(os.path.abspath(base_path))
+    pages, api_routes, components = _classify_batch(file_paths, base)
     return {"pages": pages, "api_routes": api_routes, "components": components}
 
 
-def _build_prompt_page(schema: dict, code: str) -> str:
-    schema_str = json.dumps(schema, indent=2)
-    return f"""You are analyzing a Next.js codebase. Given a database schema (JSON) and a page file (App Router or Pages Router), extract the dependency graph.
+_PAGE_TEMPLATE = """You are analyzing a Next.js codebase. Given a database schema (JSON) and a page file (App Router or Pages Router), extract the dependency graph.
 
 Database schema:
-{schema_str}
+{schema}
 
 Page file content:
 ```
@@ -96,12 +138,14 @@ Rules:
 """
 
 
-def _build_prompt_api_route(schema: dict, code: str) -> str:
-    schema_str = json.dumps(schema, indent=2)
-    return f"""You are analyzing a Next.js API route. Given a database schema (JSON) and the route handler code, extract the dependency graph.
+def _build_prompt_page(schema: dict, code: str) -> str:
+    return _PAGE_TEMPLATE.format(schema=_schema_str(schema), code=code)
+
+
+_API_ROUTE_TEMPLATE = """You are analyzing a Next.js API route. Given a database schema (JSON) and the route handler code, extract the dependency graph.
 
 Database schema:
-{schema_str}
+{schema}
 
 API route file content:
 ```
@@ -126,12 +170,14 @@ Rules:
 """
 
 
-def _build_prompt_component(schema: dict, code: str) -> str:
-    schema_str = json.dumps(schema, indent=2)
-    return f"""You are analyzing a Next.js component. Given a database schema (JSON) and the component file, extract the dependency graph.
+def _build_prompt_api_route(schema: dict, code: str) -> str:
+    return _API_ROUTE_TEMPLATE.format(schema=_schema_str(schema), code=code)
+
+
+_COMPONENT_TEMPLATE = """You are analyzing a Next.js component. Given a database schema (JSON) and the component file, extract the dependency graph.
 
 Database schema:
-{schema_str}
+{schema}
 
 Component file content:
 ```
@@ -157,12 +203,52 @@ Rules:
 """
 
 
+def _build_prompt_component(schema: dict, code: str) -> str:
+    return _COMPONENT_TEMPLATE.format(schema=_schema_str(schema), code=code)
+
+
+def make_builders(schema: dict) -> dict[str, Callable[[str], str]]:
+    """Builders por variante con el esquema ya fijado: por archivo solo queda un str.format."""
+    schema_str = _schema_str(schema)
+    # Archivos duplicados (re-exports, boilerplate) reutilizan el prompt. Clave = hash del código.
+    # La primera vez solo se anota el hash; el prompt (que incluye todo el esquema) se guarda a partir
+    # de la segunda, así un run sin duplicados no retiene miles de prompts que no se vuelven a usar.
+    seen: OrderedDict[tuple[str, int], None] = OrderedDict()
+    cache: OrderedDict[tuple[str, int], str] = OrderedDict()
+
+    def cached(kind: str, template: str) -> Callable[[str], str]:
+        def build(code: str) -> str:
+            key = (kind, hash(code))
+            hit = cache.get(key)
+            if hit is not None:
+                return hit
+            out = template.format(schema=schema_str, code=code)
+            if key in seen:
+                cache[key] = out
+                if len(cache) > _PROMPT_CACHE_MAX:
+                    cache.popitem(last=False)
+            else:
+                seen[key] = None
+                if len(seen) > _PROMPT_SEEN_MAX:
+                    seen.popitem(last=False)
+            return out
+        return build
+
+    return {
+        "pages": cached("page", _PAGE_TEMPLATE),
+        "api_routes": cached("api_route", _API_ROUTE_TEMPLATE),
+        "components": cached("component", _COMPONENT_TEMPLATE),
+    }
+
+
 NEXTJS = {
     "name": "nextjs",
     "detect": _detect,
+    "detect_unchecked": _detect_unchecked,
     "extensions": (".ts", ".tsx", ".js", ".jsx"),
     "exclude_dirs": ("node_modules", ".next", "dist", "build", ".git"),
     "classify": _classify,
+    "make_builders": make_builders,
     "variants": {
         "pages": {
             "build_prompt": _build_prompt_page,
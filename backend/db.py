@@ -3,11 +3,41 @@ Capa de acceso a PostgreSQL (anatomydb).
 Conexión desde env: DATABASE_URL o POSTGRES_*.
 """
 
+import asyncio
 import json
+import logging
 import os
+import secrets
+import threading
+import time
 import uuid
-from contextlib import contextmanager
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timezone
+
+from sqlalchemy import bindparam, create_engine, make_url, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+_log = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from yyjson import loads as _yyjson_loads
+except ImportError:
+    _yyjson_loads = None
+
+try:
+    import asyncpg  # noqa: F401
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    _HAS_ASYNCPG = True
+except ImportError:
+    _HAS_ASYNCPG = False
 
 try:
     from dotenv import load_dotenv
@@ -26,13 +56,46 @@ if not DATABASE_URL and all(os.environ.get(k) for k in ("POSTGRES_HOST", "POSTGR
         db=os.environ.get("POSTGRES_DB", "anatomydb"),
     )
 
-def _is_sqlite():
-    return not DATABASE_URL or "sqlite" in DATABASE_URL
+# DATABASE_URL no cambia tras el arranque: el dialecto se decide una vez
+_IS_SQLITE = not DATABASE_URL or "sqlite" in DATABASE_URL
+
+def _now_iso() -> str:
+    """UTC en ISO 8601 con sufijo Z y microsegundos fijos (ordenable como texto en SQLite)."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def _now():
+    """Marca de tiempo para escribir: texto ISO en SQLite, datetime UTC con zona en Postgres (timestamptz)."""
+    return _now_iso() if _IS_SQLITE else datetime.now(timezone.utc)
+
 
 def get_engine():
-    from sqlalchemy import create_engine
     url = DATABASE_URL or "sqlite:///./anatomydb.sqlite"
-    return create_engine(url, connect_args={"check_same_thread": False} if "sqlite" in url else {})
+    if "sqlite" in url:
+        if ":memory:" in url:
+            # Una sola conexión compartida: cada conexión nueva a :memory: sería una BD vacía
+            return create_engine(url, connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        return create_engine(url, connect_args={"check_same_thread": False})
+    connect_args = {}
+    if make_url(url).get_driver_name() == "psycopg":
+        # psycopg 3: sentencias preparadas en el servidor desde la primera ejecución (0) en vez de la
+        # quinta; las consultas cortas y repetidas se saltan parse/plan. Con pgbouncer en modo
+        # transacción hay que desactivarlo (DB_PREPARE_THRESHOLD vacío).
+        threshold = os.environ.get("DB_PREPARE_THRESHOLD", "0")
+        connect_args["prepare_threshold"] = int(threshold) if threshold else None
+    # Postgres: pre_ping descarta conexiones muertas tras inactividad; tamaño del pool por env
+    return create_engine(
+        url,
+        pool_pre_ping=True,
+        pool_size=int(os.environ.get("DB_POOL_SIZE", "10")),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+        pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+        connect_args=connect_args,
+        # El dialecto registra estas funciones como loader/dumper de JSONB en cada conexión:
+        # con orjson la decodificación ocurre al leer la fila, sin pasar por json estándar
+        json_serializer=_dumps,
+        json_deserializer=_loads,
+    )
 
 _engine = None
 
@@ -42,11 +105,47 @@ def get_db_engine():
         _engine = get_engine()
     return _engine
 
+def _dumps(value) -> str:
+    """json.dumps compacto; usa orjson si está instalado."""
+    if orjson is not None:
+        return orjson.dumps(value).decode()
+    return json.dumps(value, separators=(",", ":"))
+
+
+def _loads(raw):
+    """json.loads; usa orjson si está instalado (acepta str o bytes)."""
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+@contextmanager
+def _pipeline(conn):
+    """Modo pipeline de psycopg 3 en la Connection (sin esperar respuesta por sentencia); no-op en otros drivers."""
+    raw = conn.connection.dbapi_connection
+    if not hasattr(raw, "pipeline"):
+        yield
+        return
+    with raw.pipeline():
+        yield
+
+
+def _loads_text(raw):
+    """Decodifica el TEXT JSON de SQLite (notas grandes): yyjson (SIMD) si está, si no _loads."""
+    return _yyjson_loads(raw) if _yyjson_loads is not None else _loads(raw)
+
+
+def _jsonb_param(name: str):
+    """Parámetro JSONB tipado (Postgres): el dict se enlaza directo, sin json.dumps + CAST en el SQL."""
+    return bindparam(name, type_=JSONB)
+
+_SessionFactory = None
+
 @contextmanager
 def session_scope():
-    from sqlalchemy.orm import sessionmaker
-    Session = sessionmaker(bind=get_db_engine(), autocommit=False, autoflush=False)
-    session = Session()
+    global _SessionFactory
+    if _SessionFactory is None:
+        # Una sola fábrica por proceso; cada llamada solo crea la Session (segura entre hilos)
+        _SessionFactory = sessionmaker(bind=get_db_engine(), autocommit=False, autoflush=False)
+    session = _SessionFactory()
     try:
         yield session
         session.commit()
@@ -56,13 +155,112 @@ def session_scope():
     finally:
         session.close()
 
-def init_db():
-    """Crea las tablas si no existen."""
-    from sqlalchemy import text
-    engine = get_db_engine()
-    if _is_sqlite():
+_read_engine = None
+
+
+@contextmanager
+def read_scope():
+    """Conexión en AUTOCOMMIT para lecturas: sin BEGIN/COMMIT ni Session. Las escrituras siguen en session_scope()."""
+    global _read_engine
+    if _read_engine is None:
+        # Mismo pool que el motor principal; solo cambia el nivel de aislamiento de la conexión
+        _read_engine = get_db_engine().execution_options(isolation_level="AUTOCOMMIT")
+    with _read_engine.connect() as conn:
+        yield conn
+
+@contextmanager
+def write_scope():
+    """Connection en una transacción (commit al salir, rollback si falla), sin la Session del ORM.
+    Para escrituras de pocas sentencias text() en rutas calientes."""
+    with get_db_engine().begin() as conn:
+        yield conn
+
+# Motor async (solo Postgres con asyncpg instalado) para los helpers que llama FastAPI;
+# sin él, las variantes *_async delegan en la versión síncrona con asyncio.to_thread.
+_ASYNC_ENABLED = _HAS_ASYNCPG and not _IS_SQLITE
+_async_engine = None
+_AsyncSessionFactory = None
+
+
+def _get_async_engine():
+    global _async_engine
+    if _async_engine is None:
+        url = make_url(DATABASE_URL).set(drivername="postgresql+asyncpg")
+        _async_engine = create_async_engine(
+            url,
+            pool_pre_ping=True,
+            pool_size=int(os.environ.get("DB_POOL_SIZE", "10")),
+            max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", "20")),
+            pool_recycle=int(os.environ.get("DB_POOL_RECYCLE", "1800")),
+            # Consultas cortas: el JIT de Postgres solo añade latencia
+            connect_args={"server_settings": {"jit": "off"}},
+            json_serializer=_dumps,
+            json_deserializer=_loads,
+        )
+    return _async_engine
+
+
+@asynccontextmanager
+async def async_session_scope():
+    global _AsyncSessionFactory
+    if _AsyncSessionFactory is None:
+        _AsyncSessionFactory = async_sessionmaker(bind=_get_async_engine(), autoflush=False, expire_on_commit=False)
+    session = _AsyncSessionFactory()
+    try:
+        yield session
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+async def dispose_async_engine() -> None:
+    """Cierra el pool async al apagar la app (no-op si nunca se creó)."""
+    global _async_engine, _AsyncSessionFactory
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+        _AsyncSessionFactory = None
+
+# Índices compuestos para los "*_latest" (WHERE project_id ORDER BY fecha DESC LIMIT 1);
+# graphs_pid_created_idx también cubre los EXISTS por project_id, así que el simple sobra.
+# agent_api_key ya tiene índice por su UNIQUE.
+_INDEX_DDL = (
+    "DROP INDEX IF EXISTS graphs_project_id_idx",
+    # GIN opcionales de versiones anteriores: ninguna consulta filtra por contenido de las notas
+    "DROP INDEX IF EXISTS ix_project_node_notes_notes_gin",
+    "DROP INDEX IF EXISTS ix_project_node_notes_v2_notes_gin",
+    "CREATE INDEX IF NOT EXISTS project_schemas_pid_recv_idx ON project_schemas(project_id, received_at DESC)",
+    "CREATE INDEX IF NOT EXISTS graphs_pid_created_idx ON graphs(project_id, created_at DESC)",
+    "CREATE INDEX IF NOT EXISTS project_checkpoints_pid_created_idx ON project_checkpoints(project_id, created_at DESC)",
+    "CREATE INDEX IF NOT EXISTS analysis_jobs_pid_created_idx ON analysis_jobs(project_id, created_at DESC)",
+)
+
+
+def _add_column(conn, ddl: str) -> None:
+    """ALTER de columna en un savepoint: si falla (ya existe / ya no existe) no aborta el resto del DDL."""
+    try:
+        with conn.begin_nested():
+            conn.execute(text(ddl))
+    except Exception:
+        pass
+
+
+# Versión que introdujo project_node_notes_v2: la copia desde el dict por proyecto solo se hace al
+# subir desde una versión anterior (así no reaparecen notas borradas cuando el DDL vuelve a correr).
+_NOTES_V2_VERSION = 7
+# Versión que retira project_node_notes.notes_bin (copia msgpack/zstd de notes de las versiones 5 y 6):
+# nadie la lee desde las filas por nodo y notes conserva los mismos datos.
+_NOTES_BIN_DROP_VERSION = 9
+
+
+def _run_ddl(engine, from_version: int = 0) -> None:
+    """Crea tablas y columnas que falten (idempotente). from_version = versión registrada en la BD."""
+    if _IS_SQLITE:
         # SQLite para desarrollo sin Postgres
-        with engine.connect() as c:
+        with engine.begin() as c:
             c.execute(text("""
                 CREATE TABLE IF NOT EXISTS projects (
                     id TEXT PRIMARY KEY,
@@ -93,11 +291,6 @@ def init_db():
                     log TEXT DEFAULT ''
                 )
             """))
-            try:
-                c.execute(text("ALTER TABLE analysis_jobs ADD COLUMN log TEXT DEFAULT ''"))
-            except Exception:
-                pass
-            c.commit()
             c.execute(text("""
                 CREATE TABLE IF NOT EXISTS graphs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -118,9 +311,18 @@ def init_db():
             c.execute(text("""
                 CREATE TABLE IF NOT EXISTS project_node_notes (
                     project_id TEXT PRIMARY KEY REFERENCES projects(id) ON DELETE CASCADE,
-                    notes TEXT NOT NULL DEFAULT '{}'
+                    notes TEXT NOT NULL DEFAULT '{}',
+                    rev INTEGER NOT NULL DEFAULT 0
                 )
             """))
+            c.execute(text("""
+                CREATE TABLE IF NOT EXISTS project_node_notes_v2 (
+                    project_id TEXT NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+                    node_id TEXT NOT NULL,
+                    notes TEXT NOT NULL DEFAULT '[]',
+                    PRIMARY KEY (project_id, node_id)
+                ) WITHOUT ROWID
+            """))
             c.execute(text("""
                 CREATE TABLE IF NOT EXISTS project_graph_ui_state (
                     project_id TEXT PRIMARY KEY REFERENCES projects(id) ON DELETE CASCADE,
@@ -128,36 +330,31 @@ def init_db():
                     updated_at TEXT NOT NULL
                 )
             """))
-            c.commit()
-            try:
-                c.execute(text("ALTER TABLE projects ADD COLUMN excluded_paths TEXT DEFAULT '[]'"))
-                c.commit()
-            except Exception:
-                pass
-            for col, default in (("repo_url", "''"), ("repo_branch", "'main'")):
-                try:
-                    c.execute(text(f"ALTER TABLE projects ADD COLUMN {col} TEXT DEFAULT {default}"))
-                    c.commit()
-                except Exception:
-                    pass
-            try:
-                c.execute(text("ALTER TABLE projects ADD COLUMN github_access_token TEXT"))
-                c.commit()
-            except Exception:
-                pass
-            try:
-                c.execute(text("ALTER TABLE projects ADD COLUMN listen_updates INTEGER NOT NULL DEFAULT 0"))
-                c.commit()
-            except Exception:
-                pass
-            try:
-                c.execute(text("ALTER TABLE projects ADD COLUMN project_type TEXT DEFAULT ''"))
-                c.commit()
-            except Exception:
-                pass
+            for stmt in _INDEX_DDL:
+                c.execute(text(stmt))
+            for ddl in (
+                "ALTER TABLE analysis_jobs ADD COLUMN log TEXT DEFAULT ''",
+                "ALTER TABLE projects ADD COLUMN excluded_paths TEXT DEFAULT '[]'",
+                "ALTER TABLE projects ADD COLUMN repo_url TEXT DEFAULT ''",
+                "ALTER TABLE projects ADD COLUMN repo_branch TEXT DEFAULT 'main'",
+                "ALTER TABLE projects ADD COLUMN github_access_token TEXT",
+                "ALTER TABLE projects ADD COLUMN listen_updates INTEGER NOT NULL DEFAULT 0",
+                "ALTER TABLE projects ADD COLUMN project_type TEXT DEFAULT ''",
+                "ALTER TABLE project_node_notes ADD COLUMN rev INTEGER NOT NULL DEFAULT 0",
+            ):
+                _add_column(c, ddl)
+            if from_version < _NOTES_BIN_DROP_VERSION:
+                _add_column(c, "ALTER TABLE project_node_notes DROP COLUMN notes_bin")
+            # Copia única del dict por proyecto a filas por nodo. project_node_notes.notes no se toca:
+            # una versión anterior del backend sigue viendo las notas de antes.
+            if from_version < _NOTES_V2_VERSION:
+                c.execute(text(
+                    "INSERT OR IGNORE INTO project_node_notes_v2 (project_id, node_id, notes) "
+                    "SELECT n.project_id, j.key, j.value FROM project_node_notes n, json_each(n.notes) j WHERE n.notes <> '{}'"
+                ))
         return
     # Postgres
-    with engine.connect() as conn:
+    with engine.begin() as conn:
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS projects (
                 id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
@@ -188,27 +385,6 @@ def init_db():
                 log TEXT DEFAULT ''
             )
         """))
-        try:
-            conn.execute(text("ALTER TABLE analysis_jobs ADD COLUMN IF NOT EXISTS log TEXT DEFAULT ''"))
-        except Exception:
-            pass
-        for col, default in (("repo_url", "''"), ("repo_branch", "'main'")):
-            try:
-                conn.execute(text(f"ALTER TABLE projects ADD COLUMN IF NOT EXISTS {col} TEXT DEFAULT {default}"))
-            except Exception:
-                pass
-        try:
-            conn.execute(text("ALTER TABLE projects ADD COLUMN IF NOT EXISTS github_access_token TEXT"))
-        except Exception:
-            pass
-        try:
-            conn.execute(text("ALTER TABLE projects ADD COLUMN IF NOT EXISTS listen_updates BOOLEAN NOT NULL DEFAULT FALSE"))
-        except Exception:
-            pass
-        try:
-            conn.execute(text("ALTER TABLE projects ADD COLUMN IF NOT EXISTS project_type VARCHAR(64) DEFAULT ''"))
-        except Exception:
-            pass
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS graphs (
                 id SERIAL PRIMARY KEY,
@@ -229,7 +405,16 @@ def init_db():
         conn.execute(text("""
             CREATE TABLE IF NOT EXISTS project_node_notes (
                 project_id UUID PRIMARY KEY REFERENCES projects(id) ON DELETE CASCADE,
-                notes JSONB NOT NULL DEFAULT '{}'
+                notes JSONB NOT NULL DEFAULT '{}',
+                rev INTEGER NOT NULL DEFAULT 0
+            )
+        """))
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS project_node_notes_v2 (
+                project_id UUID NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+                node_id TEXT NOT NULL,
+                notes JSONB NOT NULL DEFAULT '[]',
+                PRIMARY KEY (project_id, node_id)
             )
         """))
         conn.execute(text("""
@@ -239,241 +424,490 @@ def init_db():
                 updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
             )
         """))
-        try:
-            conn.execute(text("ALTER TABLE projects ADD COLUMN IF NOT EXISTS excluded_paths JSONB DEFAULT '[]'"))
-            conn.commit()
-        except Exception:
-            pass
-        conn.commit()
+        for stmt in _INDEX_DDL:
+            conn.execute(text(stmt))
+        for ddl in (
+            "ALTER TABLE analysis_jobs ADD COLUMN IF NOT EXISTS log TEXT DEFAULT ''",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS repo_url TEXT DEFAULT ''",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS repo_branch TEXT DEFAULT 'main'",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS github_access_token TEXT",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS listen_updates BOOLEAN NOT NULL DEFAULT FALSE",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS project_type VARCHAR(64) DEFAULT ''",
+            "ALTER TABLE projects ADD COLUMN IF NOT EXISTS excluded_paths JSONB DEFAULT '[]'",
+            "ALTER TABLE project_node_notes ADD COLUMN IF NOT EXISTS rev INTEGER NOT NULL DEFAULT 0",
+        ):
+            _add_column(conn, ddl)
+        if from_version < _NOTES_BIN_DROP_VERSION:
+            _add_column(conn, "ALTER TABLE project_node_notes DROP COLUMN IF EXISTS notes_bin")
+        # Copia única del dict por proyecto a filas por nodo (la columna antigua se conserva)
+        if from_version < _NOTES_V2_VERSION:
+            conn.execute(text(
+                "INSERT INTO project_node_notes_v2 (project_id, node_id, notes) "
+                "SELECT n.project_id, j.key, j.value FROM project_node_notes n, jsonb_each(n.notes) j "
+                "WHERE n.notes <> '{}'::jsonb ON CONFLICT DO NOTHING"
+            ))
+
+
+# Versión del esquema creado por _run_ddl. Subirla al añadir tablas/columnas/índices
+# para que las instancias ya creadas vuelvan a ejecutar el DDL una vez.
+_SCHEMA_VERSION = 9
+_initialized = False
+
+
+def _schema_version(engine) -> int:
+    """Versión registrada en la BD; 0 si la tabla aún no existe."""
+    try:
+        with engine.connect() as c:
+            row = c.execute(text("SELECT MAX(version) FROM schema_version")).fetchone()
+    except Exception:
+        return 0
+    return int(row[0] or 0) if row else 0
+
+
+def init_db():
+    """Crea las tablas si no existen. Con el esquema al día solo cuesta un SELECT."""
+    global _initialized
+    if _initialized:
+        return
+    engine = get_db_engine()
+    version = _schema_version(engine)
+    if version < _SCHEMA_VERSION:
+        _run_ddl(engine, version)
+        with engine.begin() as c:
+            c.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+            c.execute(text("DELETE FROM schema_version"))
+            c.execute(text("INSERT INTO schema_version (version) VALUES (:v)"), {"v": _SCHEMA_VERSION})
+    _detect_project_columns(engine)
+    _initialized = True
+
+
+# Columnas opcionales de projects (añadidas por ALTER en versiones posteriores). Se detectan una vez
+# en init_db para elegir la consulta correcta sin probar con try/except en cada petición.
+_HAS_EXCLUDED_PATHS = True
+_HAS_REPO_COLS = True
+_HAS_GITHUB_TOKEN = True
+_HAS_LISTEN_UPDATES = True
+_HAS_PROJECT_TYPE = True
+
+
+def _detect_project_columns(engine) -> None:
+    global _HAS_EXCLUDED_PATHS, _HAS_REPO_COLS, _HAS_GITHUB_TOKEN, _HAS_LISTEN_UPDATES, _HAS_PROJECT_TYPE
+    with engine.connect() as c:
+        if _IS_SQLITE:
+            cols = {row[1] for row in c.execute(text("PRAGMA table_info(projects)"))}
+        else:
+            cols = {row[0] for row in c.execute(text(
+                "SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'projects'"
+            ))}
+    _HAS_EXCLUDED_PATHS = "excluded_paths" in cols
+    _HAS_REPO_COLS = "repo_url" in cols and "repo_branch" in cols
+    _HAS_GITHUB_TOKEN = "github_access_token" in cols
+    _HAS_LISTEN_UPDATES = "listen_updates" in cols
+    _HAS_PROJECT_TYPE = "project_type" in cols
+    _build_project_queries()
+
+
+def _project_select_columns() -> str:
+    """Columnas de projects en orden fijo; las que falten se sustituyen por su valor por defecto."""
+    return ", ".join((
+        "p.id", "p.name", "p.codebase_path", "p.agent_api_key", "p.created_at", "p.updated_at",
+        "p.excluded_paths" if _HAS_EXCLUDED_PATHS else "NULL AS excluded_paths",
+        "p.repo_url" if _HAS_REPO_COLS else "'' AS repo_url",
+        "p.repo_branch" if _HAS_REPO_COLS else "'main' AS repo_branch",
+        "p.listen_updates" if _HAS_LISTEN_UPDATES else "0 AS listen_updates",
+        "p.project_type" if _HAS_PROJECT_TYPE else "'' AS project_type",
+    ))
+
+
+def _build_project_queries() -> None:
+    global _SQL_PROJECT_LIST, _SQL_PROJECT_GET, _SQL_PROJECT_UPDATE
+    cols = _project_select_columns()
+    id_expr = ":id" if _IS_SQLITE else "CAST(:id AS uuid)"
+    has_github = (
+        "(p.github_access_token IS NOT NULL AND LENGTH(TRIM(p.github_access_token)) > 0)"
+        if _HAS_GITHUB_TOKEN else "0"
+    )
+    _SQL_PROJECT_LIST = text(
+        f"SELECT {cols}, EXISTS(SELECT 1 FROM graphs g WHERE g.project_id = p.id) AS has_graph "
+        "FROM projects p ORDER BY p.created_at DESC"
+    )
+    # Fila + flags en una sola consulta/transacción
+    _SQL_PROJECT_GET = text(
+        f"SELECT {cols}, "
+        "EXISTS(SELECT 1 FROM project_schemas WHERE project_id = p.id) AS has_schema, "
+        "EXISTS(SELECT 1 FROM graphs WHERE project_id = p.id) AS has_graph, "
+        "EXISTS(SELECT 1 FROM project_checkpoints WHERE project_id = p.id) AS has_checkpoint, "
+        f"{has_github} AS has_github FROM projects p WHERE p.id = {id_expr}"
+    )
+    # UPDATE de texto fijo: los campos que no cambian llegan como NULL y COALESCE conserva el valor
+    sets = ["name = COALESCE(:name, name)", "codebase_path = COALESCE(:path, codebase_path)"]
+    if _HAS_EXCLUDED_PATHS:
+        sets.append(
+            "excluded_paths = COALESCE(:excluded, excluded_paths)" if _IS_SQLITE
+            else "excluded_paths = COALESCE(CAST(:excluded AS jsonb), excluded_paths)"
+        )
+    if _HAS_REPO_COLS:
+        sets.append("repo_url = COALESCE(:repo_url, repo_url)")
+        sets.append("repo_branch = COALESCE(:repo_branch, repo_branch)")
+    if _HAS_LISTEN_UPDATES:
+        sets.append("listen_updates = COALESCE(:listen_updates, listen_updates)")
+    if _HAS_PROJECT_TYPE:
+        sets.append("project_type = COALESCE(:project_type, project_type)")
+    sets.append("updated_at = :now")
+    _SQL_PROJECT_UPDATE = text(f"UPDATE projects SET {', '.join(sets)} WHERE id = {id_expr}")
+
+
+_SQL_PROJECT_LIST = None
+_SQL_PROJECT_GET = None
+_SQL_PROJECT_UPDATE = None
+_build_project_queries()
+
+
+# Sentencias de las rutas calientes compiladas una vez al importar (variante SQLite / Postgres)
+_SQL_PROJECT_BY_API_KEY = text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at FROM projects WHERE agent_api_key = :key")
+_SQL_PROJECT_GITHUB_TOKEN_SQLITE = text("SELECT github_access_token FROM projects WHERE id = :id")
+_SQL_PROJECT_GITHUB_TOKEN_PG = text("SELECT github_access_token FROM projects WHERE id = CAST(:id AS uuid)")
+_SQL_SCHEMA_INSERT_SQLITE = text("INSERT INTO project_schemas (project_id, schema, received_at) VALUES (:pid, :schema, :now)")
+_SQL_SCHEMA_INSERT_PG = text("INSERT INTO project_schemas (project_id, schema, received_at) VALUES (CAST(:pid AS uuid), :schema, :now)").bindparams(_jsonb_param("schema"))
+_SQL_SCHEMA_LATEST_SQLITE = text("SELECT schema FROM project_schemas WHERE project_id = :id ORDER BY received_at DESC LIMIT 1")
+_SQL_SCHEMA_LATEST_PG = text("SELECT schema FROM project_schemas WHERE project_id = CAST(:id AS uuid) ORDER BY received_at DESC LIMIT 1")
+_SQL_JOB_INSERT_SQLITE = text("INSERT INTO analysis_jobs (id, project_id, status, created_at) VALUES (:id, :pid, 'pending', :now)")
+_SQL_JOB_INSERT_PG = text("INSERT INTO analysis_jobs (id, project_id, status, created_at) VALUES (CAST(:id AS uuid), CAST(:pid AS uuid), 'pending', :now)")
+_SQL_JOB_GET_SQLITE = text("SELECT id, project_id, status, created_at, started_at, finished_at, error_message, log FROM analysis_jobs WHERE id = :id")
+_SQL_JOB_GET_PG = text("SELECT id, project_id, status, created_at, started_at, finished_at, error_message, log FROM analysis_jobs WHERE id = CAST(:id AS uuid)")
+_SQL_JOB_APPEND_LOG_SQLITE = text("UPDATE analysis_jobs SET log = CASE WHEN log IS NULL OR log = '' THEN :msg ELSE log || :nl || :msg END WHERE id = :id")
+_SQL_JOB_APPEND_LOG_PG = text("UPDATE analysis_jobs SET log = CASE WHEN log IS NULL OR log = '' THEN :msg ELSE log || :nl || :msg END WHERE id = CAST(:id AS uuid)")
+_SQL_JOB_SET_RUNNING_SQLITE = text("UPDATE analysis_jobs SET status = 'running', started_at = :now WHERE id = :id")
+_SQL_JOB_SET_RUNNING_PG = text("UPDATE analysis_jobs SET status = 'running', started_at = :now WHERE id = CAST(:id AS uuid)")
+_SQL_JOB_SET_COMPLETED_SQLITE = text("UPDATE analysis_jobs SET status = 'completed', finished_at = :now WHERE id = :id")
+_SQL_JOB_SET_COMPLETED_PG = text("UPDATE analysis_jobs SET status = 'completed', finished_at = :now WHERE id = CAST(:id AS uuid)")
+_SQL_JOB_SET_FAILED_SQLITE = text("UPDATE analysis_jobs SET status = 'failed', finished_at = :now, error_message = :err WHERE id = :id")
+_SQL_JOB_SET_FAILED_PG = text("UPDATE analysis_jobs SET status = 'failed', finished_at = :now, error_message = :err WHERE id = CAST(:id AS uuid)")
+# 'cancelling': parada pedida, el proceso aún no ha terminado (no pisa un job ya finalizado)
+_SQL_JOB_SET_CANCELLING_SQLITE = text("UPDATE analysis_jobs SET status = 'cancelling' WHERE id = :id AND status IN ('pending', 'running')")
+_SQL_JOB_SET_CANCELLING_PG = text("UPDATE analysis_jobs SET status = 'cancelling' WHERE id = CAST(:id AS uuid) AND status IN ('pending', 'running')")
+_SQL_JOB_CANCELLING_EXISTS_SQLITE = text("SELECT 1 FROM analysis_jobs WHERE project_id = :id AND status = 'cancelling' LIMIT 1")
+_SQL_JOB_CANCELLING_EXISTS_PG = text("SELECT 1 FROM analysis_jobs WHERE project_id = CAST(:id AS uuid) AND status = 'cancelling' LIMIT 1")
+_SQL_JOBS_FINISH_CANCELLING = text(
+    "UPDATE analysis_jobs SET status = 'cancelled', finished_at = :now, error_message = 'Cancelled by user' WHERE status = 'cancelling'"
+)
+_SQL_JOB_SET_CANCELLED_SQLITE = text("UPDATE analysis_jobs SET status = 'cancelled', finished_at = :now, error_message = :err WHERE id = :id")
+_SQL_JOB_SET_CANCELLED_PG = text("UPDATE analysis_jobs SET status = 'cancelled', finished_at = :now, error_message = :err WHERE id = CAST(:id AS uuid)")
+_SQL_GRAPH_INSERT_SQLITE = text("INSERT INTO graphs (project_id, graph, created_at) VALUES (:pid, :graph, :now)")
+_SQL_GRAPH_INSERT_PG = text("INSERT INTO graphs (project_id, graph, created_at) VALUES (CAST(:pid AS uuid), :graph, :now)").bindparams(_jsonb_param("graph"))
+# Grafo ya serializado (bytes del analizador): lo valida/parsea la BD, no Python
+_SQL_GRAPH_INSERT_RAW_SQLITE = text("INSERT INTO graphs (project_id, graph, created_at) VALUES (:pid, json(:graph), :now)")
+_SQL_GRAPH_INSERT_RAW_PG = text("INSERT INTO graphs (project_id, graph, created_at) VALUES (CAST(:pid AS uuid), CAST(:graph AS jsonb), :now)")
+_SQL_GRAPH_LATEST_SQLITE = text("SELECT graph FROM graphs WHERE project_id = :id ORDER BY created_at DESC LIMIT 1")
+_SQL_GRAPH_LATEST_PG = text("SELECT graph FROM graphs WHERE project_id = CAST(:id AS uuid) ORDER BY created_at DESC LIMIT 1")
+# Lecturas parciales del grafo: el motor extrae solo lo pedido y Python no decodifica el blob
+# entero (los nodes llevan el código fuente; las aristas y los ids son una fracción).
+_SQL_GRAPH_SUMMARY_SQLITE = text(
+    "SELECT json_array_length(graph, '$.nodes'), json_array_length(graph, '$.edges') "
+    "FROM graphs WHERE project_id = :id ORDER BY created_at DESC LIMIT 1"
+)
+_SQL_GRAPH_SUMMARY_PG = text(
+    "SELECT jsonb_array_length(COALESCE(graph->'nodes', '[]'::jsonb)), jsonb_array_length(COALESCE(graph->'edges', '[]'::jsonb)) "
+    "FROM graphs WHERE project_id = CAST(:id AS uuid) ORDER BY created_at DESC LIMIT 1"
+)
+_SQL_GRAPH_TOPOLOGY_SQLITE = text(
+    "SELECT (SELECT json_group_array(json_extract(value, '$.id')) FROM json_each(graph, '$.nodes')), "
+    "json_extract(graph, '$.edges') "
+    "FROM graphs WHERE project_id = :id ORDER BY created_at DESC LIMIT 1"
+)
+_SQL_GRAPH_TOPOLOGY_PG = text(
+    "SELECT jsonb_path_query_array(graph, '$.nodes[*].id'), graph->'edges' "
+    "FROM graphs WHERE project_id = CAST(:id AS uuid) ORDER BY created_at DESC LIMIT 1"
+)
+_SQL_GRAPH_DELETE_ALL_SQLITE = text("DELETE FROM graphs WHERE project_id = :id")
+_SQL_GRAPH_DELETE_ALL_PG = text("DELETE FROM graphs WHERE project_id = CAST(:id AS uuid)")
+_SQL_CHECKPOINT_INSERT_SQLITE = text("INSERT INTO project_checkpoints (project_id, job_id, checkpoint, created_at) VALUES (:pid, :jid, :chk, :now)")
+_SQL_CHECKPOINT_INSERT_PG = text("INSERT INTO project_checkpoints (project_id, job_id, checkpoint, created_at) VALUES (CAST(:pid AS uuid), CAST(:jid AS uuid), :chk, :now)").bindparams(_jsonb_param("chk"))
+_SQL_CHECKPOINT_LATEST_SQLITE = text("SELECT job_id, checkpoint FROM project_checkpoints WHERE project_id = :id ORDER BY created_at DESC, id DESC LIMIT 1")
+_SQL_CHECKPOINT_LATEST_PG = text("SELECT job_id, checkpoint FROM project_checkpoints WHERE project_id = CAST(:id AS uuid) ORDER BY created_at DESC, id DESC LIMIT 1")
+_SQL_CHECKPOINT_CLEAR_SQLITE = text("DELETE FROM project_checkpoints WHERE project_id = :id")
+_SQL_CHECKPOINT_CLEAR_PG = text("DELETE FROM project_checkpoints WHERE project_id = CAST(:id AS uuid)")
+# Notas: una fila por (proyecto, nodo) en project_node_notes_v2, así editar un nodo solo reescribe
+# esa fila. project_node_notes queda como cabecera por proyecto: rev sube en cada escritura y es
+# el sondeo barato que valida la caché del dict ya decodificado.
+_SQL_NOTES_REV_SQLITE = text("SELECT rev FROM project_node_notes WHERE project_id = :id")
+_SQL_NOTES_REV_PG = text("SELECT rev FROM project_node_notes WHERE project_id = CAST(:id AS uuid)")
+_NOTES_BUMP_SQLITE = (
+    "INSERT INTO project_node_notes (project_id) VALUES (:id) "
+    "ON CONFLICT (project_id) DO UPDATE SET rev = project_node_notes.rev + 1"
+)
+_NOTES_BUMP_PG = (
+    "INSERT INTO project_node_notes (project_id) VALUES (CAST(:id AS uuid)) "
+    "ON CONFLICT (project_id) DO UPDATE SET rev = project_node_notes.rev + 1"
+)
+_SQL_NOTES_BUMP_SQLITE = text(_NOTES_BUMP_SQLITE)
+_SQL_NOTES_BUMP_PG = text(_NOTES_BUMP_PG)
+# node_notes_set bloquea la cabecera antes de leer la base del diff (UPDATE sin cambios: lock de fila
+# en Postgres, lock de escritura en SQLite); así dos reemplazos a la vez no mezclan sus diffs.
+# Si aún no hay cabecera se crea primero (DO NOTHING espera al INSERT concurrente) y se bloquea.
+_SQL_NOTES_LOCK_SQLITE = text("UPDATE project_node_notes SET rev = rev WHERE project_id = :id RETURNING rev")
+_SQL_NOTES_LOCK_PG = text("UPDATE project_node_notes SET rev = rev WHERE project_id = CAST(:id AS uuid) RETURNING rev")
+_SQL_NOTES_HEADER_SQLITE = text("INSERT INTO project_node_notes (project_id) VALUES (:id) ON CONFLICT (project_id) DO NOTHING")
+_SQL_NOTES_HEADER_PG = text("INSERT INTO project_node_notes (project_id) VALUES (CAST(:id AS uuid)) ON CONFLICT (project_id) DO NOTHING")
+# Variante que devuelve la rev resultante (para dejar en caché el dict recién escrito)
+_SQL_NOTES_BUMP_RET_SQLITE = text(_NOTES_BUMP_SQLITE + " RETURNING rev")
+_SQL_NOTES_BUMP_RET_PG = text(_NOTES_BUMP_PG + " RETURNING rev")
+_SQL_NOTES_ROWS_SQLITE = text("SELECT node_id, notes FROM project_node_notes_v2 WHERE project_id = :id")
+_SQL_NOTES_ROWS_PG = text("SELECT node_id, notes FROM project_node_notes_v2 WHERE project_id = CAST(:id AS uuid)")
+_SQL_NOTES_NODE_SQLITE = text("SELECT notes FROM project_node_notes_v2 WHERE project_id = :id AND node_id = :node")
+_SQL_NOTES_NODE_PG = text("SELECT notes FROM project_node_notes_v2 WHERE project_id = CAST(:id AS uuid) AND node_id = :node")
+_SQL_NOTES_ROWS_MANY_SQLITE = text(
+    "SELECT project_id, node_id, notes FROM project_node_notes_v2 WHERE project_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+_SQL_NOTES_ROWS_MANY_PG = text(
+    "SELECT project_id, node_id, notes FROM project_node_notes_v2 WHERE project_id = ANY(CAST(:ids AS uuid[]))"
+)
+# UPSERT por nodo con EXCLUDED (el payload se enlaza una vez)
+_SQL_NOTES_NODE_UPSERT_SQLITE = text(
+    "INSERT INTO project_node_notes_v2 (project_id, node_id, notes) VALUES (:id, :node, :notes) "
+    "ON CONFLICT (project_id, node_id) DO UPDATE SET notes = EXCLUDED.notes"
+)
+_SQL_NOTES_NODE_UPSERT_PG = text(
+    "INSERT INTO project_node_notes_v2 (project_id, node_id, notes) VALUES (CAST(:id AS uuid), :node, :notes) "
+    "ON CONFLICT (project_id, node_id) DO UPDATE SET notes = EXCLUDED.notes"
+).bindparams(_jsonb_param("notes"))
+_SQL_NOTES_NODE_DELETE_SQLITE = text(
+    "DELETE FROM project_node_notes_v2 WHERE project_id = :id AND node_id IN :nodes"
+).bindparams(bindparam("nodes", expanding=True))
+_SQL_NOTES_NODE_DELETE_PG = text(
+    "DELETE FROM project_node_notes_v2 WHERE project_id = CAST(:id AS uuid) AND node_id IN :nodes"
+).bindparams(bindparam("nodes", expanding=True))
+_SQL_NOTES_DELETE_MANY_SQLITE = text(
+    "DELETE FROM project_node_notes_v2 WHERE project_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+_SQL_NOTES_DELETE_MANY_PG = text("DELETE FROM project_node_notes_v2 WHERE project_id = ANY(CAST(:ids AS uuid[]))")
+
+_SQL_UI_STATE_SELECT_SQLITE = text("SELECT state FROM project_graph_ui_state WHERE project_id = :id")
+_SQL_UI_STATE_SELECT_PG = text("SELECT state FROM project_graph_ui_state WHERE project_id = CAST(:id AS uuid)")
+_SQL_UI_STATE_UPSERT_SQLITE = text(
+    "INSERT INTO project_graph_ui_state (project_id, state, updated_at) VALUES (:id, :state, :now) "
+    "ON CONFLICT (project_id) DO UPDATE SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at"
+)
+_SQL_UI_STATE_MERGE_PG = text(
+    "INSERT INTO project_graph_ui_state (project_id, state, updated_at) VALUES (CAST(:id AS uuid), :state, :now) "
+    "ON CONFLICT (project_id) DO UPDATE SET state = project_graph_ui_state.state || EXCLUDED.state, updated_at = EXCLUDED.updated_at"
+).bindparams(_jsonb_param("state"))
 
 
 def project_create(name: str, codebase_path: str = "", repo_url: str = "", repo_branch: str = "main") -> dict:
     """Crea un proyecto y devuelve el dict con id, agent_api_key, etc."""
-    import secrets
     pid = str(uuid.uuid4())
     api_key = secrets.token_urlsafe(32)
-    now = datetime.utcnow().isoformat() + "Z"
+    now = _now_iso()
+    params = {"id": pid, "name": name, "path": codebase_path or "", "key": api_key, "now": now, "repo_url": repo_url or "", "repo_branch": repo_branch or "main"}
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            try:
+        if _IS_SQLITE:
+            if _HAS_REPO_COLS:
                 s.execute(text(
                     "INSERT INTO projects (id, name, codebase_path, agent_api_key, created_at, updated_at, repo_url, repo_branch) VALUES (:id, :name, :path, :key, :now, :now, :repo_url, :repo_branch)"
-                ), {"id": pid, "name": name, "path": codebase_path or "", "key": api_key, "now": now, "repo_url": repo_url or "", "repo_branch": repo_branch or "main"})
-            except Exception:
+                ), params)
+            else:
                 s.execute(text(
                     "INSERT INTO projects (id, name, codebase_path, agent_api_key, created_at, updated_at) VALUES (:id, :name, :path, :key, :now, :now)"
-                ), {"id": pid, "name": name, "path": codebase_path or "", "key": api_key, "now": now})
+                ), params)
         else:
             s.execute(text(
                 "INSERT INTO projects (id, name, codebase_path, agent_api_key, created_at, updated_at, repo_url, repo_branch) VALUES (CAST(:id AS uuid), :name, :path, :key, CAST(:now AS timestamptz), CAST(:now AS timestamptz), :repo_url, :repo_branch)"
-            ), {"id": pid, "name": name, "path": codebase_path or "", "key": api_key, "now": now, "repo_url": repo_url or "", "repo_branch": repo_branch or "main"})
+            ), params)
     return {"id": pid, "name": name, "codebase_path": codebase_path or "", "agent_api_key": api_key, "created_at": now, "updated_at": now, "repo_url": repo_url or "", "repo_branch": repo_branch or "main", "listen_updates": False, "project_type": ""}
 
 
+class _TTLCache:
+    """Caché en memoria del proceso con TTL y tamaño máximo (expulsa el más antiguo); segura entre hilos."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def pop_where(self, pred) -> None:
+        """Elimina las entradas cuyo valor cumple pred(value)."""
+        with self._lock:
+            for key in [k for k, (_exp, v) in self._data.items() if pred(v)]:
+                del self._data[key]
+
+
+# Lookups de autenticación (agente por api_key, token GitHub por proyecto). Perder una entrada
+# solo cuesta una consulta; se invalidan al modificar o borrar el proyecto.
+_MISSING = object()
+_api_key_cache = _TTLCache(maxsize=1024, ttl=60)
+_github_token_cache = _TTLCache(maxsize=1024, ttl=60)
+
+
+def _invalidate_project(project_id: str) -> None:
+    _github_token_cache.pop(str(project_id))
+    _api_key_cache.pop_where(lambda d: d["id"] == str(project_id))
+
+
 def _parse_excluded_paths(val) -> list:
-    if val is None:
-        return []
+    """Postgres (JSONB) ya devuelve list; solo el TEXT de SQLite necesita json.loads."""
     if isinstance(val, list):
         return val
-    try:
-        import json
-        return json.loads(val) if isinstance(val, str) else []
-    except Exception:
-        return []
+    return json.loads(val) if val else []
 
 
-def project_list() -> list:
-    with session_scope() as s:
-        from sqlalchemy import text
-        try:
-            r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at, excluded_paths, repo_url, repo_branch, listen_updates, project_type FROM projects ORDER BY created_at DESC"))
-            has_repo_cols = True
-            has_listen_col = True
-            has_project_type = True
-        except Exception:
-            has_project_type = False
-            has_listen_col = False
-            try:
-                r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at, excluded_paths, repo_url, repo_branch FROM projects ORDER BY created_at DESC"))
-                has_repo_cols = True
-                has_project_type = False
-            except Exception:
-                try:
-                    r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at, excluded_paths FROM projects ORDER BY created_at DESC"))
-                except Exception:
-                    r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at FROM projects ORDER BY created_at DESC"))
-                has_repo_cols = False
-        rows = r.fetchall()
-        r2 = s.execute(text("SELECT DISTINCT project_id FROM graphs"))
-        ids_with_graph = {str(row[0]) for row in r2.fetchall()}
-    if not rows:
-        return []
+def _iso(value):
+    """datetime (Postgres) -> ISO; los TEXT de SQLite ya vienen en ISO."""
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _project_row_to_dict(row) -> dict:
+    """Convierte una fila (RowMapping) de _project_select_columns() en el dict de la API."""
+    d = dict(row)
+    d["id"] = str(d["id"])
+    d["created_at"] = _iso(d["created_at"])
+    d["updated_at"] = _iso(d["updated_at"])
+    d["excluded_paths"] = _parse_excluded_paths(d["excluded_paths"])
+    d["repo_url"] = d["repo_url"] or ""
+    d["repo_branch"] = d["repo_branch"] or "main"
+    d["listen_updates"] = bool(d["listen_updates"])
+    d["project_type"] = d["project_type"] or ""
+    return d
+
+
+def _project_list_rows_to_dicts(rows) -> list:
     out = []
-    for r in rows:
-        row_list = list(r)
-        if len(row_list) < 7:
-            row_list.extend([[]] * (7 - len(row_list)))
-        excluded = _parse_excluded_paths(row_list[6])
-        proj_id = str(row_list[0])
-        keys = ["id", "name", "codebase_path", "agent_api_key", "created_at", "updated_at"]
-        d = dict(zip(keys, (proj_id, row_list[1], row_list[2], row_list[3], row_list[4].isoformat() if hasattr(row_list[4], "isoformat") else row_list[4], row_list[5].isoformat() if hasattr(row_list[5], "isoformat") else row_list[5])))
-        d["excluded_paths"] = excluded
-        d["has_graph"] = proj_id in ids_with_graph
-        if has_repo_cols and len(row_list) >= 9:
-            d["repo_url"] = row_list[7] or ""
-            d["repo_branch"] = row_list[8] or "main"
-        else:
-            d["repo_url"] = ""
-            d["repo_branch"] = "main"
-        d["listen_updates"] = bool(row_list[9]) if (has_listen_col and len(row_list) > 9) else False
-        d["project_type"] = (row_list[10] or "") if (has_project_type and len(row_list) > 10) else ""
+    for row in rows:
+        d = _project_row_to_dict(row)
+        d["has_graph"] = bool(d["has_graph"])
         out.append(d)
     return out
 
 
-def project_get(project_id: str) -> dict | None:
-    with session_scope() as s:
-        from sqlalchemy import text
-        try:
-            if _is_sqlite():
-                r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at, excluded_paths, repo_url, repo_branch, listen_updates, project_type FROM projects WHERE id = :id"), {"id": project_id})
-            else:
-                r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at, excluded_paths, repo_url, repo_branch, listen_updates, project_type FROM projects WHERE id = CAST(:id AS uuid)"), {"id": project_id})
-            row = r.fetchone()
-            has_repo_cols = True
-            has_listen_col = True
-            has_project_type = True
-        except Exception:
-            has_listen_col = False
-            has_project_type = False
-            try:
-                if _is_sqlite():
-                    r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at, excluded_paths, repo_url, repo_branch FROM projects WHERE id = :id"), {"id": project_id})
-                else:
-                    r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at, excluded_paths, repo_url, repo_branch FROM projects WHERE id = CAST(:id AS uuid)"), {"id": project_id})
-            except Exception:
-                if _is_sqlite():
-                    r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at FROM projects WHERE id = :id"), {"id": project_id})
-                else:
-                    r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at FROM projects WHERE id = CAST(:id AS uuid)"), {"id": project_id})
-            row = r.fetchone()
-            has_repo_cols = False
+def _project_get_row_to_dict(row) -> dict | None:
     if not row:
         return None
-    keys = ["id", "name", "codebase_path", "agent_api_key", "created_at", "updated_at"]
-    d = dict(zip(keys, (str(row[0]), row[1], row[2], row[3], row[4].isoformat() if hasattr(row[4], "isoformat") else row[4], row[5].isoformat() if hasattr(row[5], "isoformat") else row[5])))
-    d["excluded_paths"] = _parse_excluded_paths(row[6]) if len(row) > 6 else []
-    d["repo_url"] = (row[7] or "") if has_repo_cols and len(row) > 8 else ""
-    d["repo_branch"] = (row[8] or "main") if has_repo_cols and len(row) > 8 else "main"
-    d["listen_updates"] = bool(row[9]) if (has_listen_col and len(row) > 9) else False
-    d["project_type"] = (row[10] or "") if (has_project_type and len(row) > 10) else ""
-    with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            r = s.execute(text("SELECT 1 FROM project_schemas WHERE project_id = :id ORDER BY received_at DESC LIMIT 1"), {"id": project_id})
-        else:
-            r = s.execute(text("SELECT 1 FROM project_schemas WHERE project_id = CAST(:id AS uuid) ORDER BY received_at DESC LIMIT 1"), {"id": project_id})
-        d["has_schema"] = r.fetchone() is not None
-        if _is_sqlite():
-            r = s.execute(text("SELECT 1 FROM graphs WHERE project_id = :id LIMIT 1"), {"id": project_id})
-        else:
-            r = s.execute(text("SELECT 1 FROM graphs WHERE project_id = CAST(:id AS uuid) LIMIT 1"), {"id": project_id})
-        d["has_graph"] = r.fetchone() is not None
-        if _is_sqlite():
-            r = s.execute(text("SELECT 1 FROM project_checkpoints WHERE project_id = :id LIMIT 1"), {"id": project_id})
-        else:
-            r = s.execute(text("SELECT 1 FROM project_checkpoints WHERE project_id = CAST(:id AS uuid) LIMIT 1"), {"id": project_id})
-        d["has_checkpoint"] = r.fetchone() is not None
-    d["has_github_connected"] = project_has_github_connected(project_id)
+    d = _project_row_to_dict(row)
+    d["has_schema"] = bool(d["has_schema"])
+    d["has_graph"] = bool(d["has_graph"])
+    d["has_checkpoint"] = bool(d["has_checkpoint"])
+    d["has_github_connected"] = bool(d.pop("has_github"))
     return d
 
 
+def project_list() -> list:
+    with session_scope() as s:
+        rows = s.execute(_SQL_PROJECT_LIST).mappings().all()
+    return _project_list_rows_to_dicts(rows)
+
+
+async def project_list_async() -> list:
+    if not _ASYNC_ENABLED:
+        return await asyncio.to_thread(project_list)
+    async with async_session_scope() as s:
+        rows = (await s.execute(_SQL_PROJECT_LIST)).mappings().all()
+    return _project_list_rows_to_dicts(rows)
+
+
+def project_get(project_id: str) -> dict | None:
+    with session_scope() as s:
+        row = s.execute(_SQL_PROJECT_GET, {"id": project_id}).mappings().first()
+    return _project_get_row_to_dict(row)
+
+
+async def project_get_async(project_id: str) -> dict | None:
+    if not _ASYNC_ENABLED:
+        return await asyncio.to_thread(project_get, project_id)
+    async with async_session_scope() as s:
+        row = (await s.execute(_SQL_PROJECT_GET, {"id": project_id})).mappings().first()
+    return _project_get_row_to_dict(row)
+
+
 def project_update(project_id: str, name: str | None = None, codebase_path: str | None = None, excluded_paths: list | None = None, repo_url: str | None = None, repo_branch: str | None = None, listen_updates: bool | None = None, project_type: str | None = None) -> bool:
-    import json
-    from sqlalchemy import text
-    updates = []
-    params = {"id": project_id}
-    if name is not None:
-        updates.append("name = :name")
-        params["name"] = name
-    if codebase_path is not None:
-        updates.append("codebase_path = :path")
-        params["path"] = codebase_path
-    if excluded_paths is not None:
-        params["excluded"] = json.dumps(excluded_paths)
-        updates.append("excluded_paths = :excluded" if _is_sqlite() else "excluded_paths = CAST(:excluded AS jsonb)")
-    if repo_url is not None:
-        updates.append("repo_url = :repo_url")
-        params["repo_url"] = repo_url
-    if repo_branch is not None:
-        updates.append("repo_branch = :repo_branch")
-        params["repo_branch"] = repo_branch
-    if listen_updates is not None:
-        updates.append("listen_updates = :listen_updates")
-        params["listen_updates"] = (1 if listen_updates else 0) if _is_sqlite() else bool(listen_updates)
-    if project_type is not None:
-        updates.append("project_type = :project_type")
-        params["project_type"] = (project_type or "").strip() if isinstance(project_type, str) else ""
-    if not updates:
+    # Columnas ausentes en la tabla se ignoran, como antes
+    if not _HAS_EXCLUDED_PATHS:
+        excluded_paths = None
+    if not _HAS_REPO_COLS:
+        repo_url = repo_branch = None
+    if not _HAS_LISTEN_UPDATES:
+        listen_updates = None
+    if not _HAS_PROJECT_TYPE:
+        project_type = None
+    if all(v is None for v in (name, codebase_path, excluded_paths, repo_url, repo_branch, listen_updates, project_type)):
         return True
-    updates.append("updated_at = :now")
-    params["now"] = datetime.utcnow().isoformat() + "Z" if _is_sqlite() else datetime.utcnow()
+    params = {
+        "id": project_id,
+        "name": name,
+        "path": codebase_path,
+        "excluded": json.dumps(excluded_paths) if excluded_paths is not None else None,
+        "repo_url": repo_url,
+        "repo_branch": repo_branch,
+        "listen_updates": None if listen_updates is None else ((1 if listen_updates else 0) if _IS_SQLITE else bool(listen_updates)),
+        "project_type": None if project_type is None else ((project_type or "").strip() if isinstance(project_type, str) else ""),
+        "now": _now(),
+    }
     with session_scope() as s:
-        try:
-            if _is_sqlite():
-                s.execute(text(f"UPDATE projects SET {', '.join(updates)} WHERE id = :id"), params)
-            else:
-                s.execute(text(f"UPDATE projects SET {', '.join(updates)} WHERE id = CAST(:id AS uuid)"), params)
-        except Exception:
-            # Si excluded_paths no existe como columna, actualizar sin ella
-            if "excluded_paths" in str(updates):
-                updates = [u for u in updates if "excluded_paths" not in u]
-                params.pop("excluded", None)
-                if len(updates) > 1:
-                    if _is_sqlite():
-                        s.execute(text(f"UPDATE projects SET {', '.join(updates)} WHERE id = :id"), params)
-                    else:
-                        s.execute(text(f"UPDATE projects SET {', '.join(updates)} WHERE id = CAST(:id AS uuid)"), params)
-            else:
-                raise
+        s.execute(_SQL_PROJECT_UPDATE, params)
+    _invalidate_project(project_id)
     return True
 
 
 def project_delete(project_id: str) -> bool:
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
+        if _IS_SQLITE:
             s.execute(text("DELETE FROM projects WHERE id = :id"), {"id": project_id})
         else:
             s.execute(text("DELETE FROM projects WHERE id = CAST(:id AS uuid)"), {"id": project_id})
+    _invalidate_project(project_id)
     return True
 
 
 def project_set_github_token(project_id: str, token: str | None) -> bool:
     """Guarda el token OAuth de GitHub del proyecto. token=None para desconectar."""
     with session_scope() as s:
-        from sqlalchemy import text
         tok = (token or "").strip() or None
-        if _is_sqlite():
+        if _IS_SQLITE:
             s.execute(text("UPDATE projects SET github_access_token = :tok WHERE id = :id"), {"id": project_id, "tok": tok})
         else:
             s.execute(text("UPDATE projects SET github_access_token = :tok WHERE id = CAST(:id AS uuid)"), {"id": project_id, "tok": tok})
+    _invalidate_project(project_id)
     return True
 
 
 def project_get_github_token(project_id: str) -> str | None:
     """Devuelve el token de GitHub del proyecto (solo uso interno, nunca exponer en API)."""
+    cached = _github_token_cache.get(str(project_id), _MISSING)
+    if cached is not _MISSING:
+        return cached
+    token = _project_get_github_token_uncached(project_id)
+    _github_token_cache.set(str(project_id), token)
+    return token
+
+
+def _project_get_github_token_uncached(project_id: str) -> str | None:
+    if not _HAS_GITHUB_TOKEN:
+        return None
     with session_scope() as s:
-        from sqlalchemy import text
-        try:
-            if _is_sqlite():
-                r = s.execute(text("SELECT github_access_token FROM projects WHERE id = :id"), {"id": project_id})
-            else:
-                r = s.execute(text("SELECT github_access_token FROM projects WHERE id = CAST(:id AS uuid)"), {"id": project_id})
-            row = r.fetchone()
-        except Exception:
-            return None
+        r = s.execute(_SQL_PROJECT_GITHUB_TOKEN_SQLITE if _IS_SQLITE else _SQL_PROJECT_GITHUB_TOKEN_PG, {"id": project_id})
+        row = r.fetchone()
     if not row or not row[0] or not str(row[0]).strip():
         return None
     return str(row[0]).strip()
@@ -511,8 +945,7 @@ def project_find_by_repo_branch(repo_full_name: str, branch: str) -> list[str]:
         return []
     try:
         with session_scope() as s:
-            from sqlalchemy import text
-            if _is_sqlite():
+            if _IS_SQLITE:
                 r = s.execute(text(
                     "SELECT id FROM projects WHERE listen_updates = 1 AND (repo_url = :repo OR repo_url = :repo_alt) AND (TRIM(COALESCE(repo_branch, 'main')) = :branch)"
                 ), {"repo": repo_norm, "repo_alt": f"https://github.com/{repo_norm}", "branch": branch_norm})
@@ -527,35 +960,59 @@ def project_find_by_repo_branch(repo_full_name: str, branch: str) -> list[str]:
 
 
 def project_by_api_key(api_key: str) -> dict | None:
-    with session_scope() as s:
-        from sqlalchemy import text
-        r = s.execute(text("SELECT id, name, codebase_path, agent_api_key, created_at, updated_at FROM projects WHERE agent_api_key = :key"), {"key": api_key})
-        row = r.fetchone()
+    cached = _api_key_cache.get(api_key)
+    if cached is not None:
+        return dict(cached)
+    project = _project_by_api_key_uncached(api_key)
+    if project is not None:
+        _api_key_cache.set(api_key, project)
+        return dict(project)
+    return None
+
+
+async def project_by_api_key_async(api_key: str) -> dict | None:
+    cached = _api_key_cache.get(api_key)
+    if cached is not None:
+        return dict(cached)
+    if not _ASYNC_ENABLED:
+        return await asyncio.to_thread(project_by_api_key, api_key)
+    async with async_session_scope() as s:
+        row = (await s.execute(_SQL_PROJECT_BY_API_KEY, {"key": api_key})).mappings().first()
+    project = _api_key_row_to_dict(row)
+    if project is not None:
+        _api_key_cache.set(api_key, project)
+        return dict(project)
+    return None
+
+
+def _api_key_row_to_dict(row) -> dict | None:
     if not row:
         return None
-    keys = ["id", "name", "codebase_path", "agent_api_key", "created_at", "updated_at"]
-    return dict(zip(keys, (str(row[0]), row[1], row[2], row[3], row[4].isoformat() if hasattr(row[4], "isoformat") else row[4], row[5].isoformat() if hasattr(row[5], "isoformat") else row[5])))
+    d = dict(row)
+    d["id"] = str(d["id"])
+    d["created_at"] = _iso(d["created_at"])
+    d["updated_at"] = _iso(d["updated_at"])
+    return d
+
+
+def _project_by_api_key_uncached(api_key: str) -> dict | None:
+    with session_scope() as s:
+        row = s.execute(_SQL_PROJECT_BY_API_KEY, {"key": api_key}).mappings().first()
+    return _api_key_row_to_dict(row)
 
 
 def schema_save(project_id: str, schema: dict) -> None:
-    import json
-    now = datetime.utcnow().isoformat() + "Z" if _is_sqlite() else datetime.utcnow()
+    now = _now()
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text("INSERT INTO project_schemas (project_id, schema, received_at) VALUES (:pid, :schema, :now)"), {"pid": project_id, "schema": json.dumps(schema), "now": now})
+        if _IS_SQLITE:
+            s.execute(_SQL_SCHEMA_INSERT_SQLITE, {"pid": project_id, "schema": json.dumps(schema), "now": now})
         else:
-            s.execute(text("INSERT INTO project_schemas (project_id, schema, received_at) VALUES (CAST(:pid AS uuid), CAST(:schema AS jsonb), :now)"), {"pid": project_id, "schema": json.dumps(schema), "now": now})
+            s.execute(_SQL_SCHEMA_INSERT_PG, {"pid": project_id, "schema": schema, "now": now})
 
 
 def schema_get_latest(project_id: str) -> dict | None:
-    import json
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            r = s.execute(text("SELECT schema FROM project_schemas WHERE project_id = :id ORDER BY received_at DESC LIMIT 1"), {"id": project_id})
-        else:
-            r = s.execute(text("SELECT schema FROM project_schemas WHERE project_id = CAST(:id AS uuid) ORDER BY received_at DESC LIMIT 1"), {"id": project_id})
+        r = s.execute(_SQL_SCHEMA_LATEST_SQLITE if _IS_SQLITE else _SQL_SCHEMA_LATEST_PG, {"id": project_id})
         row = r.fetchone()
     if not row:
         return None
@@ -565,114 +1022,271 @@ def schema_get_latest(project_id: str) -> dict | None:
 
 def job_create(project_id: str) -> str:
     jid = str(uuid.uuid4())
-    now = datetime.utcnow().isoformat() + "Z" if _is_sqlite() else datetime.utcnow()
+    now = _now()
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text("INSERT INTO analysis_jobs (id, project_id, status, created_at) VALUES (:id, :pid, 'pending', :now)"), {"id": jid, "pid": project_id, "now": now})
-        else:
-            s.execute(text("INSERT INTO analysis_jobs (id, project_id, status, created_at) VALUES (CAST(:id AS uuid), CAST(:pid AS uuid), 'pending', :now)"), {"id": jid, "pid": project_id, "now": now})
+        s.execute(_SQL_JOB_INSERT_SQLITE if _IS_SQLITE else _SQL_JOB_INSERT_PG, {"id": jid, "pid": project_id, "now": now})
     return jid
 
 
 def job_get(job_id: str) -> dict | None:
+    _flush_job_logs_best_effort()
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            r = s.execute(text("SELECT id, project_id, status, created_at, started_at, finished_at, error_message, log FROM analysis_jobs WHERE id = :id"), {"id": job_id})
-        else:
-            r = s.execute(text("SELECT id, project_id, status, created_at, started_at, finished_at, error_message, log FROM analysis_jobs WHERE id = CAST(:id AS uuid)"), {"id": job_id})
-        row = r.fetchone()
+        row = s.execute(_SQL_JOB_GET_SQLITE if _IS_SQLITE else _SQL_JOB_GET_PG, {"id": job_id}).mappings().first()
+    return _job_row_to_dict(row)
+
+
+async def job_get_async(job_id: str) -> dict | None:
+    if not _ASYNC_ENABLED:
+        return await asyncio.to_thread(job_get, job_id)
+    if _log_queue:
+        # El volcado de logs pendientes sigue siendo síncrono (lo comparte con el hilo writer)
+        await asyncio.to_thread(_flush_job_logs_best_effort)
+    async with async_session_scope() as s:
+        row = (await s.execute(_SQL_JOB_GET_PG, {"id": job_id})).mappings().first()
+    return _job_row_to_dict(row)
+
+
+def _job_row_to_dict(row) -> dict | None:
     if not row:
         return None
-    log_val = row[7] if len(row) > 7 else ""
-    return {
-        "id": str(row[0]),
-        "project_id": str(row[1]),
-        "status": row[2],
-        "created_at": row[3].isoformat() if hasattr(row[3], "isoformat") else row[3],
-        "started_at": row[4].isoformat() if row[4] and hasattr(row[4], "isoformat") else row[4],
-        "finished_at": row[5].isoformat() if row[5] and hasattr(row[5], "isoformat") else row[5],
-        "error_message": row[6],
-        "log": log_val or "",
-    }
+    d = dict(row)
+    d["id"] = str(d["id"])
+    d["project_id"] = str(d["project_id"])
+    d["created_at"] = _iso(d["created_at"])
+    d["started_at"] = _iso(d["started_at"])
+    d["finished_at"] = _iso(d["finished_at"])
+    d["log"] = d["log"] or ""
+    return d
+
+
+# Cola de líneas de log por job: job_append_log solo encola y un hilo de fondo vuelca cada
+# _LOG_FLUSH_INTERVAL con un UPDATE por job (todas las líneas unidas). Antes de leer un job y en cada
+# cambio de estado se vuelca también lo pendiente (sin propagar fallos: las líneas vuelven a la cola y
+# el writer las reintenta), así que los lectores ven el log completo.
+# El writer se despierta antes de que venza el intervalo si lo pendiente supera _LOG_FLUSH_BYTES
+# o _log_flush_lines líneas. Ese umbral de líneas se ajusta con la media móvil (EWMA) de lo que
+# tarda cada volcado: commits lentos -> lotes más grandes; commits rápidos -> lotes más pequeños.
+_LOG_FLUSH_INTERVAL = 0.5
+_LOG_FLUSH_BYTES = 64 * 1024
+_LOG_FLUSH_LINES_MIN = 64
+_LOG_FLUSH_LINES_MAX = 4096
+_LOG_FLUSH_TARGET = 0.01  # segundos por volcado
+_LOG_EWMA_ALPHA = 0.2
+_log_flush_lines = _LOG_FLUSH_LINES_MIN
+_log_flush_ewma = 0.0
+_log_queue: dict[str, list[str]] = {}
+_log_queue_bytes = 0
+_log_queue_lines = 0
+_log_queue_lock = threading.Lock()
+_log_writer_wake = threading.Event()
+_log_flush_lock = threading.Lock()
+_log_writer: threading.Thread | None = None
+_log_writer_lock = threading.Lock()
+_log_writer_stop = threading.Event()
+# Líneas que no se pudieron volcar vuelven a la cola, pero con tope: las de un job que falla
+# _LOG_FLUSH_MAX_RETRIES veces seguidas, o las que no caben en _LOG_QUEUE_MAX_BYTES (BD caída),
+# se descartan dejándolas en el log del proceso.
+_LOG_FLUSH_MAX_RETRIES = 20
+_LOG_QUEUE_MAX_BYTES = 8 * 1024 * 1024
+_log_retries: dict[str, int] = {}
 
 
 def job_append_log(job_id: str, message: str) -> None:
-    with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            r = s.execute(text("SELECT log FROM analysis_jobs WHERE id = :id"), {"id": job_id})
-        else:
-            r = s.execute(text("SELECT log FROM analysis_jobs WHERE id = CAST(:id AS uuid)"), {"id": job_id})
-        row = r.fetchone()
-        current = (row[0] or "") if row else ""
-        new_log = (current + "\n" + message).strip() if current else message
-        if _is_sqlite():
-            s.execute(text("UPDATE analysis_jobs SET log = :log WHERE id = :id"), {"id": job_id, "log": new_log})
-        else:
-            s.execute(text("UPDATE analysis_jobs SET log = :log WHERE id = CAST(:id AS uuid)"), {"id": job_id, "log": new_log})
+    job_append_log_bulk(job_id, [message])
+
+
+def job_append_log_bulk(job_id: str, messages: list[str]) -> None:
+    """Como job_append_log para varias líneas de una vez (un solo paso por el lock de la cola)."""
+    global _log_queue_bytes, _log_queue_lines
+    if not messages:
+        return
+    with _log_queue_lock:
+        _log_queue.setdefault(job_id, []).extend(messages)
+        _log_queue_bytes += sum(len(m) + 1 for m in messages)
+        _log_queue_lines += len(messages)
+        full = _log_queue_bytes >= _LOG_FLUSH_BYTES or _log_queue_lines >= _log_flush_lines
+    if full:
+        _log_writer_wake.set()
+    if _log_writer is None or not _log_writer.is_alive():
+        _start_log_writer()
+
+
+def _tune_log_flush(elapsed: float) -> None:
+    """Actualiza la EWMA de duración de volcado y dobla/parte a la mitad el umbral de líneas."""
+    global _log_flush_ewma, _log_flush_lines
+    _log_flush_ewma += _LOG_EWMA_ALPHA * (elapsed - _log_flush_ewma)
+    if _log_flush_ewma > _LOG_FLUSH_TARGET:
+        _log_flush_lines = min(_LOG_FLUSH_LINES_MAX, _log_flush_lines * 2)
+    elif _log_flush_ewma < _LOG_FLUSH_TARGET / 2:
+        _log_flush_lines = max(_LOG_FLUSH_LINES_MIN, _log_flush_lines // 2)
+
+
+def flush_job_logs() -> None:
+    """Escribe en BD las líneas pendientes: un UPDATE (log || líneas) por job, cada uno en su savepoint."""
+    global _log_queue_bytes, _log_queue_lines
+    with _log_flush_lock:
+        with _log_queue_lock:
+            if not _log_queue:
+                return
+            pending = dict(_log_queue)
+            _log_queue.clear()
+            _log_queue_bytes = 0
+            _log_queue_lines = 0
+        started = time.monotonic()
+        failed: dict[str, list[str]] = {}
+        try:
+            with session_scope() as s:
+                stmt = _SQL_JOB_APPEND_LOG_SQLITE if _IS_SQLITE else _SQL_JOB_APPEND_LOG_PG
+                for job_id, lines in pending.items():
+                    # Un job que falla (p. ej. id que no pasa el CAST a uuid) no frena a los demás
+                    try:
+                        with s.begin_nested():
+                            s.execute(stmt, {"id": job_id, "msg": "\n".join(lines), "nl": "\n"})
+                    except Exception as e:
+                        _log.warning("No se pudo volcar el log del job %s: %s", job_id, e)
+                        failed[job_id] = lines
+        except Exception:
+            _requeue_job_logs(pending)
+            raise
+        for job_id in pending.keys() - failed.keys():
+            _log_retries.pop(job_id, None)
+        if failed:
+            _requeue_job_logs(failed)
+        _tune_log_flush(time.monotonic() - started)
+
+
+def _flush_job_logs_best_effort() -> None:
+    """flush_job_logs para lecturas y cambios de estado: un fallo de la BD no debe tumbar un GET ni
+    dejar un job a medio cambiar. flush_job_logs ya devolvió las líneas a la cola; el writer reintenta."""
+    try:
+        flush_job_logs()
+    except Exception as e:
+        _log.warning("Volcado de logs de jobs fallido (se reintenta en segundo plano): %s", e)
+
+
+def _requeue_job_logs(pending: dict[str, list[str]]) -> None:
+    """Devuelve líneas no volcadas a la cola (delante de las nuevas) salvo que el job haya agotado
+    los reintentos o no quepan en _LOG_QUEUE_MAX_BYTES: esas se descartan y se registran."""
+    global _log_queue_bytes, _log_queue_lines
+    dropped: list[tuple[str, list[str]]] = []
+    with _log_queue_lock:
+        for job_id, lines in pending.items():
+            retries = _log_retries.get(job_id, 0) + 1
+            size = sum(len(line) + 1 for line in lines)
+            if retries > _LOG_FLUSH_MAX_RETRIES or _log_queue_bytes + size > _LOG_QUEUE_MAX_BYTES:
+                _log_retries.pop(job_id, None)
+                dropped.append((job_id, lines))
+                continue
+            _log_retries[job_id] = retries
+            _log_queue[job_id] = lines + _log_queue.get(job_id, [])
+            _log_queue_bytes += size
+            _log_queue_lines += len(lines)
+    for job_id, lines in dropped:
+        _log.error("Descartadas %d líneas de log del job %s sin volcar:\n%s", len(lines), job_id, "\n".join(lines))
+
+
+def _log_writer_loop() -> None:
+    while not _log_writer_stop.is_set():
+        _log_writer_wake.wait(_LOG_FLUSH_INTERVAL)
+        _log_writer_wake.clear()
+        if _log_writer_stop.is_set():
+            break
+        try:
+            flush_job_logs()
+        except Exception as e:
+            _log.warning("Volcado de logs de jobs fallido (se reintenta): %s", e)
+
+
+def _start_log_writer() -> None:
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is not None and _log_writer.is_alive():
+            return
+        _log_writer_stop.clear()
+        _log_writer = threading.Thread(target=_log_writer_loop, name="job-log-writer", daemon=True)
+        _log_writer.start()
+
+
+def stop_log_writer() -> None:
+    """Detiene el hilo de volcado y escribe lo pendiente (apagado del backend)."""
+    global _log_writer
+    with _log_writer_lock:
+        writer = _log_writer
+        _log_writer = None
+    if writer is not None:
+        _log_writer_stop.set()
+        _log_writer_wake.set()
+        writer.join(timeout=5)
+    flush_job_logs()
 
 
 def job_set_running(job_id: str) -> None:
-    now = datetime.utcnow().isoformat() + "Z" if _is_sqlite() else datetime.utcnow()
+    now = _now()
+    _flush_job_logs_best_effort()
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text("UPDATE analysis_jobs SET status = 'running', started_at = :now WHERE id = :id"), {"id": job_id, "now": now})
-        else:
-            s.execute(text("UPDATE analysis_jobs SET status = 'running', started_at = :now WHERE id = CAST(:id AS uuid)"), {"id": job_id, "now": now})
+        s.execute(_SQL_JOB_SET_RUNNING_SQLITE if _IS_SQLITE else _SQL_JOB_SET_RUNNING_PG, {"id": job_id, "now": now})
 
 
 def job_set_completed(job_id: str) -> None:
-    now = datetime.utcnow().isoformat() + "Z" if _is_sqlite() else datetime.utcnow()
+    now = _now()
+    _flush_job_logs_best_effort()
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text("UPDATE analysis_jobs SET status = 'completed', finished_at = :now WHERE id = :id"), {"id": job_id, "now": now})
-        else:
-            s.execute(text("UPDATE analysis_jobs SET status = 'completed', finished_at = :now WHERE id = CAST(:id AS uuid)"), {"id": job_id, "now": now})
+        s.execute(_SQL_JOB_SET_COMPLETED_SQLITE if _IS_SQLITE else _SQL_JOB_SET_COMPLETED_PG, {"id": job_id, "now": now})
 
 
 def job_set_failed(job_id: str, error_message: str) -> None:
-    now = datetime.utcnow().isoformat() + "Z" if _is_sqlite() else datetime.utcnow()
+    now = _now()
+    _flush_job_logs_best_effort()
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text("UPDATE analysis_jobs SET status = 'failed', finished_at = :now, error_message = :err WHERE id = :id"), {"id": job_id, "now": now, "err": error_message})
-        else:
-            s.execute(text("UPDATE analysis_jobs SET status = 'failed', finished_at = :now, error_message = :err WHERE id = CAST(:id AS uuid)"), {"id": job_id, "now": now, "err": error_message})
+        s.execute(_SQL_JOB_SET_FAILED_SQLITE if _IS_SQLITE else _SQL_JOB_SET_FAILED_PG, {"id": job_id, "now": now, "err": error_message})
+
+
+def job_set_cancelling(job_id: str) -> None:
+    with session_scope() as s:
+        s.execute(_SQL_JOB_SET_CANCELLING_SQLITE if _IS_SQLITE else _SQL_JOB_SET_CANCELLING_PG, {"id": job_id})
+
+
+def job_cancelling_exists(project_id: str) -> bool:
+    """True si el proyecto tiene un análisis deteniéndose (proceso aún vivo o checkpoint sin guardar)."""
+    with read_scope() as c:
+        return c.execute(_SQL_JOB_CANCELLING_EXISTS_SQLITE if _IS_SQLITE else _SQL_JOB_CANCELLING_EXISTS_PG, {"id": project_id}).first() is not None
+
+
+def jobs_finish_cancelling() -> None:
+    """Al arrancar: los jobs en 'cancelling' de un proceso anterior pasan a 'cancelled'."""
+    with write_scope() as c:
+        c.execute(_SQL_JOBS_FINISH_CANCELLING, {"now": _now()})
 
 
 def job_set_cancelled(job_id: str) -> None:
-    now = datetime.utcnow().isoformat() + "Z" if _is_sqlite() else datetime.utcnow()
+    now = _now()
+    _flush_job_logs_best_effort()
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text("UPDATE analysis_jobs SET status = 'cancelled', finished_at = :now, error_message = :err WHERE id = :id"), {"id": job_id, "now": now, "err": "Cancelled by user"})
-        else:
-            s.execute(text("UPDATE analysis_jobs SET status = 'cancelled', finished_at = :now, error_message = :err WHERE id = CAST(:id AS uuid)"), {"id": job_id, "now": now, "err": "Cancelled by user"})
+        s.execute(_SQL_JOB_SET_CANCELLED_SQLITE if _IS_SQLITE else _SQL_JOB_SET_CANCELLED_PG, {"id": job_id, "now": now, "err": "Cancelled by user"})
 
 
 def graph_save(project_id: str, graph: dict) -> None:
-    import json
-    now = datetime.utcnow().isoformat() + "Z" if _is_sqlite() else datetime.utcnow()
+    now = _now()
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text("INSERT INTO graphs (project_id, graph, created_at) VALUES (:pid, :graph, :now)"), {"pid": project_id, "graph": json.dumps(graph), "now": now})
+        if _IS_SQLITE:
+            s.execute(_SQL_GRAPH_INSERT_SQLITE, {"pid": project_id, "graph": json.dumps(graph), "now": now})
         else:
-            s.execute(text("INSERT INTO graphs (project_id, graph, created_at) VALUES (CAST(:pid AS uuid), CAST(:graph AS jsonb), :now)"), {"pid": project_id, "graph": json.dumps(graph), "now": now})
+            s.execute(_SQL_GRAPH_INSERT_PG, {"pid": project_id, "graph": graph, "now": now})
+
+
+def graph_save_raw(project_id: str, raw: bytes) -> None:
+    """Como graph_save pero con el JSON ya serializado: no se construye el grafo en memoria."""
+    now = _now()
+    with session_scope() as s:
+        s.execute(
+            _SQL_GRAPH_INSERT_RAW_SQLITE if _IS_SQLITE else _SQL_GRAPH_INSERT_RAW_PG,
+            {"pid": project_id, "graph": raw.decode("utf-8"), "now": now},
+        )
 
 
 def graph_get_latest(project_id: str) -> dict | None:
-    import json
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            r = s.execute(text("SELECT graph FROM graphs WHERE project_id = :id ORDER BY created_at DESC LIMIT 1"), {"id": project_id})
-        else:
-            r = s.execute(text("SELECT graph FROM graphs WHERE project_id = CAST(:id AS uuid) ORDER BY created_at DESC LIMIT 1"), {"id": project_id})
+        r = s.execute(_SQL_GRAPH_LATEST_SQLITE if _IS_SQLITE else _SQL_GRAPH_LATEST_PG, {"id": project_id})
         row = r.fetchone()
     if not row:
         return None
@@ -680,43 +1294,60 @@ def graph_get_latest(project_id: str) -> dict | None:
     return raw if isinstance(raw, dict) else json.loads(raw)
 
 
+def graph_get_summary(project_id: str) -> dict | None:
+    """Número de nodos y aristas del último grafo, contados en la BD."""
+    with session_scope() as s:
+        row = s.execute(_SQL_GRAPH_SUMMARY_SQLITE if _IS_SQLITE else _SQL_GRAPH_SUMMARY_PG, {"id": project_id}).fetchone()
+    if not row:
+        return None
+    return {"n_nodes": row[0] or 0, "n_edges": row[1] or 0}
+
+
+def graph_get_topology(project_id: str) -> dict | None:
+    """Último grafo reducido a ids de nodos + aristas: { nodes: [{id}], edges: [...] } (sin data/código)."""
+    with session_scope() as s:
+        row = s.execute(_SQL_GRAPH_TOPOLOGY_SQLITE if _IS_SQLITE else _SQL_GRAPH_TOPOLOGY_PG, {"id": project_id}).fetchone()
+    if not row:
+        return None
+    node_ids, edges = row
+    if isinstance(node_ids, str):
+        node_ids = json.loads(node_ids)
+    if isinstance(edges, str):
+        edges = json.loads(edges)
+    return {"nodes": [{"id": nid} for nid in node_ids or [] if nid is not None], "edges": edges or []}
+
+
 def graph_delete_all(project_id: str) -> None:
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text("DELETE FROM graphs WHERE project_id = :id"), {"id": project_id})
-        else:
-            s.execute(text("DELETE FROM graphs WHERE project_id = CAST(:id AS uuid)"), {"id": project_id})
+        s.execute(_SQL_GRAPH_DELETE_ALL_SQLITE if _IS_SQLITE else _SQL_GRAPH_DELETE_ALL_PG, {"id": project_id})
+
+
+_CHECKPOINT_BATCH = 500
 
 
 def checkpoint_save(project_id: str, job_id: str, checkpoint: dict) -> None:
-    import json
-    now = datetime.utcnow().isoformat() + "Z" if _is_sqlite() else datetime.utcnow()
+    checkpoint_save_many(project_id, job_id, [checkpoint])
+
+
+def checkpoint_save_many(project_id: str, job_id: str, checkpoints: list[dict]) -> None:
+    """Inserta varios checkpoints en una transacción; executemany por bloques de _CHECKPOINT_BATCH filas."""
+    if not checkpoints:
+        return
+    now = _now()
+    stmt = _SQL_CHECKPOINT_INSERT_SQLITE if _IS_SQLITE else _SQL_CHECKPOINT_INSERT_PG
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text(
-                "INSERT INTO project_checkpoints (project_id, job_id, checkpoint, created_at) VALUES (:pid, :jid, :chk, :now)"
-            ), {"pid": project_id, "jid": job_id, "chk": json.dumps(checkpoint), "now": now})
-        else:
-            s.execute(text(
-                "INSERT INTO project_checkpoints (project_id, job_id, checkpoint, created_at) VALUES (CAST(:pid AS uuid), CAST(:jid AS uuid), CAST(:chk AS jsonb), :now)"
-            ), {"pid": project_id, "jid": job_id, "chk": json.dumps(checkpoint), "now": now})
+        for start in range(0, len(checkpoints), _CHECKPOINT_BATCH):
+            chunk = checkpoints[start:start + _CHECKPOINT_BATCH]
+            s.execute(stmt, [
+                {"pid": project_id, "jid": job_id, "chk": json.dumps(chk) if _IS_SQLITE else chk, "now": now}
+                for chk in chunk
+            ])
 
 
 def checkpoint_get_latest(project_id: str):
     """Devuelve (job_id, checkpoint_dict) o (None, None) si no hay checkpoint."""
-    import json
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            r = s.execute(text(
-                "SELECT job_id, checkpoint FROM project_checkpoints WHERE project_id = :id ORDER BY created_at DESC LIMIT 1"
-            ), {"id": project_id})
-        else:
-            r = s.execute(text(
-                "SELECT job_id, checkpoint FROM project_checkpoints WHERE project_id = CAST(:id AS uuid) ORDER BY created_at DESC LIMIT 1"
-            ), {"id": project_id})
+        r = s.execute(_SQL_CHECKPOINT_LATEST_SQLITE if _IS_SQLITE else _SQL_CHECKPOINT_LATEST_PG, {"id": project_id})
         row = r.fetchone()
     if not row:
         return None, None
@@ -728,54 +1359,171 @@ def checkpoint_get_latest(project_id: str):
 def checkpoint_clear(project_id: str) -> None:
     """Borra checkpoints del proyecto (al iniciar análisis de cero o al completar)."""
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            s.execute(text("DELETE FROM project_checkpoints WHERE project_id = :id"), {"id": project_id})
-        else:
-            s.execute(text("DELETE FROM project_checkpoints WHERE project_id = CAST(:id AS uuid)"), {"id": project_id})
+        s.execute(_SQL_CHECKPOINT_CLEAR_SQLITE if _IS_SQLITE else _SQL_CHECKPOINT_CLEAR_PG, {"id": project_id})
+
+
+# Notas decodificadas por proyecto: project_id -> (rev, {node_id: tupla}). Un acierto solo cuesta el
+# SELECT rev. Se guardan tuplas y se entregan listas nuevas: mutar lo devuelto (o lo pasado a
+# node_notes_set) no altera el caché sin subir rev.
+_notes_cache = _TTLCache(maxsize=1024, ttl=300.0)
+
+
+def _freeze_notes(notes: dict) -> dict[str, tuple]:
+    return {nid: tuple(lst) for nid, lst in notes.items()}
+
+
+def _thaw_notes(frozen: dict[str, tuple]) -> dict:
+    return {nid: list(t) for nid, t in frozen.items()}
+
+
+def _node_notes_get_pg(c, project_id: str) -> dict:
+    # El driver ya devuelve cada JSONB como list: el dict se arma sin decodificar en Python
+    return dict(c.execute(_SQL_NOTES_ROWS_PG, {"id": project_id}).all())
+
+
+def _node_notes_get_sqlite(c, project_id: str) -> dict:
+    return {nid: _loads_text(raw) for nid, raw in c.execute(_SQL_NOTES_ROWS_SQLITE, {"id": project_id}).all()}
 
 
 def node_notes_get(project_id: str) -> dict:
     """Devuelve { node_id: [note1, note2, ...], ... } para el proyecto."""
-    with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            r = s.execute(text("SELECT notes FROM project_node_notes WHERE project_id = :id"), {"id": project_id})
-        else:
-            r = s.execute(text("SELECT notes FROM project_node_notes WHERE project_id = CAST(:id AS uuid)"), {"id": project_id})
-        row = r.fetchone()
-    if not row:
-        return {}
+    with read_scope() as c:
+        row = c.execute(_SQL_NOTES_REV_SQLITE if _IS_SQLITE else _SQL_NOTES_REV_PG, {"id": project_id}).fetchone()
+        if not row:
+            return {}
+        cached = _notes_cache.get(project_id)
+        if cached is not None and cached[0] == row[0]:
+            return _thaw_notes(cached[1])
+        notes = _node_notes_get_sqlite(c, project_id) if _IS_SQLITE else _node_notes_get_pg(c, project_id)
+    # Si otra escritura entra entre el SELECT rev y el de filas, la rev guardada queda atrás y el
+    # siguiente sondeo vuelve a leer: nunca se sirve un dict más viejo que su rev
+    _notes_cache.set(project_id, (row[0], _freeze_notes(notes)))
+    return notes
+
+
+def node_note_get_for_node(project_id: str, node_id: str) -> list:
+    """Notas de un solo nodo ([] si no tiene): lectura por clave primaria."""
+    with read_scope() as c:
+        row = c.execute(_SQL_NOTES_NODE_SQLITE if _IS_SQLITE else _SQL_NOTES_NODE_PG, {"id": project_id, "node": node_id}).fetchone()
+    return _node_notes_value(row)
+
+
+def _node_notes_value(row) -> list:
+    if not row or row[0] is None:
+        return []
     raw = row[0]
-    return raw if isinstance(raw, dict) else json.loads(raw or "{}")
+    return raw if isinstance(raw, list) else _loads_text(raw)
+
+
+def node_notes_get_many(project_ids: list[str]) -> dict[str, dict]:
+    """Notas de varios proyectos en una sola consulta: { project_id: { node_id: [...] } }. Sin filas = {}."""
+    ids = list(dict.fromkeys(project_ids))
+    if not ids:
+        return {}
+    # En Postgres el CAST acepta UUID en mayúsculas o sin guiones, pero devuelve la forma canónica.
+    # Un id que no es UUID no se consulta (haría fallar todo el lote): sin filas, como en SQLite
+    canon = {pid: pid if _IS_SQLITE else _canonical_uuid(pid) for pid in ids}
+    found: dict[str, dict] = {c: {} for c in canon.values() if c is not None}
+    if found:
+        with read_scope() as c:
+            rows = c.execute(_SQL_NOTES_ROWS_MANY_SQLITE if _IS_SQLITE else _SQL_NOTES_ROWS_MANY_PG, {"ids": list(found)}).all()
+        for pid, nid, raw in rows:
+            found[str(pid)][nid] = raw if isinstance(raw, list) else _loads_text(raw)
+    return {pid: found.get(canon[pid], {}) for pid in ids}
+
+
+def _canonical_uuid(value: str) -> str | None:
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return None
+
+
+_NOTES_BATCH = 500
+
+
+def _node_rows(project_id: str, notes: dict) -> list[dict]:
+    return [
+        {"id": project_id, "node": nid, "notes": _dumps(lst) if _IS_SQLITE else lst}
+        for nid, lst in notes.items()
+    ]
 
 
 def node_notes_set(project_id: str, notes: dict) -> None:
-    """Reemplaza todas las notas del proyecto. notes = { node_id: [note1, ...], ... }."""
-    with session_scope() as s:
-        from sqlalchemy import text
-        payload = json.dumps(notes)
-        if _is_sqlite():
-            s.execute(text("""
-                INSERT INTO project_node_notes (project_id, notes) VALUES (:id, :notes)
-                ON CONFLICT(project_id) DO UPDATE SET notes = :notes
-            """), {"id": project_id, "notes": payload})
+    """Reemplaza todas las notas del proyecto. notes = { node_id: [note1, ...], ... }. Solo escribe los nodos que cambian."""
+    cached = _notes_cache.get(project_id)
+    with write_scope() as s:
+        lock = _SQL_NOTES_LOCK_SQLITE if _IS_SQLITE else _SQL_NOTES_LOCK_PG
+        rev = s.execute(lock, {"id": project_id}).scalar()
+        if rev is None:
+            if not notes:
+                return
+            s.execute(_SQL_NOTES_HEADER_SQLITE if _IS_SQLITE else _SQL_NOTES_HEADER_PG, {"id": project_id})
+            rev = s.execute(lock, {"id": project_id}).scalar()
+        # Con la cabecera bloqueada: se compara con el dict en caché si su rev sigue siendo la de la BD;
+        # si no, con las filas guardadas (que ya incluyen cualquier reemplazo que haya entrado antes)
+        if cached is not None and cached[0] == rev:
+            current = cached[1]
+        elif _IS_SQLITE:
+            current = _freeze_notes(_node_notes_get_sqlite(s, project_id))
         else:
-            s.execute(text("""
-                INSERT INTO project_node_notes (project_id, notes) VALUES (CAST(:id AS uuid), CAST(:notes AS jsonb))
-                ON CONFLICT(project_id) DO UPDATE SET notes = CAST(:notes AS jsonb)
-            """), {"id": project_id, "notes": payload})
+            current = _freeze_notes(_node_notes_get_pg(s, project_id))
+        frozen = _freeze_notes(notes)
+        changed = {nid: list(t) for nid, t in frozen.items() if current.get(nid) != t}
+        removed = [nid for nid in current if nid not in notes]
+        if not changed and not removed:
+            return
+        with _pipeline(s):
+            rows = _node_rows(project_id, changed)
+            for start in range(0, len(rows), _NOTES_BATCH):
+                s.execute(_SQL_NOTES_NODE_UPSERT_SQLITE if _IS_SQLITE else _SQL_NOTES_NODE_UPSERT_PG, rows[start:start + _NOTES_BATCH])
+            for start in range(0, len(removed), _NOTES_BATCH):
+                s.execute(
+                    _SQL_NOTES_NODE_DELETE_SQLITE if _IS_SQLITE else _SQL_NOTES_NODE_DELETE_PG,
+                    {"id": project_id, "nodes": removed[start:start + _NOTES_BATCH]},
+                )
+        rev = s.execute(_SQL_NOTES_BUMP_RET_SQLITE if _IS_SQLITE else _SQL_NOTES_BUMP_RET_PG, {"id": project_id}).scalar()
+    _notes_cache.set(project_id, (rev, frozen))
+
+
+def node_notes_set_many(items: dict[str, dict]) -> None:
+    """Reemplaza las notas de varios proyectos ({ project_id: notes }) en una transacción, executemany por bloques."""
+    if not items:
+        return
+    ids = list(items)
+    rows = [row for pid, notes in items.items() for row in _node_rows(pid, notes)]
+    with write_scope() as s, _pipeline(s):
+        for start in range(0, len(ids), _NOTES_BATCH):
+            s.execute(_SQL_NOTES_DELETE_MANY_SQLITE if _IS_SQLITE else _SQL_NOTES_DELETE_MANY_PG, {"ids": ids[start:start + _NOTES_BATCH]})
+        for start in range(0, len(rows), _NOTES_BATCH):
+            s.execute(_SQL_NOTES_NODE_UPSERT_SQLITE if _IS_SQLITE else _SQL_NOTES_NODE_UPSERT_PG, rows[start:start + _NOTES_BATCH])
+        s.execute(_SQL_NOTES_BUMP_SQLITE if _IS_SQLITE else _SQL_NOTES_BUMP_PG, [{"id": pid} for pid in ids])
+    for pid in ids:
+        _notes_cache.pop(pid)
+
+
+def node_notes_upsert(project_id: str, node_id: str, notes: list) -> None:
+    """Reemplaza las notas de un nodo (lista vacía = quitarlo): solo se escribe la fila de ese nodo.
+    Si la lista guardada ya es la misma (p. ej. pulsar Guardar dos veces) no escribe ni sube rev."""
+    with write_scope() as s:
+        row = s.execute(_SQL_NOTES_NODE_SQLITE if _IS_SQLITE else _SQL_NOTES_NODE_PG, {"id": project_id, "node": node_id}).fetchone()
+        if _node_notes_value(row) == notes:
+            return
+        if notes:
+            s.execute(
+                _SQL_NOTES_NODE_UPSERT_SQLITE if _IS_SQLITE else _SQL_NOTES_NODE_UPSERT_PG,
+                {"id": project_id, "node": node_id, "notes": _dumps(notes) if _IS_SQLITE else notes},
+            )
+        else:
+            s.execute(_SQL_NOTES_NODE_DELETE_SQLITE if _IS_SQLITE else _SQL_NOTES_NODE_DELETE_PG, {"id": project_id, "nodes": [node_id]})
+        s.execute(_SQL_NOTES_BUMP_SQLITE if _IS_SQLITE else _SQL_NOTES_BUMP_PG, {"id": project_id})
+    _notes_cache.pop(project_id)
 
 
 def graph_ui_state_get(project_id: str) -> dict:
     """Estado de la UI del grafo: selected_node_id, path_locked, layout_mode, node_positions."""
-    with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            r = s.execute(text("SELECT state FROM project_graph_ui_state WHERE project_id = :id"), {"id": project_id})
-        else:
-            r = s.execute(text("SELECT state FROM project_graph_ui_state WHERE project_id = CAST(:id AS uuid)"), {"id": project_id})
-        row = r.fetchone()
+    with read_scope() as s:
+        row = s.execute(_SQL_UI_STATE_SELECT_SQLITE if _IS_SQLITE else _SQL_UI_STATE_SELECT_PG, {"id": project_id}).fetchone()
     if not row:
         return {}
     raw = row[0]
@@ -784,27 +1532,13 @@ def graph_ui_state_get(project_id: str) -> dict:
 
 def graph_ui_state_save(project_id: str, state: dict) -> None:
     """Guarda (merge) el estado de la UI del grafo. state puede ser parcial."""
+    patch = {k: v for k, v in state.items() if v is not None}
+    now = _now()
     with session_scope() as s:
-        from sqlalchemy import text
-        if _is_sqlite():
-            r = s.execute(text("SELECT state FROM project_graph_ui_state WHERE project_id = :id"), {"id": project_id})
-        else:
-            r = s.execute(text("SELECT state FROM project_graph_ui_state WHERE project_id = CAST(:id AS uuid)"), {"id": project_id})
-        row = r.fetchone()
-        existing = {}
-        if row:
-            raw = row[0]
-            existing = raw if isinstance(raw, dict) else json.loads(raw or "{}")
-        merged = {**existing, **{k: v for k, v in state.items() if v is not None}}
-        now = datetime.utcnow().isoformat() + "Z"
-        payload = json.dumps(merged)
-        if _is_sqlite():
-            s.execute(text("""
-                INSERT INTO project_graph_ui_state (project_id, state, updated_at) VALUES (:id, :state, :now)
-                ON CONFLICT(project_id) DO UPDATE SET state = :state, updated_at = :now
-            """), {"id": project_id, "state": payload, "now": now})
-        else:
-            s.execute(text("""
-                INSERT INTO project_graph_ui_state (project_id, state, updated_at) VALUES (CAST(:id AS uuid), CAST(:state AS jsonb), CAST(:now AS timestamptz))
-                ON CONFLICT(project_id) DO UPDATE SET state = CAST(:state AS jsonb), updated_at = CAST(:now AS timestamptz)
-            """), {"id": project_id, "state": payload, "now": now})
+        if not _IS_SQLITE:
+            # El merge lo hace Postgres (jsonb ||): sin SELECT previo ni json.dumps + CAST
+            s.execute(_SQL_UI_STATE_MERGE_PG, {"id": project_id, "state": patch, "now": now})
+            return
+        row = s.execute(_SQL_UI_STATE_SELECT_SQLITE, {"id": project_id}).fetchone()
+        existing = json.loads(row[0] or "{}") if row else {}
+        s.execute(_SQL_UI_STATE_UPSERT_SQLITE, {"id": project_id, "state": json.dumps({**existing, **patch}), "now": now})
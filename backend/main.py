@@ -4,13 +4,21 @@ Persistencia en Postgres (anatomydb) y opcionalmente Neo4j.
 """
 
 import asyncio
+import concurrent.futures
+import contextlib
+import functools
 import json
+import logging
+import mmap
 import os
 import re
 import subprocess
 import tempfile
 import threading
 import shutil
+import signal
+import stat
+from collections import OrderedDict, defaultdict, deque
 
 try:
     from dotenv import load_dotenv, dotenv_values
@@ -25,47 +33,91 @@ from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.datastructures import Headers, QueryParams
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, Response
+from starlette.types import ASGIApp, Receive, Scope, Send
 import time
 
+import httpx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import db
 
+_log = logging.getLogger(__name__)
+
 # API key opcional: si BACKEND_API_KEY está definido, todas las rutas /api/* (salvo health y auth/github) lo exigen
 _BACKEND_API_KEY = os.environ.get("BACKEND_API_KEY", "").strip() or None
 # CORS: si FRONTEND_URL está definido, solo ese origen (más localhost); si no, "*"
 _FRONTEND_URL = os.environ.get("FRONTEND_URL", "").strip() or None
 _RATE_LIMIT_PER_MIN = int(os.environ.get("RATE_LIMIT_PER_MIN", "100"))
 _RATE_LIMIT_ANALYZE_PER_MIN = int(os.environ.get("RATE_LIMIT_ANALYZE_PER_MIN", "5"))
-_rate_limit_store: dict[str, list[float]] = {}
-_rate_limit_lock = threading.Lock()
+# Marcas (time.monotonic) por clave, en orden: las caducadas se quitan por la izquierda en O(1).
+# Solo se toca desde el event loop y sin await de por medio: no necesita lock.
+_rate_limit_store: defaultdict[str, deque[float]] = defaultdict(deque)
 _RATE_WINDOW = 60.0  # segundos
 
-# Colas SSE por proyecto: al recibir schema las notificamos para actualizar el front en vivo
-_sse_queues: dict[str, list[asyncio.Queue]] = {}
-_sse_lock = threading.Lock()
 
-# Procesos del analizador en ejecución: job_id -> subprocess.Popen (para poder cancelar)
-_running_analyzer_procs: dict[str, subprocess.Popen] = {}
-_analyzer_procs_lock = threading.Lock()
+class _SSEChannel:
+    """Canal SSE compartido por todos los clientes de un proyecto: último(s) eventos + número de secuencia.
+    El buffer está acotado (se descartan los más antiguos) y un Event despierta a todos a la vez."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.changed = asyncio.Event()
+        self.buffer: deque[tuple[int, str]] = deque(maxlen=16)
+        self.seq = 0
+        self.subscribers = 0
+
+    def publish(self, msg: str) -> None:
+        """Solo desde el loop del canal. Los clientes esperan el Event vigente: se activa y se sustituye."""
+        self.seq += 1
+        self.buffer.append((self.seq, msg))
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+# Canales SSE por proyecto: al recibir schema los notificamos para actualizar el front en vivo.
+# Un solo buffer por proyecto (no una cola por cliente); cada cliente recuerda su última seq.
+_sse_channels: dict[str, _SSEChannel] = {}
+_sse_lock = threading.Lock()
+# Frames SSE constantes: el buffer del canal guarda el frame ya formateado
+_SSE_SCHEMA_RECEIVED = "data: " + json.dumps({"event": "schema_received"}) + "\n\n"
+_SSE_HEARTBEAT = ": heartbeat\n\n"
+
+# Procesos del analizador en ejecución: job_id -> proceso asyncio (para poder cancelar).
+# Sin lock: solo se hacen set/get/pop de una clave (atómicos con el GIL) y cancel_job tolera
+# que una entrada desaparezca entre dos lecturas.
+_running_analyzer_procs: dict[str, asyncio.subprocess.Process] = {}
 # Directorio de checkpoint por job (para leer checkpoint al cancelar)
 _job_checkpoint_dirs: dict[str, str] = {}
 
 
 def _notify_schema_received(project_id: str) -> None:
-    """Avisa a los clientes SSE de este proyecto que se recibió el schema."""
+    """Avisa a los clientes SSE de este proyecto que se recibió el schema (seguro desde cualquier hilo)."""
     with _sse_lock:
-        queues = _sse_queues.get(project_id, [])[:]
-    msg = json.dumps({"event": "schema_received"})
-    for q in queues:
-        try:
-            q.put_nowait(msg)
-        except Exception:
-            pass
+        channel = _sse_channels.get(project_id)
+    if channel is None:
+        return
+    try:
+        # Un callback en el loop (sin corrutina ni Future por aviso)
+        channel.loop.call_soon_threadsafe(channel.publish, _SSE_SCHEMA_RECEIVED)
+    except RuntimeError:
+        # Loop cerrado: el canal ya no tiene quien lo lea
+        with _sse_lock:
+            if _sse_channels.get(project_id) is channel:
+                del _sse_channels[project_id]
 
 # Estado en memoria (schema y fallback si no hay Neo4j)
 _store: dict[str, Any] = {"schema": None, "graph": None}
+# Caché write-through del grafo de Neo4j: _graph_version sube con cada grafo recibido y
+# _graph_version_neo4j indica qué versión de _store["graph"] coincide con lo que hay en Neo4j.
+_graph_version = 0
+_graph_version_neo4j = -1
 
 # Driver Neo4j (sync); None si no está configurado
 _neo4j_driver = None
@@ -83,166 +135,287 @@ def _get_neo4j_driver():
     try:
         from neo4j import GraphDatabase
 
-        _neo4j_driver = GraphDatabase.driver(uri, auth=(user, password))
+        _neo4j_driver = GraphDatabase.driver(
+            uri,
+            auth=(user, password),
+            # NEO4J_POOL_SIZE (NEO4J_POOL se mantiene por compatibilidad)
+            max_connection_pool_size=int(os.environ.get("NEO4J_POOL_SIZE") or os.environ.get("NEO4J_POOL") or "64"),
+            connection_acquisition_timeout=30,
+            max_connection_lifetime=3600,
+            keep_alive=True,
+        )
         _neo4j_driver.verify_connectivity()
         return _neo4j_driver
     except Exception:
         return None
 
 
+# Base de datos Neo4j a usar (env NEO4J_DATABASE; por defecto 'neo4j'), leída una vez al importar
+_NEO4J_DB = os.environ.get("NEO4J_DATABASE", "neo4j").strip() or "neo4j"
+
+
 def _neo4j_database() -> str:
-    """Base de datos Neo4j a usar (env NEO4J_DATABASE; por defecto 'neo4j')."""
-    return os.environ.get("NEO4J_DATABASE", "neo4j").strip() or "neo4j"
+    return _NEO4J_DB
+
+
+# True cuando constraint e índices ya se crearon (o se intentaron) en esta conexión
+_neo4j_constraints_ready = False
+
+
+def _create_neo4j_indexes(driver) -> None:
+    """Unicidad de :AnatomyNode(id): los MERGE/MATCH por id usan el índice en vez de recorrer la etiqueta.
+    Índice sobre degree: los huérfanos (degree 0) se buscan por índice."""
+    with driver.session(database=_neo4j_database()) as session:
+        session.run("CREATE CONSTRAINT anatomy_node_id IF NOT EXISTS FOR (n:AnatomyNode) REQUIRE n.id IS UNIQUE")
+        session.run("CREATE INDEX anatomy_node_degree IF NOT EXISTS FOR (n:AnatomyNode) ON (n.degree)")
+
+
+def _ensure_neo4j_constraints(driver) -> None:
+    """Al arrancar: constraint e índices, y relleno de degree en grafos escritos antes de tenerlo."""
+    global _neo4j_constraints_ready
+    _create_neo4j_indexes(driver)
+    _neo4j_constraints_ready = True
+    with driver.session(database=_neo4j_database()) as session:
+        session.run(
+            "MATCH (n:AnatomyNode) WHERE n.degree IS NULL "
+            "SET n.degree = size([(n)-[:RELATES_TO]-() | 1])"
+        )
+
+
+def _warm_neo4j(driver) -> None:
+    """Primera consulta de lectura al arrancar: deja abierta una conexión del pool (y la tabla de
+    rutas de lectura en clúster) para que la primera petición no pague el handshake Bolt."""
+    from neo4j import READ_ACCESS
+
+    with driver.session(database=_neo4j_database(), default_access_mode=READ_ACCESS) as session:
+        session.run("RETURN 1").consume()
 
 
 def _neo4j_available() -> bool:
     return _get_neo4j_driver() is not None
 
 
-def _clear_neo4j_graph(driver):
-    """Borra todos los nodos AnatomyNode y sus relaciones."""
-    with driver.session(database=_neo4j_database()) as session:
-        session.run("MATCH (n:AnatomyNode) DETACH DELETE n")
+# Escritura por lotes: un UNWIND por bloque de filas en vez de un session.run por nodo/arista.
+# Bloques de ~10k filas: pocos round-trips sin disparar la memoria de la transacción en el servidor.
+_NEO4J_BATCH = max(1, int(os.environ.get("NEO4J_BATCH_SIZE", "").strip() or 10000))
+_CYPHER_MERGE_NODES = """
+UNWIND $rows AS r
+MERGE (n:AnatomyNode {id: r.id})
+SET n.label = r.label, n.kind = r.kind,
+    n.code = r.code, n.orphan = r.orphan,
+    n.pos_x = r.pos_x, n.pos_y = r.pos_y,
+    n.degree = r.degree
+"""
+_CYPHER_MERGE_EDGES = """
+UNWIND $rows AS r
+MATCH (a:AnatomyNode {id: r.src}), (b:AnatomyNode {id: r.tgt})
+MERGE (a)-[:RELATES_TO {relation: r.relation}]->(b)
+"""
 
 
-def _write_graph_to_neo4j(driver, graph: dict) -> None:
-    """Persiste el grafo React Flow en Neo4j. Solo nodos 'reales' (no clusterBg)."""
-    nodes = graph.get("nodes") or []
-    edges = graph.get("edges") or []
+def _neo4j_graph_rows(graph: dict) -> tuple[list[dict], list[dict]]:
+    """Filas para los UNWIND: nodos 'reales' (sin clusterBg) y aristas con origen y destino."""
+    node_rows = []
+    for n in graph.get("nodes") or []:
+        nid = n.get("id") or ""
+        if nid.startswith("cluster-bg-"):
+            continue
+        data = n.get("data") or {}
+        pos = n.get("position") or {}
+        node_rows.append({
+            "id": nid,
+            "label": data.get("label", nid),
+            "kind": data.get("kind", "node"),
+            "code": data.get("code"),
+            "orphan": bool(data.get("orphan")),
+            "pos_x": pos.get("x"),
+            "pos_y": pos.get("y"),
+        })
+    edge_rows = []
+    # degree = relaciones que tendrá cada nodo en Neo4j: aristas distintas (el MERGE las une)
+    # con ambos extremos presentes (el MATCH descarta el resto)
+    node_ids = {r["id"] for r in node_rows}
+    degree: dict[str, int] = {}
+    merged = set()
+    for e in graph.get("edges") or []:
+        src = e.get("source")
+        tgt = e.get("target")
+        if not src or not tgt:
+            continue
+        relation = (e.get("data") or {}).get("relation", "uses")
+        edge_rows.append({"src": src, "tgt": tgt, "relation": relation})
+        key = (src, tgt, relation)
+        if src in node_ids and tgt in node_ids and key not in merged:
+            merged.add(key)
+            degree[src] = degree.get(src, 0) + 1
+            degree[tgt] = degree.get(tgt, 0) + 1
+    for r in node_rows:
+        r["degree"] = degree.get(r["id"], 0)
+    return node_rows, edge_rows
+
+
+def _replace_graph_tx(tx, node_rows: list[dict], edge_rows: list[dict]) -> None:
+    """Borra el grafo anterior y escribe el nuevo dentro de la transacción tx (idempotente ante reintentos)."""
+    tx.run("MATCH (n:AnatomyNode) DETACH DELETE n")
+    for start in range(0, len(node_rows), _NEO4J_BATCH):
+        tx.run(_CYPHER_MERGE_NODES, rows=node_rows[start:start + _NEO4J_BATCH])
+    for start in range(0, len(edge_rows), _NEO4J_BATCH):
+        tx.run(_CYPHER_MERGE_EDGES, rows=edge_rows[start:start + _NEO4J_BATCH])
 
+
+def _write_graph_to_neo4j(driver, graph: dict) -> None:
+    """Reemplaza el grafo en Neo4j por el grafo React Flow dado, en una sola transacción. Solo nodos 'reales' (no clusterBg)."""
+    global _neo4j_constraints_ready
+    if not _neo4j_constraints_ready:
+        # Neo4j no respondía al arrancar: sin el índice de id cada MERGE/MATCH recorrería la etiqueta.
+        # Un solo intento y sin el relleno de degree (el grafo que se escribe ya lo trae); si falla por
+        # algo persistente (ids duplicados, sin permisos de esquema) la escritura sigue igual que antes.
+        _neo4j_constraints_ready = True
+        try:
+            _create_neo4j_indexes(driver)
+        except Exception as e:
+            _log.warning("No se pudieron crear los índices de Neo4j: %s", e)
+    node_rows, edge_rows = _neo4j_graph_rows(graph)
     with driver.session(database=_neo4j_database()) as session:
-        for n in nodes:
-            nid = n.get("id") or ""
-            if nid.startswith("cluster-bg-"):
-                continue
-            data = n.get("data") or {}
-            pos = n.get("position") or {}
-            session.run(
-                """
-                MERGE (n:AnatomyNode {id: $id})
-                SET n.label = $label, n.kind = $kind,
-                    n.code = $code, n.orphan = $orphan,
-                    n.pos_x = $pos_x, n.pos_y = $pos_y
-                """,
-                id=nid,
-                label=data.get("label", nid),
-                kind=data.get("kind", "node"),
-                code=data.get("code"),
-                orphan=bool(data.get("orphan")),
-                pos_x=pos.get("x"),
-                pos_y=pos.get("y"),
-            )
-        for e in edges:
-            src = e.get("source")
-            tgt = e.get("target")
-            if not src or not tgt:
-                continue
-            rel = (e.get("data") or {}).get("relation", "uses")
-            session.run(
-                """
-                MATCH (a:AnatomyNode {id: $from_id}), (b:AnatomyNode {id: $to_id})
-                MERGE (a)-[r:RELATES_TO {relation: $relation}]->(b)
-                """,
-                from_id=src,
-                to_id=tgt,
-                relation=rel,
-            )
+        session.execute_write(_replace_graph_tx, node_rows, edge_rows)
+
+
+# Nodos y aristas en una sola consulta (un round-trip; el servidor materializa ambas listas)
+_CYPHER_READ_GRAPH = """
+CALL {
+    MATCH (n:AnatomyNode)
+    RETURN collect({id: n.id, label: n.label, kind: n.kind, code: n.code, orphan: n.orphan, pos_x: n.pos_x, pos_y: n.pos_y}) AS ns
+}
+CALL {
+    MATCH (a:AnatomyNode)-[r:RELATES_TO]->(b:AnatomyNode)
+    RETURN collect({source: a.id, target: b.id, relation: r.relation}) AS es
+}
+RETURN ns, es
+"""
+
+
+def _read_graph_tx(tx) -> dict | None:
+    rec = tx.run(_CYPHER_READ_GRAPH).single()
+    if rec is None or not rec["ns"]:
+        return None
+    nodes = [
+        {
+            "id": n["id"],
+            "type": "default",
+            "position": {"x": n["pos_x"] or 0, "y": n["pos_y"] or 0},
+            "data": {
+                "label": n["label"] or n["id"],
+                "kind": n["kind"] or "node",
+                **({"code": n["code"]} if n.get("code") else {}),
+                **({"orphan": bool(n["orphan"])} if n.get("orphan") is not None else {}),
+            },
+        }
+        for n in rec["ns"]
+    ]
+    edges = [
+        {
+            "id": f"{e['source']}->{e['target']}",
+            "source": e["source"],
+            "target": e["target"],
+            "data": {"relation": e["relation"] or "uses"},
+        }
+        for e in rec["es"]
+    ]
+    return {"nodes": nodes, "edges": edges}
 
 
 def _read_graph_from_neo4j(driver) -> dict | None:
-    """Lee el grafo desde Neo4j y lo devuelve en formato React Flow."""
-    with driver.session(database=_neo4j_database()) as session:
-        nodes_result = session.run(
-            "MATCH (n:AnatomyNode) RETURN n.id AS id, n.label AS label, n.kind AS kind, n.code AS code, n.orphan AS orphan, n.pos_x AS pos_x, n.pos_y AS pos_y"
-        )
-        nodes = []
-        for rec in nodes_result:
-            nodes.append({
-                "id": rec["id"],
-                "type": "default",
-                "position": {"x": rec["pos_x"] or 0, "y": rec["pos_y"] or 0},
-                "data": {
-                    "label": rec["label"] or rec["id"],
-                    "kind": rec["kind"] or "node",
-                    **({"code": rec["code"]} if rec.get("code") else {}),
-                    **({"orphan": bool(rec["orphan"])} if rec.get("orphan") is not None else {}),
-                },
-            })
-        if not nodes:
-            return None
-        edges_result = session.run(
-            """
-            MATCH (a:AnatomyNode)-[r:RELATES_TO]->(b:AnatomyNode)
-            RETURN a.id AS source, b.id AS target, r.relation AS relation
-            """
-        )
-        edges = []
-        for i, rec in enumerate(edges_result):
-            edges.append({
-                "id": f"{rec['source']}->{rec['target']}",
-                "source": rec["source"],
-                "target": rec["target"],
-                "data": {"relation": rec["relation"] or "uses"},
-            })
-        return {"nodes": nodes, "edges": edges}
+    """Lee el grafo desde Neo4j y lo devuelve en formato React Flow (sesión de lectura; en clúster va a réplicas)."""
+    from neo4j import READ_ACCESS
+
+    with driver.session(database=_neo4j_database(), default_access_mode=READ_ACCESS) as session:
+        return session.execute_read(_read_graph_tx)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     db.init_db()
-    _get_neo4j_driver()
+    # Un job que quedó en 'cancelling' al parar el servidor ya no tiene proceso: se da por cancelado
+    db.jobs_finish_cancelling()
+    driver = _get_neo4j_driver()
+    if driver:
+        try:
+            _ensure_neo4j_constraints(driver)
+            _warm_neo4j(driver)
+        except Exception as e:
+            _log.warning("Preparación de Neo4j al arrancar incompleta: %s", e)
     yield
-    global _neo4j_driver
+    db.stop_log_writer()
+    await db.dispose_async_engine()
+    await _close_github_client()
+    global _neo4j_driver, _graph_version_neo4j, _neo4j_constraints_ready
     if _neo4j_driver:
         _neo4j_driver.close()
         _neo4j_driver = None
+    _neo4j_constraints_ready = False
     _store["schema"] = None
     _store["graph"] = None
+    _graph_version_neo4j = -1
 
 
 app = FastAPI(title="ProjectAnatomy API", lifespan=lifespan)
 
 
-class APIKeyMiddleware(BaseHTTPMiddleware):
+# Middlewares ASGI puros (sin BaseHTTPMiddleware): no abren un task group por petición ni
+# envuelven el cuerpo de la respuesta, así el stream SSE de /events llega sin buffer intermedio.
+class APIKeyMiddleware:
     """Si BACKEND_API_KEY está definido, exige X-API-Key en /api/* salvo health y auth/github.
     Para GET /api/projects/{id}/events (SSE), también se acepta api_key por query (EventSource no permite headers)."""
 
-    async def dispatch(self, request: Request, call_next):
-        path = request.url.path
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not _BACKEND_API_KEY:
+            return await self.app(scope, receive, send)
+        path = scope["path"]
         if path == "/api/health" or path.startswith("/api/auth/github") or path == "/api/webhooks/github":
-            return await call_next(request)
-        if not _BACKEND_API_KEY:
-            return await call_next(request)
-        key = request.headers.get("X-API-Key", "").strip()
-        if not key and request.method == "GET" and "/events" in path and path.startswith("/api/projects/") and path.endswith("/events"):
-            key = (request.query_params.get("api_key") or "").strip()
+            return await self.app(scope, receive, send)
+        key = Headers(scope=scope).get("x-api-key", "").strip()
+        if not key and scope["method"] == "GET" and path.startswith("/api/projects/") and path.endswith("/events"):
+            key = (QueryParams(scope["query_string"]).get("api_key") or "").strip()
         if key != _BACKEND_API_KEY:
-            return JSONResponse(status_code=401, content={"detail": "Invalid or missing X-API-Key"})
-        return await call_next(request)
+            response = JSONResponse(status_code=401, content={"detail": "Invalid or missing X-API-Key"})
+            return await response(scope, receive, send)
+        await self.app(scope, receive, send)
 
 
-class RateLimitMiddleware(BaseHTTPMiddleware):
+class RateLimitMiddleware:
     """Límite de peticiones por IP: general y más estricto para POST .../analyze."""
 
-    async def dispatch(self, request: Request, call_next):
-        path = request.url.path
-        client = request.client.host if request.client else "unknown"
-        if request.headers.get("x-forwarded-for"):
-            client = request.headers["x-forwarded-for"].split(",")[0].strip()
-        now = time.time()
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        client = scope["client"][0] if scope.get("client") else "unknown"
+        forwarded = Headers(scope=scope).get("x-forwarded-for")
+        if forwarded:
+            client = forwarded.split(",")[0].strip()
+        now = time.monotonic()
         is_analyze = path.endswith("/analyze") or path.endswith("/analyze/resume")
-        limit = _RATE_LIMIT_ANALYZE_PER_MIN if (is_analyze and request.method == "POST") else _RATE_LIMIT_PER_MIN
+        limit = _RATE_LIMIT_ANALYZE_PER_MIN if (is_analyze and scope["method"] == "POST") else _RATE_LIMIT_PER_MIN
         key = f"{client}:analyze" if is_analyze else f"{client}:general"
-        with _rate_limit_lock:
-            if key not in _rate_limit_store:
-                _rate_limit_store[key] = []
-            times = _rate_limit_store[key]
-            times[:] = [t for t in times if now - t < _RATE_WINDOW]
-            if len(times) >= limit:
-                return JSONResponse(status_code=429, content={"detail": "Rate limit exceeded. Try again later."})
-            times.append(now)
-        return await call_next(request)
+        times = _rate_limit_store[key]
+        while times and now - times[0] >= _RATE_WINDOW:
+            times.popleft()
+        if len(times) >= limit:
+            response = JSONResponse(status_code=429, content={"detail": "Rate limit exceeded. Try again later."})
+            return await response(scope, receive, send)
+        times.append(now)
+        await self.app(scope, receive, send)
+
 
+# Cabecera que marca un listado de GitHub cortado en _GITHUB_MAX_PAGES páginas (expuesta por CORS
+# para que la UI pueda avisar)
+_GITHUB_TRUNCATED_HEADER = "X-GitHub-Truncated"
 
 _origins = ["*"]
 if _FRONTEND_URL:
@@ -260,6 +433,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[_GITHUB_TRUNCATED_HEADER],
 )
 
 
@@ -313,39 +487,53 @@ PROJECT_TYPE_CHOICES = [
 
 
 @app.post("/api/graph")
-def post_graph(payload: GraphPayload):
+async def post_graph(payload: GraphPayload):
     """Recibe esquema y/o grafo (React Flow) y los guarda. Si Neo4j está configurado, persiste el grafo ahí."""
     if payload.schema_data is not None:
         _store["schema"] = payload.schema_data
+    if payload.graph is not None and (not isinstance(payload.graph, dict) or "nodes" not in payload.graph):
+        raise HTTPException(400, "graph must have 'nodes' (and optionally 'edges')")
+    # Conectar y escribir en Neo4j bloquea: en un hilo, para no frenar el resto de peticiones
+    global _graph_version, _graph_version_neo4j
+    driver = await asyncio.to_thread(_get_neo4j_driver)
     if payload.graph is not None:
-        if not isinstance(payload.graph, dict) or "nodes" not in payload.graph:
-            raise HTTPException(400, "graph must have 'nodes' (and optionally 'edges')")
+        _graph_version += 1
+        version = _graph_version
         _store["graph"] = payload.graph
-        driver = _get_neo4j_driver()
         if driver:
             try:
-                _clear_neo4j_graph(driver)
-                _write_graph_to_neo4j(driver, payload.graph)
+                await asyncio.to_thread(_write_graph_to_neo4j, driver, payload.graph)
             except Exception as e:
                 raise HTTPException(502, f"Neo4j write failed: {e}")
+            if _graph_version == version:
+                _graph_version_neo4j = version
     return {
         "ok": True,
         "has_schema": _store["schema"] is not None,
         "has_graph": _store["graph"] is not None,
-        "neo4j": _neo4j_available(),
+        "neo4j": driver is not None,
     }
 
 
 @app.get("/api/graph")
-def get_graph():
-    """Devuelve esquema y grafo. Si Neo4j está configurado, el grafo se lee desde Neo4j."""
+async def get_graph():
+    """Devuelve esquema y grafo. Si Neo4j está configurado, el grafo se lee desde Neo4j
+    (salvo que la copia en memoria ya sea la última escrita/leída allí)."""
+    global _graph_version_neo4j
     graph = _store["graph"]
-    driver = _get_neo4j_driver()
+    if graph is not None and _graph_version_neo4j == _graph_version:
+        return {"schema": _store["schema"], "graph": graph}
+    driver = await asyncio.to_thread(_get_neo4j_driver)
     if driver:
+        version = _graph_version
         try:
-            from_neo4j = _read_graph_from_neo4j(driver)
+            from_neo4j = await asyncio.to_thread(_read_graph_from_neo4j, driver)
             if from_neo4j is not None:
                 graph = from_neo4j
+                # Solo se cachea si no llegó otro grafo mientras se leía
+                if _graph_version == version:
+                    _store["graph"] = from_neo4j
+                    _graph_version_neo4j = version
         except Exception:
             pass
     return {
@@ -354,23 +542,40 @@ def get_graph():
     }
 
 
+# Resultado del último chequeo de Neo4j: (instante monotónico, ok); se reutiliza durante el TTL
+_NEO4J_HEALTH_TTL = 5.0
+_neo4j_health_cache: tuple[float, bool] | None = None
+
+
+def _probe_neo4j() -> bool:
+    driver = _get_neo4j_driver()
+    if not driver:
+        return False
+    try:
+        driver.verify_connectivity()
+        return True
+    except Exception:
+        return False
+
+
 @app.get("/api/health")
-def health():
-    neo4j_ok = False
-    if _get_neo4j_driver():
-        try:
-            _get_neo4j_driver().verify_connectivity()
-            neo4j_ok = True
-        except Exception:
-            pass
+async def health():
+    global _neo4j_health_cache
+    cached = _neo4j_health_cache
+    if cached is not None and time.monotonic() - cached[0] < _NEO4J_HEALTH_TTL:
+        neo4j_ok = cached[1]
+    else:
+        # El chequeo bloquea (red): fuera del loop
+        neo4j_ok = await asyncio.to_thread(_probe_neo4j)
+        _neo4j_health_cache = (time.monotonic(), neo4j_ok)
     return {"status": "ok", "neo4j": neo4j_ok}
 
 
 # --- Proyectos (Postgres) ---
 
 @app.get("/api/projects")
-def list_projects():
-    return db.project_list()
+async def list_projects():
+    return await db.project_list_async()
 
 
 @app.post("/api/projects")
@@ -385,8 +590,8 @@ def create_project(payload: ProjectCreate):
 
 
 @app.get("/api/projects/{project_id}")
-def get_project(project_id: str):
-    proj = db.project_get(project_id)
+async def get_project(project_id: str):
+    proj = await db.project_get_async(project_id)
     if not proj:
         raise HTTPException(404, "Project not found")
     return proj
@@ -395,27 +600,34 @@ def get_project(project_id: str):
 @app.get("/api/projects/{project_id}/events")
 async def project_events(project_id: str):
     """SSE: notifica en vivo cuando el agente envía el schema (schema_received)."""
-    if db.project_get(project_id) is None:
+    if await db.project_get_async(project_id) is None:
         raise HTTPException(404, "Project not found")
-    queue: asyncio.Queue = asyncio.Queue()
     with _sse_lock:
-        _sse_queues.setdefault(project_id, []).append(queue)
+        channel = _sse_channels.get(project_id)
+        if channel is None:
+            channel = _sse_channels[project_id] = _SSEChannel(asyncio.get_running_loop())
+        channel.subscribers += 1
 
     async def stream():
+        last_seen = channel.seq
         try:
             while True:
-                try:
-                    event = await asyncio.wait_for(queue.get(), timeout=15.0)
-                    yield f"data: {event}\n\n"
-                except asyncio.TimeoutError:
-                    yield ": heartbeat\n\n"
+                if channel.seq == last_seen:
+                    try:
+                        await asyncio.wait_for(channel.changed.wait(), timeout=15.0)
+                    except asyncio.TimeoutError:
+                        yield _SSE_HEARTBEAT
+                        continue
+                # Cada cliente lee el buffer compartido a su ritmo: uno lento no frena a los demás
+                events = [msg for seq, msg in channel.buffer if seq > last_seen]
+                last_seen = channel.seq
+                for frame in events:
+                    yield frame
         finally:
             with _sse_lock:
-                if project_id in _sse_queues:
-                    try:
-                        _sse_queues[project_id].remove(queue)
-                    except ValueError:
-                        pass
+                channel.subscribers -= 1
+                if channel.subscribers <= 0 and _sse_channels.get(project_id) is channel:
+                    del _sse_channels[project_id]
 
     return StreamingResponse(
         stream(),
@@ -454,6 +666,58 @@ def delete_project(project_id: str):
 
 # --- GitHub OAuth (por proyecto: cada proyecto vincula su cuenta GitHub) ---
 
+try:
+    import h2  # noqa: F401 (httpx solo habilita HTTP/2 si está instalado)
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+# Cliente HTTP compartido para GitHub (API y OAuth): keep-alive entre llamadas en vez de un
+# socket + handshake TLS nuevo por petición. Se cierra en el lifespan.
+_github_client: httpx.Client | None = None
+_github_client_lock = threading.Lock()
+
+
+def _get_github_client() -> httpx.Client:
+    global _github_client
+    with _github_client_lock:
+        if _github_client is None:
+            _github_client = httpx.Client(
+                http2=_HTTP2,
+                timeout=15,
+                headers={"Accept": "application/vnd.github.v3+json"},
+            )
+        return _github_client
+
+
+# Versión async para la API (listados paginados en paralelo); vive en el loop de la app.
+_github_async_client: httpx.AsyncClient | None = None
+# Tope de páginas de 100 que se piden de una vez (repos/ramas)
+_GITHUB_MAX_PAGES = 20
+
+
+def _get_github_async_client() -> httpx.AsyncClient:
+    global _github_async_client
+    if _github_async_client is None:
+        _github_async_client = httpx.AsyncClient(
+            http2=_HTTP2,
+            timeout=15,
+            headers={"Accept": "application/vnd.github.v3+json"},
+        )
+    return _github_async_client
+
+
+async def _close_github_client() -> None:
+    global _github_client, _github_async_client
+    with _github_client_lock:
+        client, _github_client = _github_client, None
+    if client is not None:
+        client.close()
+    async_client, _github_async_client = _github_async_client, None
+    if async_client is not None:
+        await async_client.aclose()
+
+
 def _github_oauth_config():
     client_id = os.environ.get("GITHUB_CLIENT_ID", "").strip()
     client_secret = os.environ.get("GITHUB_CLIENT_SECRET", "").strip()
@@ -500,23 +764,20 @@ def github_callback(code: str | None = None, state: str | None = None, error: st
     client_id, client_secret, redirect_uri, _fe = _github_oauth_config()
     if not client_id or not client_secret or not redirect_uri:
         return RedirectResponse(url=f"{frontend_url}?github_error=oauth_not_configured", status_code=302)
-    import urllib.request
-    import urllib.parse
-    data = urllib.parse.urlencode({
+    data = {
         "client_id": client_id,
         "client_secret": client_secret,
         "code": code,
         "redirect_uri": redirect_uri,
-    }).encode()
-    req = urllib.request.Request(
-        "https://github.com/login/oauth/access_token",
-        data=data,
-        headers={"Accept": "application/json", "Content-Type": "application/x-www-form-urlencoded"},
-        method="POST",
-    )
+    }
     try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            body = json.loads(resp.read().decode())
+        resp = _get_github_client().post(
+            "https://github.com/login/oauth/access_token",
+            data=data,
+            headers={"Accept": "application/json"},
+        )
+        resp.raise_for_status()
+        body = resp.json()
     except Exception as e:
         return RedirectResponse(url=f"{frontend_url}?github_error=token_exchange_failed", status_code=302)
     access_token = body.get("access_token")
@@ -557,40 +818,69 @@ def github_pull(project_id: str):
         raise HTTPException(500, str(e))
 
 
-def _github_api_get(project_id: str, path: str) -> list | dict:
-    """Llama a la API de GitHub con el token del proyecto. path sin barra inicial (ej. user/repos)."""
-    token = db.project_get_github_token(project_id)
+def _github_response_json(resp: httpx.Response) -> list | dict:
+    """Cuerpo JSON de una respuesta de la API de GitHub; los errores se traducen a HTTPException."""
+    if resp.status_code >= 400:
+        body = resp.text
+        try:
+            msg = resp.json().get("message", body) or body
+        except Exception:
+            msg = body
+        if resp.status_code == 401:
+            raise HTTPException(401, "GitHub token expired or revoked. Disconnect and connect again.")
+        raise HTTPException(resp.status_code, msg or "GitHub API error")
+    try:
+        return resp.json()
+    except ValueError as e:
+        raise HTTPException(502, str(e))
+
+
+async def _github_api_get_all(project_id: str, path: str) -> tuple[list, bool]:
+    """GET paginado a la API de GitHub con el token del proyecto: la primera página da el rel="last"
+    del header Link y el resto se pide en paralelo. path sin barra inicial (ej. user/repos?per_page=100).
+    Devuelve (elementos, truncado): truncado si había más de _GITHUB_MAX_PAGES páginas."""
+    token = await asyncio.to_thread(db.project_get_github_token, project_id)
     if not token:
         raise HTTPException(400, "Connect GitHub first (no token for this project)")
-    import urllib.request
-    import urllib.error
-    url = f"https://api.github.com/{path}"
-    req = urllib.request.Request(url, headers={"Authorization": f"Bearer {token}", "Accept": "application/vnd.github.v3+json"})
+    client = _get_github_async_client()
+    headers = {"Authorization": f"Bearer {token}"}
     try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            return json.loads(resp.read().decode())
-    except urllib.error.HTTPError as e:
-        body = e.read().decode() if e.fp else ""
+        first = await client.get(f"https://api.github.com/{path}", headers=headers)
+        data = _github_response_json(first)
+        if not isinstance(data, list):
+            return [], False
+        last_url = (first.links.get("last") or {}).get("url")
+        if not last_url:
+            return data, False
+        last = httpx.URL(last_url)
         try:
-            err = json.loads(body)
-            msg = err.get("message", body) or str(e)
-        except Exception:
-            msg = body or str(e)
-        if e.code == 401:
-            raise HTTPException(401, "GitHub token expired or revoked. Disconnect and connect again.")
-        raise HTTPException(e.code, msg or "GitHub API error")
-    except Exception as e:
+            total_pages = int(last.params.get("page", "1"))
+        except ValueError:
+            return data, False
+        last_page = min(total_pages, _GITHUB_MAX_PAGES)
+        truncated = total_pages > _GITHUB_MAX_PAGES
+        if truncated:
+            _log.warning("GitHub %s: %d páginas, solo se leen %d", path.split("?", 1)[0], total_pages, _GITHUB_MAX_PAGES)
+        pages = await asyncio.gather(
+            *(client.get(last.copy_set_param("page", p), headers=headers) for p in range(2, last_page + 1))
+        )
+    except httpx.HTTPError as e:
         raise HTTPException(502, str(e))
+    for resp in pages:
+        page = _github_response_json(resp)
+        if isinstance(page, list):
+            data.extend(page)
+    return data, truncated
 
 
 @app.get("/api/projects/{project_id}/github/repos")
-def github_list_repos(project_id: str):
+async def github_list_repos(project_id: str, response: Response):
     """Lista los repos del usuario conectado (requiere haber conectado GitHub en este proyecto)."""
-    if db.project_get(project_id) is None:
+    if await db.project_get_async(project_id) is None:
         raise HTTPException(404, "Project not found")
-    data = _github_api_get(project_id, "user/repos?per_page=100&sort=updated")
-    if not isinstance(data, list):
-        return []
+    data, truncated = await _github_api_get_all(project_id, "user/repos?per_page=100&sort=updated")
+    if truncated:
+        response.headers[_GITHUB_TRUNCATED_HEADER] = "1"
     return [
         {"full_name": r.get("full_name"), "name": r.get("name"), "private": bool(r.get("private")), "default_branch": r.get("default_branch") or "main"}
         for r in data
@@ -599,13 +889,13 @@ def github_list_repos(project_id: str):
 
 
 @app.get("/api/projects/{project_id}/github/repos/{owner}/{repo}/branches")
-def github_list_branches(project_id: str, owner: str, repo: str):
+async def github_list_branches(project_id: str, owner: str, repo: str, response: Response):
     """Lista las ramas de un repo (owner/repo). Requiere GitHub conectado."""
-    if db.project_get(project_id) is None:
+    if await db.project_get_async(project_id) is None:
         raise HTTPException(404, "Project not found")
-    data = _github_api_get(project_id, f"repos/{owner}/{repo}/branches?per_page=100")
-    if not isinstance(data, list):
-        return []
+    data, truncated = await _github_api_get_all(project_id, f"repos/{owner}/{repo}/branches?per_page=100")
+    if truncated:
+        response.headers[_GITHUB_TRUNCATED_HEADER] = "1"
     return [{"name": b.get("name")} for b in data if b.get("name")]
 
 
@@ -631,13 +921,7 @@ def _trigger_analyze_after_webhook(project_id: str) -> None:
             return
         checkpoint_dir = tempfile.mkdtemp(prefix="anatomy_webhook_")
         pt = (proj.get("project_type") or "").strip() or None
-        thread = threading.Thread(
-            target=_run_analyzer,
-            args=(job_id, project_id, codebase_path, schema),
-            kwargs={"excluded_paths": excluded_paths or None, "checkpoint_dir": checkpoint_dir, "resume": False, "project_type": pt},
-        )
-        thread.daemon = True
-        thread.start()
+        _start_analyzer(job_id, project_id, codebase_path, schema, excluded_paths=excluded_paths or None, checkpoint_dir=checkpoint_dir, resume=False, project_type=pt)
     except Exception:
         pass
 
@@ -693,6 +977,11 @@ def project_webhook_info(project_id: str, request: Request):
     }
 
 
+# owner/repo abreviado (sin esquema) y caracteres no válidos en el nombre de la carpeta del clon
+_SHORT_REPO_RE = re.compile(r"^[a-zA-Z0-9_.-]+/[a-zA-Z0-9_.-]+$")
+_UNSAFE_NAME_RE = re.compile(r"[^\w.-]")
+
+
 # Directorio donde se clonan repos de GitHub (env REPOS_DIR; por defecto ./repos junto al backend)
 def _repos_dir() -> str:
     d = os.environ.get("REPOS_DIR", "").strip()
@@ -705,7 +994,7 @@ def _repos_dir() -> str:
 def _repo_clone_path(project_id: str) -> str:
     """Ruta donde se clona el repo de un proyecto (para borrarla al eliminar el proyecto)."""
     base = _repos_dir()
-    clone_name = re.sub(r"[^\w.-]", "_", project_id) or "repo"
+    clone_name = _UNSAFE_NAME_RE.sub("_", project_id) or "repo"
     return os.path.join(base, clone_name)
 
 
@@ -747,6 +1036,30 @@ def _inject_github_token(url: str, token: str | None = None) -> str:
     return url.replace("https://", f"https://{t}@", 1)
 
 
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+
+def _pygit2_callbacks(token: str | None):
+    """Credenciales para libgit2: el token va en el callback y no queda guardado en .git/config."""
+    t = (token or "").strip() or os.environ.get("GITHUB_TOKEN", "").strip()
+    if not t:
+        return None
+    return pygit2.RemoteCallbacks(credentials=pygit2.UserPass("x-access-token", t))
+
+
+def _pygit2_fetch_checkout(clone_path: str, branch: str, callbacks) -> None:
+    """Equivalente a git fetch origin <branch> --depth=1 + git checkout origin/<branch> (en proceso)."""
+    repo = pygit2.Repository(clone_path)
+    ref = f"refs/remotes/origin/{branch}"
+    repo.remotes["origin"].fetch([f"+refs/heads/{branch}:{ref}"], callbacks=callbacks, depth=1)
+    commit = repo.revparse_single(ref)
+    repo.checkout_tree(commit, strategy=pygit2.GIT_CHECKOUT_FORCE)
+    repo.set_head(commit.id)
+
+
 def _clone_or_pull_repo(project_id: str, repo_url: str, branch: str, job_id: str) -> str:
     """Clona el repo (o hace pull si ya existe) y devuelve la ruta absoluta al directorio del repo.
     Escribe mensajes en el log del job si se pasa job_id.
@@ -760,7 +1073,7 @@ def _clone_or_pull_repo(project_id: str, repo_url: str, branch: str, job_id: str
     if not repo_url:
         raise ValueError("repo_url is required")
     # Normalizar URL (aceptar github.com/user/repo con o sin .git)
-    if re.match(r"^[a-zA-Z0-9_.-]+/[a-zA-Z0-9_.-]+$", repo_url):
+    if _SHORT_REPO_RE.match(repo_url):
         repo_url = f"https://github.com/{repo_url}"
     if not repo_url.endswith(".git"):
         repo_url = repo_url.rstrip("/") + ".git"
@@ -769,23 +1082,29 @@ def _clone_or_pull_repo(project_id: str, repo_url: str, branch: str, job_id: str
     url_with_auth = _inject_github_token(repo_url, project_token)
     base = _repos_dir()
     clone_path = _repo_clone_path(project_id)
+    # Con pygit2 (libgit2) clone/fetch van en proceso: sin fork+exec de git por operación
+    callbacks = _pygit2_callbacks(project_token) if pygit2 is not None else None
     if os.path.isdir(os.path.join(clone_path, ".git")):
         log(f"      Actualizando repo en {clone_path}…")
         try:
-            subprocess.run(
-                ["git", "fetch", "origin", branch, "--depth=1"],
-                cwd=clone_path,
-                capture_output=True,
-                text=True,
-                timeout=120,
-            )
-            subprocess.run(
-                ["git", "checkout", "-q", "origin/" + branch],
-                cwd=clone_path,
-                capture_output=True,
-                text=True,
-                timeout=30,
-            )
+            if pygit2 is not None:
+                _pygit2_fetch_checkout(clone_path, branch, callbacks)
+            else:
+                # Partial clone (blob:none): el checkout trae solo los blobs del commit que se usa
+                subprocess.run(
+                    ["git", "fetch", "--depth=1", "--filter=blob:none", "--no-tags", "origin", branch],
+                    cwd=clone_path,
+                    capture_output=True,
+                    text=True,
+                    timeout=120,
+                )
+                subprocess.run(
+                    ["git", "checkout", "-q", "origin/" + branch],
+                    cwd=clone_path,
+                    capture_output=True,
+                    text=True,
+                    timeout=120,
+                )
         except Exception as e:
             log(f"      git pull failed: {e}, usando copia existente.")
     else:
@@ -796,15 +1115,24 @@ def _clone_or_pull_repo(project_id: str, repo_url: str, branch: str, job_id: str
             except Exception:
                 pass
         os.makedirs(base, exist_ok=True)
-        result = subprocess.run(
-            ["git", "clone", "--depth", "1", "--branch", branch, url_with_auth, clone_path],
-            capture_output=True,
-            text=True,
-            timeout=300,
-        )
-        if result.returncode != 0:
-            err = (result.stderr or result.stdout or "").strip()
-            raise RuntimeError(f"git clone failed: {err}")
+        if pygit2 is not None:
+            try:
+                pygit2.clone_repository(repo_url, clone_path, checkout_branch=branch, callbacks=callbacks, depth=1)
+            except pygit2.GitError as e:
+                raise RuntimeError(f"git clone failed: {e}")
+        else:
+            result = subprocess.run(
+                [
+                    "git", "clone", "--depth", "1", "--filter=blob:none", "--no-tags", "--single-branch",
+                    "--branch", branch, url_with_auth, clone_path,
+                ],
+                capture_output=True,
+                text=True,
+                timeout=300,
+            )
+            if result.returncode != 0:
+                err = (result.stderr or result.stdout or "").strip()
+                raise RuntimeError(f"git clone failed: {err}")
     if not os.path.isdir(clone_path):
         raise RuntimeError("Clone path does not exist after clone")
     return os.path.abspath(clone_path)
@@ -841,39 +1169,105 @@ def _skip_folder(name: str) -> bool:
     return name in EXCLUDED_FOLDERS
 
 
+def _scan_sorted(path: str) -> list | None:
+    """Entradas de un directorio ordenadas por nombre; None si no se puede leer."""
+    try:
+        # scandir trae el tipo de cada entrada: sin un stat extra por archivo
+        with os.scandir(path) as it:
+            return sorted(it, key=lambda e: e.name)
+    except OSError:
+        return None
+
+
 def _build_tree(path: str, base: str, relative: str, max_depth: int, max_nodes: list) -> dict | None:
     """Construye un nodo de árbol: { name, path, type, children? }. path en relativo con /."""
     if max_nodes[0] <= 0 or max_depth <= 0:
         return None
-    try:
-        names = sorted(os.listdir(path))
-    except OSError:
+    entries = _scan_sorted(path)
+    if entries is None:
         return None
     rel = relative.replace("\\", "/") or "."
     name = os.path.basename(path) if path != base else (rel if rel != "." else ".")
     if name == ".":
         name = os.path.basename(base.rstrip(os.sep)) or "root"
-    node = {"name": name, "path": rel, "type": "dir", "children": []}
-    for n in names:
-        if _skip_folder(n):
-            continue
-        if max_nodes[0] <= 0:
+    root = {"name": name, "path": rel, "type": "dir", "children": []}
+    # Recorrido en profundidad con pila explícita (sin límite de recursión); cada marco guarda
+    # su iterador para retomar los hermanos tras terminar un subdirectorio.
+    stack = [(root, iter(entries), rel, max_depth)]
+    while stack:
+        node, it, rel, depth = stack[-1]
+        descended = False
+        for entry in it:
+            n = entry.name
+            if _skip_folder(n):
+                continue
+            if max_nodes[0] <= 0:
+                break
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            child_rel = (rel + "/" + n) if rel != "." else n
+            if not is_dir:
+                max_nodes[0] -= 1
+                node["children"].append({"name": n, "path": child_rel, "type": "file"})
+                continue
+            if depth <= 1:
+                continue
+            sub = _scan_sorted(entry.path)
+            if sub is None:
+                continue
+            child = {"name": n, "path": child_rel, "type": "dir", "children": []}
+            stack.append((child, iter(sub), child_rel, depth - 1))
+            descended = True
             break
-        full = os.path.join(path, n)
-        try:
-            is_dir = os.path.isdir(full)
-        except OSError:
+        if descended:
             continue
-        child_rel = (rel + "/" + n) if rel != "." else n
-        if is_dir:
-            child = _build_tree(full, base, child_rel, max_depth - 1, max_nodes)
-            if child:
-                node["children"].append(child)
-                max_nodes[0] -= 1
-        else:
+        stack.pop()
+        # El directorio cuenta para el presupuesto al cerrarse, como en el recorrido recursivo
+        if stack:
+            stack[-1][0]["children"].append(node)
             max_nodes[0] -= 1
-            node["children"].append({"name": n, "path": child_rel, "type": "file"})
-    return node
+    return root
+
+
+# Árboles ya construidos: clave (proyecto, ruta, límites, mtime_ns de la raíz) -> (expira, root).
+# El mtime de la raíz solo cambia con sus hijos directos; el TTL corto cubre cambios más profundos.
+_TREE_CACHE_MAX = 32
+_TREE_CACHE_TTL = 30.0
+_tree_cache: OrderedDict[tuple, tuple[float, dict]] = OrderedDict()
+_tree_cache_lock = threading.Lock()
+
+
+def _tree_cache_key(project_id: str, path: str, max_depth: int, max_nodes: int) -> tuple | None:
+    """Clave del árbol de path (un solo os.stat); None si path no es un directorio accesible."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode):
+        return None
+    return (project_id, path, max_depth, max_nodes, st.st_mtime_ns)
+
+
+def _tree_cache_get(key: tuple) -> dict | None:
+    with _tree_cache_lock:
+        item = _tree_cache.get(key)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del _tree_cache[key]
+            return None
+        _tree_cache.move_to_end(key)
+        return item[1]
+
+
+def _tree_cache_set(key: tuple, root: dict) -> None:
+    with _tree_cache_lock:
+        _tree_cache[key] = (time.monotonic() + _TREE_CACHE_TTL, root)
+        _tree_cache.move_to_end(key)
+        while len(_tree_cache) > _TREE_CACHE_MAX:
+            _tree_cache.popitem(last=False)
 
 
 def _browse_root() -> str:
@@ -899,15 +1293,15 @@ def browse_folders(path: str = ""):
         raise HTTPException(400, "Not a directory or not accessible")
     entries = []
     try:
-        for name in sorted(os.listdir(current)):
-            if _skip_folder(name):
-                continue
-            full = os.path.join(current, name)
-            try:
-                if os.path.isdir(full):
-                    entries.append({"name": name, "path": full})
-            except OSError:
-                continue
+        with os.scandir(current) as it:
+            for entry in sorted(it, key=lambda e: e.name):
+                if _skip_folder(entry.name):
+                    continue
+                try:
+                    if entry.is_dir():
+                        entries.append({"name": entry.name, "path": entry.path})
+                except OSError:
+                    continue
     except OSError as e:
         raise HTTPException(400, str(e))
     parent = None
@@ -924,22 +1318,35 @@ def get_project_tree(project_id: str, max_depth: int = 12, max_nodes: int = 2500
     proj = db.project_get(project_id)
     if not proj:
         raise HTTPException(404, "Project not found")
+    excluded_paths = proj.get("excluded_paths") or []
+    # Repo ya clonado: se mira la caché antes de resolver la ruta, que haría fetch + checkout
+    if (proj.get("repo_url") or "").strip():
+        clone_path = os.path.abspath(_repo_clone_path(proj["id"]))
+        if os.path.isdir(os.path.join(clone_path, ".git")):
+            cache_key = _tree_cache_key(project_id, clone_path, max_depth, max_nodes)
+            root = _tree_cache_get(cache_key) if cache_key else None
+            if root is not None:
+                return {"root": root, "excluded_paths": excluded_paths}
     try:
         codebase_path = _resolve_codebase_path(proj, "")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(400, str(e))
-    if not os.path.isdir(codebase_path):
+    cache_key = _tree_cache_key(project_id, codebase_path, max_depth, max_nodes)
+    if cache_key is None:
         raise HTTPException(400, "codebase_path is not a directory or not accessible")
-    root_name = os.path.basename(codebase_path.rstrip(os.sep)) or "root"
-    counter = [max_nodes]
-    root = _build_tree(codebase_path, codebase_path, ".", max_depth, counter)
-    if not root:
-        root = {"name": root_name, "path": ".", "type": "dir", "children": []}
-    else:
-        root["name"] = root_name
-    return {"root": root, "excluded_paths": proj.get("excluded_paths") or []}
+    root = _tree_cache_get(cache_key)
+    if root is None:
+        root_name = os.path.basename(codebase_path.rstrip(os.sep)) or "root"
+        counter = [max_nodes]
+        root = _build_tree(codebase_path, codebase_path, ".", max_depth, counter)
+        if not root:
+            root = {"name": root_name, "path": ".", "type": "dir", "children": []}
+        else:
+            root["name"] = root_name
+        _tree_cache_set(cache_key, root)
+    return {"root": root, "excluded_paths": excluded_paths}
 
 
 # --- WebSocket para el agente (envía schema) ---
@@ -951,7 +1358,7 @@ async def ws_agent(websocket: WebSocket):
     if not api_key:
         await websocket.close(code=4001)
         return
-    project = db.project_by_api_key(api_key)
+    project = await db.project_by_api_key_async(api_key)
     if not project:
         await websocket.close(code=4002)
         return
@@ -1004,15 +1411,195 @@ def _save_checkpoint_from_disk_if_exists(
     if not os.path.isfile(ck_path):
         return
     try:
-        with open(ck_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = _load_json_file(ck_path)
         db.checkpoint_save(project_id, job_id, data)
         db.job_append_log(job_id, "Progreso guardado. Puedes reanudar más tarde.")
     except (OSError, json.JSONDecodeError):
         pass
 
 
-def _run_analyzer(
+# Loop dedicado a los análisis: un solo hilo lee la salida de todos los subprocesos
+# (en lugar de un hilo bloqueado en readline por job).
+# Como mucho ANALYZER_MAX_CONCURRENCY análisis a la vez; el resto espera turno en estado pending.
+_analyzer_loop: asyncio.AbstractEventLoop | None = None
+_analyzer_loop_lock = threading.Lock()
+_ANALYZER_MAX_CONCURRENCY = int(
+    os.environ.get("ANALYZER_MAX_CONCURRENCY", "").strip() or min(32, (os.cpu_count() or 1) * 2)
+)
+_analyzer_slots: asyncio.Semaphore | None = None
+# Tarea de cada job (en cola o en ejecución): job_id -> Future, para cancelar antes de que arranque
+_analyzer_futures: dict[str, concurrent.futures.Future] = {}
+# Fase de cada job: "queued" (esperando hueco), "started" (ya corre _run_analyzer) o "cancelled"
+# (cancelado en cola; no arrancará). Solo se cancela la tarea mientras sigue en "queued": el paso
+# de fase es atómico bajo el lock, así una cancelación nunca corta un análisis ya iniciado.
+_analyzer_phase: dict[str, str] = {}
+_analyzer_phase_lock = threading.Lock()
+
+
+def _get_analyzer_loop() -> asyncio.AbstractEventLoop:
+    global _analyzer_loop, _analyzer_slots
+    with _analyzer_loop_lock:
+        if _analyzer_loop is None or _analyzer_loop.is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="analyzer-loop", daemon=True).start()
+            _analyzer_loop = loop
+            _analyzer_slots = asyncio.Semaphore(_ANALYZER_MAX_CONCURRENCY)
+        return _analyzer_loop
+
+
+async def _run_analyzer_queued(job_id: str, project_id: str, codebase_path: str, schema: dict, **kwargs) -> None:
+    try:
+        async with _analyzer_slots:
+            with _analyzer_phase_lock:
+                if _analyzer_phase.get(job_id) == "cancelled":
+                    return
+                _analyzer_phase[job_id] = "started"
+            await _run_analyzer(job_id, project_id, codebase_path, schema, **kwargs)
+    finally:
+        # El checkpoint ya quedó en BD (o el job se canceló en cola): la carpeta temporal sobra
+        checkpoint_dir = kwargs.get("checkpoint_dir")
+        if checkpoint_dir:
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+
+def _start_analyzer(job_id: str, project_id: str, codebase_path: str, schema: dict, **kwargs) -> None:
+    """Encola _run_analyzer en el loop de análisis (desde cualquier hilo)."""
+    _analyzer_phase[job_id] = "queued"
+    fut = asyncio.run_coroutine_threadsafe(
+        _run_analyzer_queued(job_id, project_id, codebase_path, schema, **kwargs), _get_analyzer_loop()
+    )
+    _analyzer_futures[job_id] = fut
+
+    def _done(_fut: concurrent.futures.Future) -> None:
+        _analyzer_futures.pop(job_id, None)
+        _analyzer_phase.pop(job_id, None)
+
+    fut.add_done_callback(_done)
+
+
+def _cancel_queued_analyzer(job_id: str) -> bool:
+    """Cancela el job solo si aún espera hueco en la cola. False si ya arrancó (o no existe)."""
+    with _analyzer_phase_lock:
+        if _analyzer_phase.get(job_id) != "queued":
+            return False
+        _analyzer_phase[job_id] = "cancelled"
+    fut = _analyzer_futures.get(job_id)
+    if fut is not None:
+        # Libera la espera del semáforo; si ya lo obtuvo, la tarea ve "cancelled" y sale sin arrancar
+        fut.cancel()
+    return True
+
+
+# El analizador arranca en su propio grupo de procesos: al cancelar se señala al grupo entero
+# y no quedan huérfanos los procesos que haya lanzado (parsers, compiladores...).
+if os.name == "nt":
+    _ANALYZER_GROUP_KWARGS = {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    _ANALYZER_GROUP_KWARGS = {"start_new_session": True}
+
+
+def _signal_analyzer_group(proc: asyncio.subprocess.Process, kill: bool = False) -> None:
+    if os.name == "nt":
+        if kill:
+            proc.kill()
+        else:
+            proc.send_signal(signal.CTRL_BREAK_EVENT)
+        return
+    # Con start_new_session el pgid es el pid del analizador
+    os.killpg(proc.pid, signal.SIGKILL if kill else signal.SIGTERM)
+
+
+async def _stop_analyzer_proc(proc: asyncio.subprocess.Process) -> None:
+    """SIGTERM al grupo y hasta 10 s de espera; si no termina, SIGKILL."""
+    try:
+        _signal_analyzer_group(proc)
+        await asyncio.wait_for(proc.wait(), timeout=10)
+    except asyncio.TimeoutError:
+        with contextlib.suppress(ProcessLookupError):
+            _signal_analyzer_group(proc, kill=True)
+    except ProcessLookupError:
+        pass
+
+
+_ANALYZER_READ_CHUNK = 64 * 1024
+
+
+_ANALYZER_LOG_INDENT = b"      "
+
+
+def _append_analyzer_lines(job_id: str, data: bytes | bytearray) -> None:
+    """Añade al log del job las líneas no vacías de un bloque de salida del analizador.
+    Se trabaja en bytes (strip + sangría) y se decodifica una sola vez por bloque."""
+    lines = [_ANALYZER_LOG_INDENT + line for line in (raw.rstrip() for raw in data.split(b"\n")) if line]
+    if lines:
+        db.job_append_log(job_id, b"\n".join(lines).decode("utf-8", errors="replace"))
+
+
+def _json_bytes(value) -> bytes:
+    """JSON compacto en UTF-8 para los ficheros que lee el analizador; usa orjson si está instalado."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _write_file_bytes(path: str, data: bytes) -> None:
+    """Escribe data de una vez con os.write (sin la pila de I/O de texto); fichero solo para el dueño (0600)."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        # memoryview: si una escritura queda corta, el resto se pasa sin copiar el buffer
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def _log_cancel_error(job_id: str, fut: concurrent.futures.Future) -> None:
+    """Done-callback de la parada: un fallo no se pierde en un Future que nadie consulta."""
+    if fut.cancelled() or fut.exception() is None:
+        return
+    err = fut.exception()
+    _log.error("No se pudo detener el analizador del job %s: %r", job_id, err)
+    with contextlib.suppress(Exception):
+        db.job_append_log(job_id, f"ERROR al detener el análisis: {err}")
+
+
+def _write_temp_json(value) -> str:
+    """Vuelca value a un .json temporal (se borra al terminar el análisis) y devuelve su ruta."""
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        f.write(_json_bytes(value))
+        return f.name
+
+
+def _fadvise_sequential(fd: int) -> None:
+    """Indica al kernel lectura secuencial de todo el fichero (read-ahead agresivo). No-op fuera de POSIX."""
+    if hasattr(os, "posix_fadvise"):
+        with contextlib.suppress(OSError):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+
+def _read_file_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        _fadvise_sequential(f.fileno())
+        return f.read()
+
+
+def _load_json_file(path: str):
+    """Lee y parsea un JSON (checkpoints del analizador). Con orjson se parsea directamente sobre un
+    mmap del fichero, sin copiarlo antes a un bytes."""
+    if orjson is None:
+        return json.loads(_read_file_bytes(path))
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return orjson.loads(b"")  # mmap no admite ficheros vacíos; lanza JSONDecodeError
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                return orjson.loads(view)
+
+
+async def _run_analyzer(
     job_id: str,
     project_id: str,
     codebase_path: str,
@@ -1023,7 +1610,9 @@ def _run_analyzer(
     project_type: str | None = None,
 ) -> None:
     """Ejecuta el analizador en subprocess y guarda el grafo. checkpoint_dir: carpeta para checkpoint (guardar/reanudar)."""
-    db.job_set_running(job_id)
+    # Todo lo que bloquea (BD, ficheros) va a un hilo: el loop solo drena la salida de los análisis,
+    # así un commit lento no deja sin leer la tubería de otro job. job_append_log solo encola.
+    await asyncio.to_thread(db.job_set_running, job_id)
     db.job_append_log(job_id, "[1/4] Iniciando análisis…" if not resume else "[1/4] Reanudando análisis…")
     analyzer_path = os.environ.get("ANALYZER_SCRIPT")
     if not analyzer_path:
@@ -1031,22 +1620,17 @@ def _run_analyzer(
         analyzer_path = os.path.join(base, "..", "analyzer", "extract_deps.py")
     if not os.path.isfile(analyzer_path):
         db.job_append_log(job_id, f"ERROR: No se encuentra el script del analizador: {analyzer_path}")
-        db.job_set_failed(job_id, "Analyzer script not found. Set ANALYZER_SCRIPT.")
+        await asyncio.to_thread(db.job_set_failed, job_id, "Analyzer script not found. Set ANALYZER_SCRIPT.")
         return
     db.job_append_log(job_id, f"[2/4] Analizador: {analyzer_path}")
     db.job_append_log(job_id, f"      Ruta del código: {codebase_path}")
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as f:
-        json.dump(schema, f, indent=2)
-        schema_path = f.name
+    schema_path = await asyncio.to_thread(_write_temp_json, schema)
     exclude_file = None
     if excluded_paths:
-        with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as f:
-            json.dump(excluded_paths, f)
-            exclude_file = f.name
+        exclude_file = await asyncio.to_thread(_write_temp_json, excluded_paths)
     out_path = None
     if checkpoint_dir:
-        with _analyzer_procs_lock:
-            _job_checkpoint_dirs[job_id] = checkpoint_dir
+        _job_checkpoint_dirs[job_id] = checkpoint_dir
     try:
         out_path = tempfile.mktemp(suffix=".graph.json")
         db.job_append_log(job_id, "[3/4] Ejecutando analizador (esto puede tardar varios minutos)…")
@@ -1063,72 +1647,75 @@ def _run_analyzer(
             cmd.extend(["--checkpoint-path", ck_path])
             if resume:
                 cmd.append("--resume")
-        proc = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
             cwd=analyzer_dir,
             env=run_env,
+            **_ANALYZER_GROUP_KWARGS,
         )
-        with _analyzer_procs_lock:
-            _running_analyzer_procs[job_id] = proc
+        _running_analyzer_procs[job_id] = proc
         try:
-            for line in iter(proc.stdout.readline, ""):
-                line = line.rstrip()
-                if line:
-                    db.job_append_log(job_id, "      " + line)
+            # Lecturas de hasta 64 KB: un read por bloque (no por línea) y un append por bloque de líneas
+            pending = bytearray()
+            while chunk := await proc.stdout.read(_ANALYZER_READ_CHUNK):
+                pending += chunk
+                end = pending.rfind(b"\n")
+                if end < 0:
+                    continue
+                _append_analyzer_lines(job_id, pending[:end])
+                del pending[:end + 1]
+            if pending:
+                _append_analyzer_lines(job_id, pending)
         finally:
-            with _analyzer_procs_lock:
-                _running_analyzer_procs.pop(job_id, None)
-                _job_checkpoint_dirs.pop(job_id, None)
-            proc.wait()
-        job = db.job_get(job_id)
-        if job and job.get("status") == "cancelled":
+            _running_analyzer_procs.pop(job_id, None)
+            _job_checkpoint_dirs.pop(job_id, None)
+            await proc.wait()
+        job = await asyncio.to_thread(db.job_get, job_id)
+        if job and job.get("status") in ("cancelling", "cancelled"):
+            # Pasa a 'cancelled' en el finally, después de rescatar el checkpoint
             db.job_append_log(job_id, "Análisis detenido por el usuario.")
             return
         if proc.returncode != 0:
             db.job_append_log(job_id, f"ERROR: Analizador terminó con código {proc.returncode}")
-            db.job_set_failed(job_id, "Analysis failed. Check the job log.")
-            _save_checkpoint_from_disk_if_exists(project_id, job_id, checkpoint_dir)
+            await asyncio.to_thread(db.job_set_failed, job_id, "Analysis failed. Check the job log.")
+            await asyncio.to_thread(_save_checkpoint_from_disk_if_exists, project_id, job_id, checkpoint_dir)
             return
         db.job_append_log(job_id, "[4/4] Guardando grafo…")
-        with open(out_path, "r", encoding="utf-8") as g:
-            graph = json.load(g)
-        db.graph_save(project_id, graph)
-        db.checkpoint_clear(project_id)
+        # El JSON del analizador pasa tal cual a la BD (sin json.load)
+        raw = await asyncio.to_thread(_read_file_bytes, out_path)
+        await asyncio.to_thread(db.graph_save_raw, project_id, raw)
+        await asyncio.to_thread(db.checkpoint_clear, project_id)
         db.job_append_log(job_id, "Listo. Grafo guardado.")
-        db.job_set_completed(job_id)
-    except subprocess.TimeoutExpired:
-            db.job_append_log(job_id, "ERROR: Timeout del analizador.")
-            db.job_set_failed(job_id, "Timeout: el analizador tardó demasiado. Prueba con menos archivos o reanuda más tarde.")
-            _save_checkpoint_from_disk_if_exists(project_id, job_id, checkpoint_dir)
+        await asyncio.to_thread(db.job_set_completed, job_id)
     except Exception as e:
             db.job_append_log(job_id, f"ERROR: {e}")
-            db.job_set_failed(job_id, f"Error: {e}. Check the log for details.")
-            _save_checkpoint_from_disk_if_exists(project_id, job_id, checkpoint_dir)
+            await asyncio.to_thread(db.job_set_failed, job_id, f"Error: {e}. Check the log for details.")
+            await asyncio.to_thread(_save_checkpoint_from_disk_if_exists, project_id, job_id, checkpoint_dir)
     finally:
-        with _analyzer_procs_lock:
-            _job_checkpoint_dirs.pop(job_id, None)
-        # Si el análisis no terminó bien, intentar rescatar el checkpoint del disco (crash, kill, etc.)
-        job_after = db.job_get(job_id)
-        if job_after and job_after.get("status") != "completed":
-            _save_checkpoint_from_disk_if_exists(project_id, job_id, checkpoint_dir)
+        _job_checkpoint_dirs.pop(job_id, None)
+        job_after = None
         try:
-            os.unlink(schema_path)
-        except Exception:
-            pass
-        if exclude_file and os.path.isfile(exclude_file):
-            try:
-                os.unlink(exclude_file)
-            except Exception:
-                pass
-        if out_path and os.path.isfile(out_path):
+            # Si el análisis no terminó bien, intentar rescatar el checkpoint del disco (crash, kill, etc.)
+            job_after = await asyncio.to_thread(db.job_get, job_id)
+            if job_after and job_after.get("status") != "completed":
+                await asyncio.to_thread(_save_checkpoint_from_disk_if_exists, project_id, job_id, checkpoint_dir)
+        except Exception as e:
+            _log.warning("No se pudo rescatar el checkpoint del job %s: %s", job_id, e)
+        finally:
+            # Hasta aquí el job sigue en 'cancelling' y start/resume lo rechazan: un análisis nuevo no
+            # puede borrar checkpoints y ver después cómo este finally vuelve a escribir el viejo.
+            # Pasa a 'cancelled' aunque el rescate falle; si no, el proyecto queda bloqueado hasta reiniciar
             try:
-                os.unlink(out_path)
-            except Exception:
-                pass
+                if job_after and job_after.get("status") == "cancelling":
+                    await asyncio.to_thread(db.job_set_cancelled, job_id)
+            finally:
+                # unlink directo (sin isfile previo): un syscall por fichero y sin carrera entre comprobar y borrar
+                for path in (schema_path, exclude_file, out_path):
+                    if path:
+                        with contextlib.suppress(OSError):
+                            os.unlink(path)
 
 
 @app.post("/api/projects/{project_id}/analyze")
@@ -1137,6 +1724,8 @@ def start_analyze(project_id: str):
     proj = db.project_get(project_id)
     if not proj:
         raise HTTPException(404, "Project not found")
+    if db.job_cancelling_exists(project_id):
+        raise HTTPException(409, "The previous analysis is still stopping. Try again in a few seconds.")
     schema = db.schema_get_latest(project_id)
     if not schema:
         schema = {}  # Opcional: analizar solo código sin agente/schema
@@ -1152,13 +1741,7 @@ def start_analyze(project_id: str):
         db.job_set_failed(job_id, str(e))
         raise HTTPException(400, str(e))
     checkpoint_dir = tempfile.mkdtemp(prefix="anatomy_job_")
-    thread = threading.Thread(
-        target=_run_analyzer,
-        args=(job_id, project_id, codebase_path, schema),
-        kwargs={"excluded_paths": excluded_paths or None, "checkpoint_dir": checkpoint_dir, "resume": False, "project_type": (proj.get("project_type") or "").strip() or None},
-    )
-    thread.daemon = True
-    thread.start()
+    _start_analyzer(job_id, project_id, codebase_path, schema, excluded_paths=excluded_paths or None, checkpoint_dir=checkpoint_dir, resume=False, project_type=(proj.get("project_type") or "").strip() or None)
     return {"job_id": job_id, "status": "pending"}
 
 
@@ -1168,6 +1751,9 @@ def resume_analyze(project_id: str):
     proj = db.project_get(project_id)
     if not proj:
         raise HTTPException(404, "Project not found")
+    # Mientras se detiene, el checkpoint que se reanudaría aún no está guardado
+    if db.job_cancelling_exists(project_id):
+        raise HTTPException(409, "The previous analysis is still stopping. Try again in a few seconds.")
     _, checkpoint = db.checkpoint_get_latest(project_id)
     if not checkpoint:
         raise HTTPException(400, "No checkpoint to resume. Run an analysis and stop it first.")
@@ -1186,17 +1772,10 @@ def resume_analyze(project_id: str):
     checkpoint_dir = tempfile.mkdtemp(prefix="anatomy_job_")
     ck_path = os.path.join(checkpoint_dir, "checkpoint.json")
     try:
-        with open(ck_path, "w", encoding="utf-8") as f:
-            json.dump(checkpoint, f, indent=2)
+        _write_file_bytes(ck_path, _json_bytes(checkpoint))
     except OSError as e:
         raise HTTPException(500, f"Could not write checkpoint: {e}")
-    thread = threading.Thread(
-        target=_run_analyzer,
-        args=(job_id, project_id, codebase_path, schema),
-        kwargs={"excluded_paths": excluded_paths or None, "checkpoint_dir": checkpoint_dir, "resume": True, "project_type": (proj.get("project_type") or "").strip() or None},
-    )
-    thread.daemon = True
-    thread.start()
+    _start_analyzer(job_id, project_id, codebase_path, schema, excluded_paths=excluded_paths or None, checkpoint_dir=checkpoint_dir, resume=True, project_type=(proj.get("project_type") or "").strip() or None)
     return {"job_id": job_id, "status": "pending"}
 
 
@@ -1207,8 +1786,8 @@ def list_project_types():
 
 
 @app.get("/api/jobs/{job_id}")
-def get_job(job_id: str):
-    job = db.job_get(job_id)
+async def get_job(job_id: str):
+    job = await db.job_get_async(job_id)
     if not job:
         raise HTTPException(404, "Job not found")
     return job
@@ -1220,29 +1799,21 @@ def cancel_job(job_id: str):
     job = db.job_get(job_id)
     if not job:
         raise HTTPException(404, "Job not found")
-    with _analyzer_procs_lock:
-        proc = _running_analyzer_procs.get(job_id)
-        checkpoint_dir = _job_checkpoint_dirs.get(job_id)
+    proc = _running_analyzer_procs.get(job_id)
     if not proc:
+        # Solo mientras espera en la cola: una vez iniciado (preparando el subproceso o guardando el
+        # grafo) cancelar la tarea dejaría el job 'cancelled' con escrituras a medias
+        if _cancel_queued_analyzer(job_id):
+            db.job_set_cancelled(job_id)
+            return {"ok": True, "status": "cancelled"}
         raise HTTPException(400, "No analysis running for this job. It may have already finished.")
-    try:
-        proc.terminate()
-        proc.wait(timeout=10)
-    except subprocess.TimeoutExpired:
-        proc.kill()
-    except Exception:
-        pass
-    db.job_set_cancelled(job_id)
-    if checkpoint_dir:
-        ck_path = os.path.join(checkpoint_dir, "checkpoint.json")
-        if os.path.isfile(ck_path):
-            try:
-                with open(ck_path, "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                db.checkpoint_save(job["project_id"], job_id, data)
-            except (OSError, json.JSONDecodeError):
-                pass
-    return {"ok": True, "status": "cancelled"}
+    # La espera (hasta 10 s + SIGKILL) corre en el loop de análisis, no en este worker HTTP.
+    # _run_analyzer pasa el job a 'cancelled' cuando el proceso termina y el checkpoint está
+    # guardado; el front sigue consultando el job hasta entonces.
+    db.job_set_cancelling(job_id)
+    fut = asyncio.run_coroutine_threadsafe(_stop_analyzer_proc(proc), _get_analyzer_loop())
+    fut.add_done_callback(functools.partial(_log_cancel_error, job_id))
+    return {"ok": True, "status": "cancelling"}
 
 
 def _resolve_node_to_file_path(node_id: str, path_prefix: str) -> tuple[str | None, str | None]:
@@ -1482,6 +2053,17 @@ def get_project_graph(project_id: str):
     return graph
 
 
+@app.get("/api/projects/{project_id}/graph/summary")
+def get_project_graph_summary(project_id: str):
+    """Conteo de nodos y aristas del último grafo sin descargarlo entero."""
+    if db.project_get(project_id) is None:
+        raise HTTPException(404, "Project not found")
+    summary = db.graph_get_summary(project_id)
+    if summary is None:
+        raise HTTPException(404, "No graph yet. Run analysis first.")
+    return summary
+
+
 class ProjectGraphPayload(BaseModel):
     nodes: list = Field(default_factory=list)
     edges: list = Field(default_factory=list)
@@ -1548,11 +2130,14 @@ def patch_project_graph_ui_state(project_id: str, payload: GraphUIStatePayload):
 
 
 @app.get("/api/projects/{project_id}/node-notes")
-def get_project_node_notes(project_id: str):
-    """Devuelve { node_id: [note1, note2, ...], ... }."""
+def get_project_node_notes(project_id: str, node_id: str | None = None):
+    """Devuelve { node_id: [note1, note2, ...], ... }. Con ?node_id= solo las de ese nodo."""
     proj = db.project_get(project_id)
     if not proj:
         raise HTTPException(404, "Project not found")
+    if node_id:
+        notes = db.node_note_get_for_node(project_id, node_id)
+        return {"notes": {node_id: notes} if notes else {}}
     return {"notes": db.node_notes_get(project_id)}
 
 
@@ -1567,12 +2152,7 @@ def patch_project_node_notes(project_id: str, payload: NodeNotesPayload):
     proj = db.project_get(project_id)
     if not proj:
         raise HTTPException(404, "Project not found")
-    all_notes = db.node_notes_get(project_id)
-    if payload.notes:
-        all_notes[payload.node_id] = payload.notes
-    else:
-        all_notes.pop(payload.node_id, None)
-    db.node_notes_set(project_id, all_notes)
+    db.node_notes_upsert(project_id, payload.node_id, payload.notes)
     return {"ok": True, "notes": payload.notes}
 
 
@@ -1632,7 +2212,7 @@ def get_project_impact(project_id: str, node_id: str):
     """Impacto de un nodo: upstream (de los que depende) y downstream (los que lo usan). Usa el grafo guardado en BD, no Neo4j."""
     if db.project_get(project_id) is None:
         raise HTTPException(404, "Project not found")
-    graph = db.graph_get_latest(project_id)
+    graph = db.graph_get_topology(project_id)
     if not graph:
         raise HTTPException(404, "No graph yet. Run analysis first.")
     upstream, downstream = _graph_impact_from_json(graph, node_id)
@@ -1644,13 +2224,106 @@ def get_project_orphans(project_id: str):
     """Nodos huérfanos (sin conexiones) del grafo del proyecto. Usa el grafo en BD, no Neo4j."""
     if db.project_get(project_id) is None:
         raise HTTPException(404, "Project not found")
-    graph = db.graph_get_latest(project_id)
+    graph = db.graph_get_topology(project_id)
     if not graph:
         raise HTTPException(404, "No graph yet. Run analysis first.")
     orphan_ids = _graph_orphans_from_json(graph)
     return {"orphan_ids": orphan_ids}
 
 
+# Impacto en Neo4j: recorrido BFS que visita cada nodo una vez (apoc.path.subgraphNodes), en vez de
+# expandir todos los caminos con RELATES_TO*1..; sin APOC se hace el BFS por niveles desde Python.
+_CYPHER_IMPACT_APOC = """
+MATCH (a:AnatomyNode {id: $id})
+CALL apoc.path.subgraphNodes(a, {relationshipFilter: $rel, labelFilter: '+AnatomyNode', bfs: true, minLevel: 1})
+YIELD node
+RETURN node.id AS id
+"""
+_CYPHER_NEXT_DOWN = """
+MATCH (a:AnatomyNode)-[:RELATES_TO]->(b:AnatomyNode)
+WHERE a.id IN $ids
+RETURN DISTINCT b.id AS id
+"""
+_CYPHER_NEXT_UP = """
+MATCH (b:AnatomyNode)-[:RELATES_TO]->(a:AnatomyNode)
+WHERE a.id IN $ids
+RETURN DISTINCT b.id AS id
+"""
+# degree se guarda al escribir el grafo (índice anatomy_node_degree): búsqueda por índice, sin
+# comprobar relaciones nodo a nodo
+_CYPHER_ORPHANS = """
+MATCH (n:AnatomyNode {degree: 0})
+RETURN n.id AS id
+"""
+# None = sin comprobar; False = el servidor no tiene APOC
+_neo4j_apoc: bool | None = None
+
+
+def _impact_apoc_tx(tx, node_id: str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    downstream = tuple(tx.run(_CYPHER_IMPACT_APOC, id=node_id, rel="RELATES_TO>").value("id"))
+    upstream = tuple(tx.run(_CYPHER_IMPACT_APOC, id=node_id, rel="<RELATES_TO").value("id"))
+    return upstream, downstream
+
+
+def _bfs_tx(tx, query: str, node_id: str) -> tuple[str, ...]:
+    """BFS por niveles: una consulta de un salto por nivel con toda la frontera, cada nodo una vez."""
+    seen = {node_id}
+    found: list[str] = []
+    frontier = [node_id]
+    while frontier:
+        nxt = tx.run(query, ids=frontier).value("id")
+        frontier = [i for i in nxt if i not in seen]
+        seen.update(frontier)
+        found.extend(frontier)
+    return tuple(found)
+
+
+def _impact_bfs_tx(tx, node_id: str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    return _bfs_tx(tx, _CYPHER_NEXT_UP, node_id), _bfs_tx(tx, _CYPHER_NEXT_DOWN, node_id)
+
+
+def _orphans_tx(tx) -> tuple[str, ...]:
+    return tuple(tx.run(_CYPHER_ORPHANS).value("id"))
+
+
+# Resultados de Neo4j memorizados por versión del grafo confirmada en Neo4j (_graph_version_neo4j):
+# un grafo nuevo usa claves nuevas y las entradas viejas salen por LRU. Tuplas: el caché no se muta.
+@functools.lru_cache(maxsize=4096)
+def _neo4j_impact(graph_version: int, node_id: str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+    global _neo4j_apoc
+    from neo4j import READ_ACCESS
+    from neo4j.exceptions import ClientError
+
+    with _get_neo4j_driver().session(database=_neo4j_database(), default_access_mode=READ_ACCESS) as session:
+        if _neo4j_apoc is not False:
+            try:
+                result = session.execute_read(_impact_apoc_tx, node_id)
+                _neo4j_apoc = True
+                return result
+            except ClientError as e:
+                if e.code != "Neo.ClientError.Procedure.ProcedureNotFound":
+                    raise
+                _neo4j_apoc = False
+        return session.execute_read(_impact_bfs_tx, node_id)
+
+
+@functools.lru_cache(maxsize=16)
+def _neo4j_orphans(graph_version: int) -> tuple[str, ...]:
+    from neo4j import READ_ACCESS
+
+    with _get_neo4j_driver().session(database=_neo4j_database(), default_access_mode=READ_ACCESS) as session:
+        return session.execute_read(_orphans_tx)
+
+
+def _neo4j_cached(fn, *args):
+    """Llama a fn memorizada solo si Neo4j ya tiene la última versión del grafo. Con un POST en curso
+    la consulta va directa: podría ver el grafo anterior y no debe quedar guardada con la versión nueva."""
+    version = _graph_version_neo4j
+    if version == _graph_version:
+        return fn(version, *args)
+    return fn.__wrapped__(version, *args)
+
+
 @app.get("/api/graph/impact")
 def get_impact(node_id: str):
     """Requiere Neo4j. Devuelve nodos que dependen del dado (downstream) y de los que depende (upstream)."""
@@ -1658,25 +2331,8 @@ def get_impact(node_id: str):
     if not driver:
         raise HTTPException(503, "Neo4j not configured")
     try:
-        with driver.session(database=_neo4j_database()) as session:
-            # Downstream: nodos alcanzables siguiendo RELATES_TO hacia delante
-            down = session.run(
-                """
-                MATCH (a:AnatomyNode {id: $id})-[:RELATES_TO*1..]->(b:AnatomyNode)
-                RETURN DISTINCT b.id AS id
-                """,
-                id=node_id,
-            )
-            downstream = [r["id"] for r in down]
-            # Upstream: nodos desde los que se llega al dado
-            up = session.run(
-                """
-                MATCH (b:AnatomyNode)-[:RELATES_TO*1..]->(a:AnatomyNode {id: $id})
-                RETURN DISTINCT b.id AS id
-                """,
-                id=node_id,
-            )
-            upstream = [r["id"] for r in up]
+        # Las tuplas del caché se serializan como arrays JSON: sin copiarlas a listas
+        upstream, downstream = _neo4j_cached(_neo4j_impact, node_id)
         return {"node_id": node_id, "upstream": upstream, "downstream": downstream}
     except Exception as e:
         raise HTTPException(502, str(e))
@@ -1689,15 +2345,6 @@ def get_orphans():
     if not driver:
         raise HTTPException(503, "Neo4j not configured")
     try:
-        with driver.session(database=_neo4j_database()) as session:
-            result = session.run(
-                """
-                MATCH (n:AnatomyNode)
-                WHERE NOT (n)-[:RELATES_TO]-()
-                RETURN n.id AS id
-                """
-            )
-            ids = [r["id"] for r in result]
-        return {"orphans": ids}
+        return {"orphans": _neo4j_cached(_neo4j_orphans)}
     except Exception as e:
         raise HTTPException(502, str(e))
@@ -1,9 +1,25 @@
 """
 Configuración de pytest para el backend.
-Usa SQLite en memoria para no depender de Postgres en CI/local.
+Usa SQLite en un fichero temporal para no depender de Postgres en CI/local
+(con :memory: cada conexión del pool vería su propia BD vacía).
 """
 import os
+import tempfile
 
 # Forzar SQLite antes de que se importe db o main
-# Forzar siempre SQLite en memoria en tests
-os.environ["DATABASE_URL"] = "sqlite:///:memory:"
+_TEST_DB_DIR = tempfile.mkdtemp(prefix="anatomy_tests_")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_TEST_DB_DIR, "test.sqlite")
+# Toda la suite comparte cliente (misma IP): sin esto superaría el límite general de 100/min
+os.environ.setdefault("RATE_LIMIT_PER_MIN", "100000")
+
+import pytest
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _init_db():
+    """Crea las tablas (los tests usan TestClient sin lifespan)."""
+    import db
+
+    db.init_db()
+    yield
+    db.stop_log_writer()
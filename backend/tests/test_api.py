@@ -1,6 +1,8 @@
 """
 Tests de la API del backend: health, proyectos (CRUD), grafo por proyecto.
 """
+import json
+
 import pytest
 from fastapi.testclient import TestClient
 
@@ -90,3 +92,677 @@ def test_save_and_get_graph():
     assert "nodes" in data
     assert len(data["nodes"]) == 1
     assert data["nodes"][0]["id"] == "n1"
+
+
+def _new_project(name: str) -> str:
+    r = client.post("/api/projects", json={"name": name, "codebase_path": "", "repo_url": "", "repo_branch": "main"})
+    return r.json()["id"]
+
+
+def test_project_tree_cache_hit_skips_repo_fetch(monkeypatch, tmp_path):
+    import os
+    import main
+    monkeypatch.setenv("REPOS_DIR", str(tmp_path))
+    r = client.post("/api/projects", json={"name": "Repo tree", "codebase_path": "", "repo_url": "owner/repo", "repo_branch": "main"})
+    pid = r.json()["id"]
+    clone = main._repo_clone_path(pid)
+    os.makedirs(os.path.join(clone, ".git"))
+    os.makedirs(os.path.join(clone, "src"))
+    open(os.path.join(clone, "src", "a.php"), "w").close()
+    fetches = []
+
+    def fake_clone_or_pull(project_id, repo_url, branch, job_id):
+        fetches.append(project_id)
+        return os.path.abspath(clone)
+    monkeypatch.setattr(main, "_clone_or_pull_repo", fake_clone_or_pull)
+    first = client.get(f"/api/projects/{pid}/tree").json()
+    assert [c["name"] for c in first["root"]["children"]] == ["src"]
+    # Mientras el árbol está en caché, consultar el árbol no vuelve a hacer fetch del repo
+    assert client.get(f"/api/projects/{pid}/tree").json() == first
+    assert fetches == [pid]
+
+
+def test_node_notes_patch_and_get():
+    pid = _new_project("Notes")
+    r = client.patch(f"/api/projects/{pid}/node-notes", json={"node_id": "model:User", "notes": ["a", "b"]})
+    assert r.status_code == 200
+    client.patch(f"/api/projects/{pid}/node-notes", json={"node_id": "route:home", "notes": ["c"]})
+    assert client.get(f"/api/projects/{pid}/node-notes").json()["notes"] == {"model:User": ["a", "b"], "route:home": ["c"]}
+    r2 = client.get(f"/api/projects/{pid}/node-notes", params={"node_id": "model:User"})
+    assert r2.json()["notes"] == {"model:User": ["a", "b"]}
+    assert client.get(f"/api/projects/{pid}/node-notes", params={"node_id": "missing"}).json()["notes"] == {}
+    # Lista vacía = quitar las notas del nodo
+    client.patch(f"/api/projects/{pid}/node-notes", json={"node_id": "route:home", "notes": []})
+    assert client.get(f"/api/projects/{pid}/node-notes").json()["notes"] == {"model:User": ["a", "b"]}
+
+
+def test_node_notes_upsert_same_notes_is_noop():
+    import db
+    pid = _new_project("Notes noop")
+    db.node_notes_upsert(pid, "n1", ["x"])
+    with db.read_scope() as c:
+        rev = c.execute(db._SQL_NOTES_REV_SQLITE, {"id": pid}).scalar()
+    db.node_notes_upsert(pid, "n1", ["x"])
+    db.node_notes_upsert(pid, "n2", [])
+    with db.read_scope() as c:
+        assert c.execute(db._SQL_NOTES_REV_SQLITE, {"id": pid}).scalar() == rev
+    db.node_notes_upsert(pid, "n1", ["y"])
+    assert db.node_note_get_for_node(pid, "n1") == ["y"]
+
+
+def _migration_engine(tmp_path):
+    from sqlalchemy import create_engine
+    return create_engine("sqlite:///" + str(tmp_path / "migrate.sqlite"))
+
+
+def test_notes_migration_copies_legacy_dict_once(tmp_path):
+    import db
+    from sqlalchemy import text
+    engine = _migration_engine(tmp_path)
+    db._run_ddl(engine, db._NOTES_V2_VERSION)
+    # BD de una versión anterior: notas como dict por proyecto (y la copia binaria notes_bin)
+    with engine.begin() as c:
+        c.execute(text("ALTER TABLE project_node_notes ADD COLUMN notes_bin BLOB"))
+        c.execute(text(
+            "INSERT INTO projects (id, name, codebase_path, agent_api_key, created_at, updated_at) "
+            "VALUES ('p1', 'old', '', 'k1', '', '')"
+        ))
+        c.execute(text("INSERT INTO project_node_notes (project_id, notes) VALUES ('p1', :n)"),
+                  {"n": '{"model:User": ["a"], "route:x": ["b", "c"]}'})
+    db._run_ddl(engine, db._NOTES_V2_VERSION - 1)
+    with engine.connect() as c:
+        rows = dict(c.execute(text("SELECT node_id, notes FROM project_node_notes_v2 WHERE project_id = 'p1'")).all())
+        legacy = c.execute(text("SELECT notes FROM project_node_notes WHERE project_id = 'p1'")).scalar()
+        cols = {r[1] for r in c.execute(text("PRAGMA table_info(project_node_notes)"))}
+    assert {k: json.loads(v) for k, v in rows.items()} == {"model:User": ["a"], "route:x": ["b", "c"]}
+    # La columna antigua queda intacta (una versión anterior del backend sigue leyéndola);
+    # la copia binaria notes_bin, sin lectores, se elimina
+    assert json.loads(legacy) == {"model:User": ["a"], "route:x": ["b", "c"]}
+    assert "notes_bin" not in cols
+    # Ya en la versión nueva, volver a correr el DDL no resucita notas borradas
+    with engine.begin() as c:
+        c.execute(text("DELETE FROM project_node_notes_v2 WHERE node_id = 'route:x'"))
+    db._run_ddl(engine, db._NOTES_V2_VERSION)
+    with engine.connect() as c:
+        assert c.execute(text("SELECT node_id FROM project_node_notes_v2")).scalars().all() == ["model:User"]
+
+
+def test_node_notes_set_writes_only_changes():
+    import db
+    pid = _new_project("Notes set")
+    db.node_notes_set(pid, {"a": ["1"], "b": ["2"]})
+    assert db.node_notes_get(pid) == {"a": ["1"], "b": ["2"]}
+    db.node_notes_set(pid, {"a": ["1"], "c": ["3"]})
+    assert db.node_notes_get(pid) == {"a": ["1"], "c": ["3"]}
+    # Tras una escritura de otro camino la caché queda atrás y se compara con las filas
+    db.node_notes_upsert(pid, "a", ["9"])
+    db.node_notes_set(pid, {"a": ["1"], "c": ["3"]})
+    assert db.node_note_get_for_node(pid, "a") == ["1"]
+
+
+def test_node_notes_set_concurrent_replaces_do_not_merge(monkeypatch):
+    import db
+    pid = _new_project("Notes race")
+    db.node_notes_set(pid, {"a": ["1"]})
+    real_get = db._notes_cache.get
+    injected = []
+
+    def get_with_second_writer(key):
+        # Otro reemplazo entra justo después de que el primero lea su base del diff ({a} en caché)
+        cached = real_get(key)
+        if not injected:
+            injected.append(1)
+            db.node_notes_set(pid, {"c": ["3"]})
+        return cached
+    monkeypatch.setattr(db._notes_cache, "get", get_with_second_writer)
+    db.node_notes_set(pid, {"b": ["2"]})
+    monkeypatch.undo()
+    # Gana el último en escribir, entero: ni {b, c} en BD ni un caché distinto de la BD
+    assert db.node_notes_get(pid) == {"b": ["2"]}
+    db._notes_cache.pop(pid)
+    assert db.node_notes_get(pid) == {"b": ["2"]}
+
+
+def _wait_for(cond, timeout: float = 5.0) -> None:
+    import time
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "timeout"
+        time.sleep(0.01)
+
+
+def test_cancel_job_while_queued(monkeypatch):
+    import asyncio
+    import db
+    import main
+    ran = []
+
+    async def fake_run(job_id, *args, **kwargs):
+        ran.append(job_id)
+
+    monkeypatch.setattr(main, "_run_analyzer", fake_run)
+    pid = _new_project("Queued")
+    loop = main._get_analyzer_loop()
+    # Todos los huecos ocupados: el job queda en cola
+    for _ in range(main._ANALYZER_MAX_CONCURRENCY):
+        asyncio.run_coroutine_threadsafe(main._analyzer_slots.acquire(), loop).result(5)
+    try:
+        jid = db.job_create(pid)
+        main._start_analyzer(jid, pid, "/tmp", {})
+        r = client.post(f"/api/jobs/{jid}/cancel")
+        assert r.status_code == 200
+        assert r.json()["status"] == "cancelled"
+    finally:
+        for _ in range(main._ANALYZER_MAX_CONCURRENCY):
+            loop.call_soon_threadsafe(main._analyzer_slots.release)
+    _wait_for(lambda: jid not in main._analyzer_futures)
+    assert ran == []
+    assert db.job_get(jid)["status"] == "cancelled"
+
+
+def test_cancel_job_after_start_without_process_is_rejected(monkeypatch):
+    import asyncio
+    import threading
+    import db
+    import main
+    release = threading.Event()
+
+    async def fake_run(job_id, *args, **kwargs):
+        # Simula las fases sin subproceso (job_set_running, guardar el grafo...)
+        await asyncio.to_thread(release.wait, 5)
+
+    monkeypatch.setattr(main, "_run_analyzer", fake_run)
+    pid = _new_project("Started")
+    jid = db.job_create(pid)
+    main._start_analyzer(jid, pid, "/tmp", {})
+    try:
+        _wait_for(lambda: main._analyzer_phase.get(jid) == "started")
+        r = client.post(f"/api/jobs/{jid}/cancel")
+        assert r.status_code == 400
+    finally:
+        release.set()
+    _wait_for(lambda: jid not in main._analyzer_futures)
+    assert db.job_get(jid)["status"] != "cancelled"
+
+
+_SLOW_ANALYZER = """
+import json, signal, sys, time
+# Tarda un poco en salir tras SIGTERM: el job se ve en 'cancelling' mientras tanto
+signal.signal(signal.SIGTERM, lambda *_: (time.sleep(1), sys.exit(0)))
+ck = sys.argv[sys.argv.index("--checkpoint-path") + 1]
+with open(ck, "w") as f:
+    json.dump({"done": ["a.php"]}, f)
+print("ready", flush=True)
+time.sleep(30)
+"""
+
+
+def test_cancel_running_job_goes_through_cancelling(monkeypatch, tmp_path):
+    import os
+    import sys
+    import tempfile
+    import db
+    import main
+    script = tmp_path / "slow_analyzer.py"
+    script.write_text(_SLOW_ANALYZER)
+    monkeypatch.setenv("ANALYZER_SCRIPT", str(script))
+    monkeypatch.setenv("PYTHON", sys.executable)
+    pid = _new_project("Cancelling")
+    jid = db.job_create(pid)
+    ck_dir = tempfile.mkdtemp(prefix="anatomy_job_")
+    main._start_analyzer(jid, pid, str(tmp_path), {}, checkpoint_dir=ck_dir)
+    ck_path = os.path.join(ck_dir, "checkpoint.json")
+    _wait_for(lambda: jid in main._running_analyzer_procs and os.path.exists(ck_path))
+    r = client.post(f"/api/jobs/{jid}/cancel")
+    assert r.status_code == 200
+    assert r.json()["status"] == "cancelling"
+    # Mientras se detiene no se puede lanzar ni reanudar otro análisis del proyecto
+    assert db.job_get(jid)["status"] == "cancelling"
+    assert client.post(f"/api/projects/{pid}/analyze").status_code == 409
+    assert client.post(f"/api/projects/{pid}/analyze/resume").status_code == 409
+    _wait_for(lambda: db.job_get(jid)["status"] == "cancelled", timeout=15)
+    # Al llegar a 'cancelled' el checkpoint ya está en BD
+    assert db.checkpoint_get_latest(pid)[1] == {"done": ["a.php"]}
+
+
+def test_cancel_finishes_even_if_checkpoint_save_fails(monkeypatch, tmp_path, caplog):
+    import os
+    import sys
+    import tempfile
+    import db
+    import main
+    script = tmp_path / "slow_analyzer.py"
+    script.write_text(_SLOW_ANALYZER)
+    monkeypatch.setenv("ANALYZER_SCRIPT", str(script))
+    monkeypatch.setenv("PYTHON", sys.executable)
+
+    def broken_checkpoint_save(*args):
+        raise RuntimeError("db down")
+    monkeypatch.setattr(db, "checkpoint_save", broken_checkpoint_save)
+    pid = _new_project("Cancelling broken")
+    jid = db.job_create(pid)
+    ck_dir = tempfile.mkdtemp(prefix="anatomy_job_")
+    main._start_analyzer(jid, pid, str(tmp_path), {}, checkpoint_dir=ck_dir)
+    _wait_for(lambda: jid in main._running_analyzer_procs and os.path.exists(os.path.join(ck_dir, "checkpoint.json")))
+    assert client.post(f"/api/jobs/{jid}/cancel").json()["status"] == "cancelling"
+    # Sin checkpoint guardado, pero el job termina y el proyecto no queda bloqueado
+    _wait_for(lambda: db.job_get(jid)["status"] == "cancelled", timeout=15)
+    assert not db.job_cancelling_exists(pid)
+    assert any("db down" in r.getMessage() for r in caplog.records)
+
+
+def test_jobs_left_cancelling_are_finished_on_startup():
+    import db
+    pid = _new_project("Stale cancelling")
+    jid = db.job_create(pid)
+    db.job_set_cancelling(jid)
+    assert db.job_cancelling_exists(pid)
+    assert client.post(f"/api/projects/{pid}/analyze").status_code == 409
+    db.jobs_finish_cancelling()
+    assert db.job_get(jid)["status"] == "cancelled"
+    assert not db.job_cancelling_exists(pid)
+
+
+class _FakeNeo4jSession:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def run(self, query, **params):
+        self.driver.queries.append(query)
+        if query.startswith("CREATE CONSTRAINT"):
+            raise RuntimeError("duplicate ids")
+
+    def execute_write(self, fn, *args):
+        self.driver.writes += 1
+
+
+class _FakeNeo4jDriver:
+    def __init__(self):
+        self.queries = []
+        self.writes = 0
+
+    def session(self, **kwargs):
+        return _FakeNeo4jSession(self)
+
+
+def test_neo4j_write_survives_constraint_failure(monkeypatch):
+    import main
+    monkeypatch.setattr(main, "_neo4j_constraints_ready", False)
+    driver = _FakeNeo4jDriver()
+    graph = {"nodes": [{"id": "a", "data": {}}], "edges": []}
+    main._write_graph_to_neo4j(driver, graph)
+    main._write_graph_to_neo4j(driver, graph)
+    assert driver.writes == 2
+    # Un solo intento de crear el constraint y nunca el relleno de degree en la ruta de escritura
+    assert sum(q.startswith("CREATE CONSTRAINT") for q in driver.queries) == 1
+    assert not any("degree IS NULL" in q for q in driver.queries)
+
+
+def test_github_repos_flags_truncated_listing(monkeypatch):
+    import httpx
+    import db
+    import main
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        page = int(request.url.params.get("page", "1"))
+        headers = {"Link": '<https://api.github.com/user/repos?per_page=100&page=25>; rel="last"'}
+        return httpx.Response(200, json=[{"full_name": f"o/r{page}", "name": f"r{page}"}], headers=headers)
+
+    monkeypatch.setattr(db, "project_get_github_token", lambda _pid: "tok")
+    monkeypatch.setattr(main, "_get_github_async_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    pid = _new_project("GitHub")
+    r = client.get(f"/api/projects/{pid}/github/repos")
+    assert r.status_code == 200
+    assert len(r.json()) == main._GITHUB_MAX_PAGES
+    assert r.headers.get("X-GitHub-Truncated") == "1"
+
+
+def test_graph_summary():
+    import db
+    pid = _new_project("Summary")
+    assert client.get(f"/api/projects/{pid}/graph/summary").status_code == 404
+    db.graph_save(pid, {
+        "nodes": [{"id": "a", "data": {}}, {"id": "b", "data": {}}, {"id": "c", "data": {}}],
+        "edges": [{"id": "a->b", "source": "a", "target": "b"}],
+    })
+    r = client.get(f"/api/projects/{pid}/graph/summary")
+    assert r.status_code == 200
+    assert r.json() == {"n_nodes": 3, "n_edges": 1}
+
+
+async def _ok_app(scope, receive, send):
+    """App ASGI mínima detrás de los middlewares: responde 200 'ok'."""
+    from starlette.responses import PlainTextResponse
+    await PlainTextResponse("ok")(scope, receive, send)
+
+
+def test_api_key_middleware(monkeypatch):
+    import main
+    monkeypatch.setattr(main, "_BACKEND_API_KEY", "secret")
+    c = TestClient(main.APIKeyMiddleware(_ok_app))
+    assert c.get("/api/projects").status_code == 401
+    assert c.get("/api/projects", headers={"X-API-Key": "wrong"}).status_code == 401
+    assert c.get("/api/projects", headers={"X-API-Key": "secret"}).status_code == 200
+    # Rutas abiertas y api_key por query solo para el SSE de /events
+    assert c.get("/api/health").status_code == 200
+    assert c.get("/api/auth/github/callback").status_code == 200
+    assert c.get("/api/projects/p1/events", params={"api_key": "secret"}).status_code == 200
+    assert c.get("/api/projects", params={"api_key": "secret"}).status_code == 401
+    r = c.get("/api/projects")
+    assert r.json() == {"detail": "Invalid or missing X-API-Key"}
+
+
+def test_api_key_middleware_disabled_without_key(monkeypatch):
+    import main
+    monkeypatch.setattr(main, "_BACKEND_API_KEY", None)
+    c = TestClient(main.APIKeyMiddleware(_ok_app))
+    assert c.get("/api/projects").status_code == 200
+
+
+def test_rate_limit_middleware(monkeypatch):
+    from collections import defaultdict, deque
+    import main
+    monkeypatch.setattr(main, "_rate_limit_store", defaultdict(deque))
+    monkeypatch.setattr(main, "_RATE_LIMIT_PER_MIN", 3)
+    monkeypatch.setattr(main, "_RATE_LIMIT_ANALYZE_PER_MIN", 1)
+    c = TestClient(main.RateLimitMiddleware(_ok_app))
+    assert [c.get("/api/projects").status_code for _ in range(4)] == [200, 200, 200, 429]
+    # POST .../analyze tiene su propio límite (más estricto) por cliente
+    assert c.post("/api/projects/p1/analyze").status_code == 200
+    assert c.post("/api/projects/p1/analyze").status_code == 429
+    # Otro cliente (X-Forwarded-For) no comparte cuota
+    assert c.get("/api/projects", headers={"X-Forwarded-For": "10.0.0.9, 10.0.0.1"}).status_code == 200
+    # Las marcas fuera de la ventana se descartan por la izquierda y vuelve a haber cuota
+    times = main._rate_limit_store["testclient:general"]
+    for i in range(len(times)):
+        times[i] -= main._RATE_WINDOW
+    assert c.get("/api/projects").status_code == 200
+    assert len(times) == 1
+
+
+def test_sse_channel_fanout_and_cleanup():
+    import asyncio
+    import threading
+    import main
+    pid = _new_project("SSE")
+
+    async def take(resp, n):
+        frames = []
+        async for frame in resp.body_iterator:
+            frames.append(frame)
+            if len(frames) >= n:
+                break
+        return frames
+
+    async def run():
+        r1 = await main.project_events(pid)
+        r2 = await main.project_events(pid)
+        t1 = asyncio.create_task(take(r1, 3))
+        t2 = asyncio.create_task(take(r2, 3))
+        await asyncio.sleep(0.05)
+        # Avisos desde otro hilo (como el WebSocket del agente o un handler síncrono)
+        pub = threading.Thread(target=lambda: [main._notify_schema_received(pid) for _ in range(3)])
+        pub.start()
+        frames = await asyncio.wait_for(asyncio.gather(t1, t2), 5)
+        pub.join()
+        await r1.body_iterator.aclose()
+        await r2.body_iterator.aclose()
+        return frames
+
+    frames = asyncio.run(run())
+    assert frames == [[main._SSE_SCHEMA_RECEIVED] * 3] * 2
+    # Sin suscriptores el canal se elimina
+    assert pid not in main._sse_channels
+
+
+def test_sse_channel_buffer_is_bounded():
+    import asyncio
+    import main
+
+    async def run():
+        channel = main._SSEChannel(asyncio.get_running_loop())
+        waiter = asyncio.create_task(channel.changed.wait())
+        await asyncio.sleep(0)
+        for i in range(40):
+            channel.publish(f"data: {i}\n\n")
+        await asyncio.wait_for(waiter, 1)
+        return channel
+
+    channel = asyncio.run(run())
+    # Un cliente lento solo ve los últimos eventos: memoria acotada, se descartan los más viejos
+    assert len(channel.buffer) == channel.buffer.maxlen
+    assert channel.buffer[-1] == (40, "data: 39\n\n")
+
+
+def test_job_log_queue_flushes_in_order_and_requeues_on_failure(monkeypatch):
+    import db
+    pid = _new_project("Logs")
+    jid = db.job_create(pid)
+    db.job_append_log(jid, "uno")
+    db.job_append_log_bulk(jid, ["dos", "tres"])
+    db.flush_job_logs()
+    assert db.job_get(jid)["log"] == "uno\ndos\ntres"
+
+    # Si el volcado falla, las líneas vuelven a la cola delante de las nuevas
+    def broken_scope():
+        raise RuntimeError("db down")
+    monkeypatch.setattr(db, "session_scope", broken_scope)
+    db.job_append_log(jid, "cuatro")
+    with pytest.raises(RuntimeError):
+        db.flush_job_logs()
+    monkeypatch.undo()
+    db.job_append_log(jid, "cinco")
+    assert db.job_get(jid)["log"] == "uno\ndos\ntres\ncuatro\ncinco"
+
+
+def test_job_reads_and_status_changes_survive_failed_log_flush(monkeypatch, caplog):
+    import db
+    jid = db.job_create(_new_project("LogsDown"))
+
+    def broken_flush():
+        raise RuntimeError("db down")
+    monkeypatch.setattr(db, "flush_job_logs", broken_flush)
+    # El poll del job y los cambios de estado siguen; el volcado queda para el writer
+    db.job_set_running(jid)
+    assert db.job_get(jid)["status"] == "running"
+    assert client.get(f"/api/jobs/{jid}").status_code == 200
+    db.job_set_failed(jid, "boom")
+    assert db.job_get(jid)["status"] == "failed"
+    assert any("db down" in r.getMessage() for r in caplog.records)
+    # Solo el apagado propaga el fallo
+    with pytest.raises(RuntimeError):
+        db.stop_log_writer()
+
+
+def test_job_log_flush_threshold_tracks_flush_latency(monkeypatch):
+    import db
+    monkeypatch.setattr(db, "_log_flush_lines", db._LOG_FLUSH_LINES_MIN)
+    monkeypatch.setattr(db, "_log_flush_ewma", 0.0)
+    # Volcados lentos -> lotes más grandes, con tope en _LOG_FLUSH_LINES_MAX
+    for _ in range(50):
+        db._tune_log_flush(db._LOG_FLUSH_TARGET * 10)
+    assert db._log_flush_lines == db._LOG_FLUSH_LINES_MAX
+    # Volcados rápidos -> vuelta al mínimo
+    for _ in range(50):
+        db._tune_log_flush(0.0)
+    assert db._log_flush_lines == db._LOG_FLUSH_LINES_MIN
+
+    # Superar el umbral de líneas despierta al writer sin esperar al intervalo
+    import threading
+    wakes = []
+
+    class SpyEvent(threading.Event):
+        def set(self):
+            wakes.append(1)
+            super().set()
+    monkeypatch.setattr(db, "_log_writer_wake", SpyEvent())
+    jid = db.job_create(_new_project("Wake"))
+    db.flush_job_logs()
+    db.job_append_log_bulk(jid, ["x"] * (db._LOG_FLUSH_LINES_MIN - 1))
+    assert wakes == []
+    db.job_append_log(jid, "y")
+    assert wakes == [1]
+    db.flush_job_logs()
+
+
+def test_impact_cache_ignores_reads_during_graph_write(monkeypatch):
+    import sys
+    import threading
+    import types
+    import main
+
+    class Session(_FakeNeo4jSession):
+        def execute_read(self, fn, *args):
+            return self.driver.impact
+
+    class Driver(_FakeNeo4jDriver):
+        impact = (("old",), ())
+
+        def session(self, **kwargs):
+            return Session(self)
+
+    neo4j = types.ModuleType("neo4j")
+    neo4j.READ_ACCESS = "READ"
+    neo4j.exceptions = types.ModuleType("neo4j.exceptions")
+    neo4j.exceptions.ClientError = type("ClientError", (Exception,), {})
+    monkeypatch.setitem(sys.modules, "neo4j", neo4j)
+    monkeypatch.setitem(sys.modules, "neo4j.exceptions", neo4j.exceptions)
+    driver = Driver()
+    started, release = threading.Event(), threading.Event()
+
+    def slow_write(_driver, _graph):
+        started.set()
+        release.wait(5)
+        driver.impact = (("new",), ())  # "commit" del grafo nuevo
+
+    monkeypatch.setattr(main, "_get_neo4j_driver", lambda: driver)
+    monkeypatch.setattr(main, "_write_graph_to_neo4j", slow_write)
+    monkeypatch.setattr(main, "_neo4j_apoc", False)
+    main._neo4j_impact.cache_clear()
+    graph = {"nodes": [{"id": "a", "data": {}}], "edges": []}
+    post = threading.Thread(target=lambda: client.post("/api/graph", json={"graph": graph}))
+    post.start()
+    assert started.wait(5)
+    # Lectura durante la escritura: ve el grafo anterior, pero no lo deja en caché
+    assert client.get("/api/graph/impact", params={"node_id": "a"}).json()["upstream"] == ["old"]
+    release.set()
+    post.join(5)
+    assert client.get("/api/graph/impact", params={"node_id": "a"}).json()["upstream"] == ["new"]
+    main._neo4j_impact.cache_clear()
+
+
+def test_job_log_flush_isolates_failing_job_and_caps_retries(monkeypatch, caplog):
+    import db
+    from sqlalchemy import text
+    pid = _new_project("LogsBad")
+    good = db.job_create(pid)
+    db.flush_job_logs()
+    # El UPDATE falla solo para el job "bad" (json() de texto no válido), como un id que no pasa el CAST
+    monkeypatch.setattr(db, "_SQL_JOB_APPEND_LOG_SQLITE", text(
+        "UPDATE analysis_jobs SET log = CASE WHEN log IS NULL OR log = '' THEN :msg ELSE log || :nl || :msg END "
+        "WHERE id = :id AND CASE WHEN :id = 'bad' THEN json('x') ELSE 1 END"
+    ))
+    monkeypatch.setattr(db, "_LOG_FLUSH_MAX_RETRIES", 2)
+    db.job_append_log("bad", "perdida")
+    db.job_append_log(good, "ok")
+    db.flush_job_logs()
+    assert db.job_get(good)["log"] == "ok"
+    for _ in range(5):
+        db.flush_job_logs()
+    # Reintentos agotados: la línea sale de la cola y queda en el log del proceso
+    assert "bad" not in db._log_queue and "bad" not in db._log_retries
+    assert any("perdida" in r.getMessage() for r in caplog.records)
+
+
+def test_job_log_requeue_is_bounded_by_bytes(monkeypatch, caplog):
+    import db
+    jid = db.job_create(_new_project("LogsBig"))
+    db.flush_job_logs()
+
+    def broken_scope():
+        raise RuntimeError("db down")
+    monkeypatch.setattr(db, "session_scope", broken_scope)
+    monkeypatch.setattr(db, "_LOG_QUEUE_MAX_BYTES", 10)
+    db.job_append_log(jid, "x" * 50)
+    with pytest.raises(RuntimeError):
+        db.flush_job_logs()
+    assert jid not in db._log_queue
+    assert any("x" * 50 in r.getMessage() for r in caplog.records)
+
+
+def test_node_notes_get_many_accepts_non_canonical_uuids(monkeypatch):
+    import contextlib
+    import types
+    import uuid
+    import db
+    pid = uuid.uuid4()
+    seen = {}
+
+    class Conn:
+        def execute(self, stmt, params):
+            seen.update(params)
+            # Postgres devuelve el UUID en forma canónica
+            return types.SimpleNamespace(all=lambda: [(pid, "model:User", ["a"])])
+
+    monkeypatch.setattr(db, "_IS_SQLITE", False)
+    monkeypatch.setattr(db, "read_scope", contextlib.contextmanager(lambda: (yield Conn())))
+    upper, bare = str(pid).upper(), pid.hex
+    out = db.node_notes_get_many([upper, bare, "no-es-un-uuid"])
+    # Un id que no es UUID no tumba el lote ni llega al CAST: sale sin notas, como en SQLite
+    assert out == {upper: {"model:User": ["a"]}, bare: {"model:User": ["a"]}, "no-es-un-uuid": {}}
+    assert seen["ids"] == [str(pid)]
+
+
+def test_node_notes_get_many_reads_several_projects():
+    import uuid
+    import db
+    p1, p2 = _new_project("NotesMany1"), _new_project("NotesMany2")
+    db.node_notes_set(p1, {"model:User": ["a"], "view:home": ["b"]})
+    db.node_notes_set(p2, {"model:Order": ["c"]})
+    missing = str(uuid.uuid4())
+    assert db.node_notes_get_many([p1, p2, missing]) == {
+        p1: {"model:User": ["a"], "view:home": ["b"]},
+        p2: {"model:Order": ["c"]},
+        missing: {},
+    }
+
+
+def test_node_notes_set_many_replaces_and_invalidates_cache():
+    import db
+    p1, p2 = _new_project("NotesSetMany1"), _new_project("NotesSetMany2")
+    db.node_notes_set(p1, {"model:User": ["a"], "view:home": ["b"]})
+    db.node_notes_set(p2, {"model:Order": ["c"]})
+    # Caché caliente con las notas viejas
+    assert db.node_notes_get(p1) == {"model:User": ["a"], "view:home": ["b"]}
+    assert db.node_notes_get(p2) == {"model:Order": ["c"]}
+    db.node_notes_set_many({p1: {"model:User": ["x"]}, p2: {"route:new": ["y"]}})
+    # Reemplazo completo: los nodos que no vienen desaparecen, y no se sirven los del caché
+    new = {p1: {"model:User": ["x"]}, p2: {"route:new": ["y"]}}
+    assert db.node_notes_get(p1) == new[p1]
+    assert db.node_notes_get(p2) == new[p2]
+    assert db.node_notes_get_many([p1, p2]) == new
+    assert db.node_note_get_for_node(p1, "view:home") == []
+    db.node_notes_set_many({})
+    assert db.node_notes_get_many([p1, p2]) == new
+
+
+def test_node_notes_cache_is_not_shared_with_callers():
+    import db
+    pid = _new_project("NotesCache")
+    notes = {"model:User": ["a"]}
+    db.node_notes_set(pid, notes)
+    # Mutar lo pasado o lo devuelto no toca el caché (que no sube rev)
+    notes["model:User"].append("b")
+    got = db.node_notes_get(pid)
+    assert got == {"model:User": ["a"]}
+    got["model:User"].append("c")
+    assert db.node_notes_get(pid) == {"model:User": ["a"]}
+    # Así node_notes_set sigue viendo el cambio real y lo escribe
+    db.node_notes_set(pid, {"model:User": ["a", "b"]})
+    assert db.node_note_get_for_node(pid, "model:User") == ["a", "b"]
@@ -252,18 +252,21 @@ export default function ProjectDetail({ projectId, onBack, onOpenGraph, initialS
         if (job.status === 'completed') {
           setJobId(null)
           setAnalyzing(false)
+          setCancellingJob(false)
           toast.success('Analysis completed')
           const graph = await fetchProjectGraph(projectId)
           onOpenGraph(graph)
         } else if (job.status === 'failed') {
           setJobId(null)
           setAnalyzing(false)
+          setCancellingJob(false)
           const msg = job.error_message || 'Analysis failed'
           setAnalyzeError(msg)
           toast.error(msg)
         } else if (job.status === 'cancelled') {
           setJobId(null)
           setAnalyzing(false)
+          setCancellingJob(false)
           load()
           toast('Analysis stopped. You can resume later.', { icon: '⏹' })
         }
@@ -463,16 +466,20 @@ export default function ProjectDetail({ projectId, onBack, onOpenGraph, initialS
     if (!jobId) return
     setCancellingJob(true)
     cancelJob(jobId)
-      .then(() => {
+      .then((res) => {
+        // 'cancelling': el analizador aún se está deteniendo; el polling del job termina al ver 'cancelled'
+        if (res?.status === 'cancelling') return
         setJobId(null)
         setAnalyzing(false)
+        setCancellingJob(false)
+        load()
         toast.success('Analysis stopped')
       })
       .catch((e) => {
+        setCancellingJob(false)
         toast.error(e.message || 'Failed to stop')
       })
-      .finally(() => setCancellingJob(false))
-  }, [jobId])
+  }, [jobId, load])
 
   const handleClearGraph = useCallback(() => {
     if (!projectId) return